@@ -0,0 +1,224 @@
+import argparse
+import inlet_data
+import snapshot
+
+
+def select_names(names, inlet_names=[]):
+    # every inlet unless some were asked for
+    if len(inlet_names) == 0:
+        return names
+    return [name for name in names if name in inlet_names]
+
+
+def copy_inlet(source, target):
+    """Copy every row of one inlet between two stores with the InletDb interface.
+
+    Rows are copied a batch at a time, so any size of inlet can be copied.
+    """
+    everything = (None, None)
+    for data in source.iter_data("temperature", everything):
+        target.add_temperature_data(data)
+    for data in source.iter_data("salinity", everything):
+        target.add_salinity_data(data)
+    for data in source.iter_data("oxygen", everything):
+        target.add_oxygen_data(data)
+
+
+def convert(source_store, source_name, target_store, target_name, inlet_names=[]):
+    if source_store == "parquet":
+        import inlet_parquet
+
+        names = inlet_parquet.get_inlet_names(source_name)
+    else:
+        names = inlet_data.get_inlet_names(source_name)
+    for name in select_names(names, inlet_names):
+        print(f"Copying {name} from {source_name} to {target_name}")
+        source = inlet_data.open_db(name, db_name=source_name, store=source_store)
+        target = inlet_data.open_db(
+            name, clear=True, db_name=target_name, store=target_store
+        )
+        copy_inlet(source, target)
+        target.flush()
+
+
+def encode(db_name, target, inlet_names=[]):
+    """Copy inlets into `target` with the compact encoding.
+
+    Depths and values are kept to DEPTH_SCALE and VALUE_SCALE, and positions
+    once per source. Reading the copy is the same as reading the original.
+    Inlets with rows whose depths are too close to tell apart at DEPTH_SCALE
+    are reported and not copied, instead of losing all but one of those rows.
+    """
+    for name in select_names(inlet_data.get_inlet_names(db_name), inlet_names):
+        source = inlet_data.InletDb(name, db_name=db_name, read_only=True)
+        collisions = source.get_depth_collisions()
+        if len(collisions) > 0:
+            print(
+                f"Not copying {name}: {len(collisions)} groups of rows have depths "
+                f"closer than the 1/{inlet_data.DEPTH_SCALE} m the encoding keeps"
+            )
+            for kind, source_name, time, depths in collisions[:10]:
+                print(f"  {kind} from {source_name} at {time}: {depths}")
+            continue
+        print(f"Copying {name} from {db_name} to {target} with the compact encoding")
+        compact = inlet_data.InletDb(name, clear=True, db_name=target, compact=True)
+        compact.set_depth_zones(source.zones)
+        compact.merge_from(db_name)
+
+
+def export_snapshots(db_name, root, inlet_names=[]):
+    for name in select_names(inlet_data.get_inlet_names(db_name), inlet_names):
+        print(f"Writing snapshot of {name} to {root}")
+        snapshot.export_snapshot(
+            inlet_data.InletDb(name, db_name=db_name, read_only=True), root
+        )
+
+
+def compact(db_name, inlet_names=[]):
+    for name in select_names(inlet_data.get_inlet_names(db_name), inlet_names):
+        print(f"Compacting {name}")
+        # once the key is there, duplicates cannot come back
+        removed = inlet_data.InletDb(name, db_name=db_name).add_key()
+        if removed > 0:
+            print(f"Removed {removed} duplicate rows from {name}")
+    print(f"Vacuuming {db_name}")
+    inlet_data.vacuum(db_name)
+
+
+def merge_shards(root, db_name, inlet_names=[]):
+    print(f"Merging shards in {root} into {db_name}")
+    inlet_data.ShardSet(root).merge(db_name, inlet_names)
+
+
+def merge(db_names, target, inlet_names=[]):
+    """Merge the inlets of every database in `db_names` into `target`.
+
+    Rows with the same key are only kept once, with the values from the
+    database that comes last.
+    """
+    for db_name in db_names:
+        for name in select_names(inlet_data.get_inlet_names(db_name), inlet_names):
+            print(f"Merging {name} from {db_name} into {target}")
+            inlet_data.InletDb(name, db_name=target).merge_from(db_name)
+
+
+def diff(old, new, inlet_names=[]):
+    """Print the rows per inlet and source that differ between two databases."""
+    names = sorted(
+        set(inlet_data.get_inlet_names(old)) | set(inlet_data.get_inlet_names(new))
+    )
+    for name in select_names(names, inlet_names):
+        differences = inlet_data.diff(old, new, name)
+        if len(differences) == 0:
+            continue
+        print(f"{name}:")
+        for source, counts in sorted(differences.items()):
+            print(
+                f"  {source}: {counts['added']} added, {counts['removed']} removed, "
+                f"{counts['changed']} changed"
+            )
+
+
+def delta(old, new, target, inlet_names=[]):
+    """Write the rows of `new` which are not in `old` as they are to `target`.
+
+    Merging `target` into `old` then gives the rows of `new`, apart from any
+    which were removed.
+    """
+    for name in select_names(inlet_data.get_inlet_names(new), inlet_names):
+        print(f"Writing changes to {name} in {new} to {target}")
+        inlet_data.InletDb(name, db_name=target).merge_from(new, base=old)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain inlet databases")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    to_parquet = commands.add_parser(
+        "to-parquet", help="Copy inlets from a SQLite database to Parquet files"
+    )
+    to_parquet.add_argument("-s", "--source", type=str, default="inlet_data.db")
+    to_parquet.add_argument("-t", "--target", type=str, default="inlet_data.parquet")
+    to_parquet.add_argument("-i", "--inlet-name", type=str, nargs="+", default=[])
+
+    to_sqlite = commands.add_parser(
+        "to-sqlite", help="Copy inlets from Parquet files to a SQLite database"
+    )
+    to_sqlite.add_argument("-s", "--source", type=str, default="inlet_data.parquet")
+    to_sqlite.add_argument("-t", "--target", type=str, default="inlet_data.db")
+    to_sqlite.add_argument("-i", "--inlet-name", type=str, nargs="+", default=[])
+
+    to_compact = commands.add_parser(
+        "to-compact", help="Copy inlets to a SQLite database with the compact encoding"
+    )
+    to_compact.add_argument("-s", "--source", type=str, default="inlet_data.db")
+    to_compact.add_argument("-t", "--target", type=str, required=True)
+    to_compact.add_argument("-i", "--inlet-name", type=str, nargs="+", default=[])
+
+    snapshots = commands.add_parser(
+        "snapshot", help="Write .npy snapshots of a SQLite database for plot -r"
+    )
+    snapshots.add_argument("-s", "--source", type=str, default="inlet_data.db")
+    snapshots.add_argument("-t", "--target", type=str, default="inlet_data.snapshots")
+    snapshots.add_argument("-i", "--inlet-name", type=str, nargs="+", default=[])
+
+    compaction = commands.add_parser(
+        "compact", help="Remove duplicate rows from a SQLite database and vacuum it"
+    )
+    compaction.add_argument("-s", "--source", type=str, default="inlet_data.db")
+    compaction.add_argument("-i", "--inlet-name", type=str, nargs="+", default=[])
+
+    merging = commands.add_parser(
+        "merge-shards", help="Gather per-inlet shard files into one SQLite database"
+    )
+    merging.add_argument("-s", "--source", type=str, default="inlet_data.shards")
+    merging.add_argument("-t", "--target", type=str, default="inlet_data.db")
+    merging.add_argument("-i", "--inlet-name", type=str, nargs="+", default=[])
+
+    merging_all = commands.add_parser(
+        "merge", help="Merge SQLite databases into one, without duplicate rows"
+    )
+    merging_all.add_argument("sources", type=str, nargs="+")
+    merging_all.add_argument("-t", "--target", type=str, default="inlet_data.db")
+    merging_all.add_argument("-i", "--inlet-name", type=str, nargs="+", default=[])
+
+    differences = commands.add_parser(
+        "diff", help="Count the rows per inlet and source differing between databases"
+    )
+    differences.add_argument("old", type=str)
+    differences.add_argument("new", type=str)
+    differences.add_argument("-i", "--inlet-name", type=str, nargs="+", default=[])
+
+    deltas = commands.add_parser(
+        "delta", help="Write the rows added or changed between two databases"
+    )
+    deltas.add_argument("old", type=str)
+    deltas.add_argument("new", type=str)
+    deltas.add_argument("-t", "--target", type=str, required=True)
+    deltas.add_argument("-i", "--inlet-name", type=str, nargs="+", default=[])
+
+    args = parser.parse_args()
+    # inlet names are matched against table names, as in "saanich_inlet"
+    inlet_names = [inlet_data._table_name(name) for name in args.inlet_name]
+    if args.command == "to-parquet":
+        convert("sqlite", args.source, "parquet", args.target, inlet_names)
+    elif args.command == "to-sqlite":
+        convert("parquet", args.source, "sqlite", args.target, inlet_names)
+    elif args.command == "to-compact":
+        encode(args.source, args.target, inlet_names)
+    elif args.command == "snapshot":
+        export_snapshots(args.source, args.target, inlet_names)
+    elif args.command == "compact":
+        compact(args.source, inlet_names)
+    elif args.command == "merge-shards":
+        merge_shards(args.source, args.target, inlet_names)
+    elif args.command == "merge":
+        merge(args.sources, args.target, inlet_names)
+    elif args.command == "diff":
+        diff(args.old, args.new, inlet_names)
+    elif args.command == "delta":
+        delta(args.old, args.new, args.target, inlet_names)
+
+
+if __name__ == "__main__":
+    main()
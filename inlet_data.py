@@ -1,18 +1,149 @@
+from contextlib import contextmanager
 from dataclasses import dataclass
 import datetime
 import logging
+import numpy
+import os
+import pathlib
 import sqlite3
-from typing import List, Tuple
+import tempfile
+from typing import Dict, Iterator, List, Optional, Sequence, Set, Tuple
+import uuid
 
 
 sqlite3.paramstyle = "named"
 DB_NAME = "inlet_data.db"
+SHARD_ROOT = "inlet_data.shards"
+STORES = ("sqlite", "parquet", "shards")
+# SQLite's default limit on attached databases
+MAX_ATTACHED = 10
+# write generation of every inlet, bumped on every write and kept in the
+# database, so that cached query results and files derived from the rows can
+# tell whether they are still current
+GENERATIONS = "inlet_generations"
+# the depth boundaries each inlet's rows are tagged against, see set_depth_zones
+ZONES = "inlet_zones"
+# a random identity of each inlet's rows, made again when they are cleared, so
+# files derived from them can tell a new table with the same generation apart
+IDENTITIES = "inlet_identities"
+# the generation each inlet's aggregate cube was built from, see build_cube
+CUBES = "inlet_cubes"
+# the depth range and left out qualities of each bucket of those cubes
+CUBE_BUCKETS = "inlet_cube_buckets"
+# the periods of the cube, from finest to coarsest, with the SQL giving the
+# period of each from the one below it
+RESOLUTIONS = ("day", "month", "year", "decade")
+PERIODS = {"month": "substr(period, 1, 7)", "year": "substr(period, 1, 4)"}
+PERIODS["decade"] = "substr(period, 1, 3) || '0'"
+COLUMN_TYPES = {
+    "time": "datetime64[us]",
+    "depth": float,
+    "value": float,
+    "quality": int,
+    "longitude": float,
+    "latitude": float,
+    "computed": bool,
+    "assumed_density": bool,
+    "source": object,
+}
+DEFAULT_COLUMNS = ("time", "value", "quality")
+# a row with the same key as an existing one replaces it, so inserting the
+# same data twice leaves one copy
+KEY = ("kind", "source", "time", "depth")
+KEY_COLUMNS = ", ".join(KEY)
+UPSERT = f"""on conflict ({KEY_COLUMNS}) do update set
+    latitude=excluded.latitude,
+    longitude=excluded.longitude,
+    value=excluded.value,
+    quality=excluded.quality,
+    computed=excluded.computed,
+    assumed_density=excluded.assumed_density"""
+# a source written to again widens its catalog entry, whose samples are
+# counted again from the summary
+CATALOG_UPSERT = """on conflict (source) do update set
+    start_time=min(start_time, excluded.start_time),
+    end_time=max(end_time, excluded.end_time),
+    min_depth=min(min_depth, excluded.min_depth),
+    max_depth=max(max_depth, excluded.max_depth),
+    samples=excluded.samples"""
+# the columns which are not part of the key
+VALUE_COLUMNS = (
+    "latitude",
+    "longitude",
+    "value",
+    "quality",
+    "computed",
+    "assumed_density",
+)
+# the columns written from InletData, in table order, before the depth zone
+DATA_COLUMNS = (
+    "kind",
+    "source",
+    "latitude",
+    "longitude",
+    "time",
+    "depth",
+    "value",
+    "quality",
+    "computed",
+    "assumed_density",
+)
+# rows fetched from the cursor at a time by the iter_* methods
+BATCH_SIZE = 100_000
+# the typed fields of InletDataBatch, besides the encoded source
+BATCH_FIELDS = (
+    "time",
+    "depth",
+    "value",
+    "quality",
+    "longitude",
+    "latitude",
+    "computed",
+    "assumed_density",
+)
+# the compact encoding keeps depths and values as integers in these units,
+# which SQLite writes in 2 to 4 bytes instead of 8
+DEPTH_SCALE = 1_000
+VALUE_SCALE = 100_000
+# tables kept alongside each inlet's table, named "<inlet>_<suffix>"
+AUXILIARY_SUFFIXES = ("_summary", "_catalog", "_rows", "_positions", "_cube")
+# times are read without their UTC offset, matching the wall clock values
+# that datetime.fromisoformat gives for the date and month
+TIME = "substr(time, 1, 26)"
+DAY = "substr(time, 1, 10)"
+YEAR = "cast(substr(time, 1, 4) as integer)"
+MONTH = "cast(substr(time, 6, 2) as integer)"
 
 
 def _table_name(inlet_name: str) -> str:
     return inlet_name.lower().replace(" ", "_")
 
 
+def get_inlet_names(db_name: str = DB_NAME) -> List[str]:
+    """Names of the inlets stored in `db_name`, as their table names."""
+    connection = sqlite3.connect(db_name)
+    try:
+        cursor = connection.execute(
+            """
+            select name
+            from sqlite_master
+            where type in ('table', 'view')
+                and name not in (:generations, :identities, :zones, :cubes, :buckets)
+            order by name
+            """,
+            {
+                "generations": GENERATIONS,
+                "identities": IDENTITIES,
+                "zones": ZONES,
+                "cubes": CUBES,
+                "buckets": CUBE_BUCKETS,
+            },
+        )
+        return [row[0] for row in cursor if not row[0].endswith(AUXILIARY_SUFFIXES)]
+    finally:
+        connection.close()
+
+
 @dataclass(frozen=True)
 class InletData:
     time: datetime.datetime
@@ -39,37 +170,846 @@ class InletData:
         }
 
 
-def _averaged(data: List[InletData]) -> List[InletData]:
-    """Perform daily vertical averaging inside depth categories."""
-    freqs = {}
-    for datum in data:
-        source = datum.source
-        date = datum.time.date()
-        key = (source, date)
-        if key not in freqs:
-            freqs[key] = (0, 0)
-        total, count = freqs[key]
-        freqs[key] = (total + datum.value, count + 1)
-    return [
-        InletData(d, 0, total / count, 0, 0, 0, fn)
-        for (fn, d), (total, count) in freqs.items()
-    ]
+@dataclass(frozen=True)
+class CatalogEntry:
+    """What is known about one source file that data was read from."""
+
+    source: str
+    instrument: str
+    latitude: float
+    longitude: float
+    start_time: datetime.datetime
+    end_time: datetime.datetime
+    min_depth: float
+    max_depth: float
+    samples: int
+
+
+@dataclass(frozen=True, eq=False)
+class InletDataBatch:
+    """Many InletData rows, stored as one typed array per field.
+
+    `source` holds indices into `sources`, so each row costs a few tens of
+    bytes instead of a whole object. Iterating or indexing with an integer
+    gives InletData rows, and any other index selects a smaller batch. Times
+    are wall clock datetime64 values, without a UTC offset.
+    """
+
+    time: numpy.ndarray
+    depth: numpy.ndarray
+    value: numpy.ndarray
+    quality: numpy.ndarray
+    longitude: numpy.ndarray
+    latitude: numpy.ndarray
+    source: numpy.ndarray
+    sources: numpy.ndarray
+    computed: numpy.ndarray
+    assumed_density: numpy.ndarray
+
+    @classmethod
+    def from_columns(cls, columns: Dict[str, Sequence]) -> "InletDataBatch":
+        """Batch from a value sequence per field, with the sources as strings."""
+        sources, codes = numpy.unique(
+            numpy.asarray(columns["source"], dtype=object), return_inverse=True
+        )
+        return cls(
+            source=codes.astype(numpy.int32),
+            sources=sources,
+            **{
+                field: numpy.asarray(columns[field], dtype=COLUMN_TYPES[field])
+                for field in BATCH_FIELDS
+            },
+        )
+
+    @classmethod
+    def from_data(cls, data: Sequence[InletData]) -> "InletDataBatch":
+        columns = {
+            field: [getattr(datum, field) for datum in data]
+            for field in BATCH_FIELDS + ("source",)
+        }
+        columns["time"] = [time.replace(tzinfo=None) for time in columns["time"]]
+        return cls.from_columns(columns)
+
+    def __len__(self):
+        return len(self.time)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, numpy.integer)):
+            return InletData(
+                source=self.sources[self.source[index]],
+                **{field: self.__item(field, index) for field in BATCH_FIELDS},
+            )
+        return InletDataBatch(
+            source=self.source[index],
+            sources=self.sources,
+            **{field: getattr(self, field)[index] for field in BATCH_FIELDS},
+        )
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __item(self, field: str, index: int):
+        item = getattr(self, field)[index]
+        if field == "time":
+            return item.astype(datetime.datetime)
+        return item.item()
+
+    @property
+    def nbytes(self) -> int:
+        return sum(
+            getattr(self, field).nbytes for field in BATCH_FIELDS + ("source",)
+        )
+
+    def get_sources(self) -> numpy.ndarray:
+        """The source of every row, as strings."""
+        return self.sources[self.source]
+
+    def filter(self, keep: numpy.ndarray) -> "InletDataBatch":
+        return self[numpy.asarray(keep, dtype=bool)]
+
+    def in_bucket(self, bucket: Tuple[float, float]) -> "InletDataBatch":
+        """Rows with a depth inside `bucket`, bounds included like InletDb."""
+        min_depth, max_depth = bucket
+        keep = numpy.ones(len(self), dtype=bool)
+        if min_depth is not None:
+            keep &= self.depth >= min_depth
+        if max_depth is not None:
+            keep &= self.depth <= max_depth
+        return self.filter(keep)
+
+    def excluding_qualities(self, qualities: Sequence[int]) -> "InletDataBatch":
+        return self.filter(~numpy.isin(self.quality, qualities))
+
+    def before(self, before) -> "InletDataBatch":
+        """Rows from before the year of `before`, like the `before` queries."""
+        return self.filter(
+            self.time < numpy.datetime64(f"{before.year:04}-01-01", "us")
+        )
+
+
+def _row_to_data(row: sqlite3.Row) -> InletData:
+    return InletData(
+        source=row["source"],
+        latitude=row["latitude"],
+        longitude=row["longitude"],
+        time=datetime.datetime.fromisoformat(row["time"]),
+        depth=row["depth"],
+        value=row["value"],
+        quality=row["quality"],
+        computed=(row["computed"] > 0),
+        assumed_density=(row["assumed_density"] > 0),
+    )
+
+
+def _same_key(a: str, b: str) -> str:
+    return " and ".join(f"{a}.{column}={b}.{column}" for column in KEY)
+
+
+def _same_values(a: str, b: str) -> str:
+    return " and ".join(f"{a}.{column} is {b}.{column}" for column in VALUE_COLUMNS)
+
+
+def diff(old_db: str, new_db: str, inlet_name: str) -> Dict[str, Dict[str, int]]:
+    """Row differences per source of one inlet between two database files.
+
+    Counts rows "added" in `new_db`, "removed" from `old_db`, and "changed",
+    which have the same key but different values. Sources which are the
+    same in both are left out. Both files are only read, as they are.
+    """
+    name = _table_name(inlet_name)
+    connection = sqlite3.connect("file::memory:", uri=True)
+    counts = {}
+
+    def count(label: str, query: str):
+        for row in connection.execute(query):
+            counts.setdefault(row[0], {"added": 0, "removed": 0, "changed": 0})[
+                label
+            ] = row[1]
+
+    try:
+        has_table = {}
+        for schema, db_name in (("old", old_db), ("new", new_db)):
+            if not os.path.isfile(db_name):
+                raise ValueError(f"There is no database {db_name}")
+            connection.execute(
+                f"attach database :uri as {schema}", {"uri": _read_only_uri(db_name)}
+            )
+            cursor = connection.execute(
+                f"""
+                select count(name) from {schema}.sqlite_master
+                where type in ('table', 'view') and name=:name""",
+                {"name": name},
+            )
+            has_table[schema] = cursor.fetchone()[0] > 0
+        for label, schema, other in (
+            ("added", "new", "old"),
+            ("removed", "old", "new"),
+        ):
+            if not has_table[schema]:
+                continue
+            missing = (
+                f"""not exists (
+                    select 1 from {other}.{name} as b where {_same_key("a", "b")}
+                )"""
+                if has_table[other]
+                else "true"
+            )
+            count(
+                label,
+                f"""select a.source, count(*) from {schema}.{name} as a
+                where {missing}
+                group by a.source""",
+            )
+        if has_table["old"] and has_table["new"]:
+            count(
+                "changed",
+                f"""select o.source, count(*) from old.{name} as o
+                join new.{name} as n on {_same_key("o", "n")}
+                where not ({_same_values("o", "n")})
+                group by o.source""",
+            )
+    finally:
+        connection.close()
+    return counts
+
+
+def _instrument(source: str) -> str:
+    # the file extension of `source`, ignoring a final ".nc"
+    name = f"replace(lower({source}), '.nc', '')"
+    return f"""case when instr({name}, '.') > 0
+        then replace({name}, rtrim({name}, replace({name}, '.', '')), '')
+        else '' end"""
+
+
+def _zone(depth: str, boundaries: Sequence[float]) -> str:
+    """SQL for the depth zone of `depth`, given sorted, distinct boundaries.
+
+    Zone 2i + 1 is exactly the depth boundaries[i], and zone 2i is between it
+    and the boundary before, so rows on a boundary are in every bucket that
+    includes it, as with the inclusive depth ranges.
+    """
+    if len(boundaries) == 0:
+        return "null"
+    cases = "".join(
+        f" when {depth}<{boundary!r} then {2 * i}"
+        f" when {depth}={boundary!r} then {2 * i + 1}"
+        for i, boundary in enumerate(boundaries)
+    )
+    return f"case{cases} else {2 * len(boundaries)} end"
+
+
+def _merged_cells(cube: str, coarser: str, condition: str) -> str:
+    """SQL for the cells of `coarser` periods, from the finer cells in them.
+
+    Each cell has the count, mean and M2 of every value of the cells in it
+    together, as Chan et al. merge partial results, so a month has every
+    daily mean of its days.
+    """
+    period = PERIODS[coarser]
+    return f"""
+        select kind, bucket, '{coarser}' as resolution, parent as period,
+            sum(count) as count,
+            sum(count * mean) / sum(count) as mean,
+            sum(m2 + count * (mean - merged) * (mean - merged)) as m2
+        from (
+            select kind, bucket, {period} as parent, count, mean, m2,
+                sum(count * mean) over cells / sum(count) over cells as merged
+            from {cube}
+            where {condition}
+            window cells as (partition by kind, bucket, {period})
+        )
+        group by kind, bucket, parent"""
+
+
+def _cells_of_means(cube: str, coarser: str, condition: str) -> str:
+    # like _merged_cells, with the mean of each finer cell as one value, as a
+    # year is averaged from its monthly means
+    period = PERIODS[coarser]
+    return f"""
+        select kind, bucket, '{coarser}' as resolution, parent as period,
+            count(mean) as count,
+            avg(mean) as mean,
+            sum((mean - merged) * (mean - merged)) as m2
+        from (
+            select kind, bucket, {period} as parent, mean,
+                avg(mean) over cells as merged
+            from {cube}
+            where {condition}
+            window cells as (partition by kind, bucket, {period})
+        )
+        group by kind, bucket, parent"""
+
+
+def _bucket_definition(
+    bounds: Tuple[float, float], exclude_qualities: Sequence[int]
+) -> Tuple:
+    # a bucket as it is kept in CUBE_BUCKETS
+    min_depth, max_depth = bounds
+    excluded = ",".join(str(quality) for quality in sorted(set(exclude_qualities)))
+    return (min_depth, max_depth, excluded)
+
+
+def _depth_collisions(table: str, condition: str = "") -> str:
+    # rows of `table`, as "o", with keys that only differ by depths which the
+    # compact encoding rounds to the same DEPTH_SCALE units
+    return f"""
+        select kind, source, time, group_concat(depth, ', ') as depths
+        from (select distinct kind, source, time, depth from {table} as o
+            where true {condition})
+        group by kind, source, time, cast(round(depth * {DEPTH_SCALE}) as integer)
+        having count(*) > 1
+        order by kind, source, time"""
+
+
+def _read_only_uri(db_name: str) -> str:
+    # SQLite opens these without ever writing to the file, or making it
+    if db_name.startswith("file:"):
+        return f"{db_name}{'&' if '?' in db_name else '?'}mode=ro"
+    return f"{pathlib.Path(db_name).absolute().as_uri()}?mode=ro"
+
+
+def _new(expression: str) -> str:
+    # refer to the inserted row inside a trigger
+    return expression.replace("time", "new.time")
+
+
+def _old(expression: str) -> str:
+    # refer to the deleted row inside a trigger
+    return expression.replace("time", "old.time")
+
+
+def _row_dtype(columns: Sequence[str]) -> numpy.dtype:
+    # times are parsed from their ISO text after the rows have been read
+    return numpy.dtype(
+        [
+            (column, "U26" if column == "time" else COLUMN_TYPES[column])
+            for column in columns
+        ]
+    )
+
+
+def _read_columns(
+    rows: Sequence[tuple], columns: Sequence[str]
+) -> Dict[str, numpy.ndarray]:
+    # numpy.fromiter only makes object fields from numpy 1.23 on, so sources
+    # are gathered into their own array
+    fields = [column for column in columns if COLUMN_TYPES[column] is not object]
+    if len(fields) < len(columns):
+        indices = [columns.index(column) for column in fields]
+        records = (tuple(row[i] for i in indices) for row in rows)
+    else:
+        records = iter(rows)
+    values = numpy.fromiter(records, dtype=_row_dtype(fields), count=len(rows))
+    return {
+        column: values[column].astype(COLUMN_TYPES[column])
+        if column == "time"
+        else numpy.ascontiguousarray(values[column])
+        if column in fields
+        else numpy.array([row[i] for row in rows], dtype=object)
+        for i, column in enumerate(columns)
+    }
 
 
 class InletDb:
-    def __init__(self, inlet_name: str, clear: bool = False, db_name: str = DB_NAME):
+    def __init__(
+        self,
+        inlet_name: str,
+        clear: bool = False,
+        db_name: str = DB_NAME,
+        compact: bool = False,
+        read_only: bool = False,
+    ):
+        """Open the table of one inlet, making it when there is none.
+
+        Tables written by older versions get the tables and columns added
+        since, but duplicate rows are only removed, and the key only added,
+        by add_key. With `read_only`, nothing is written to the database, and
+        an inlet which is missing or needs any of that raises ValueError.
+        """
         self.name = _table_name(inlet_name)
-        self.connection = sqlite3.connect(db_name)
+        self.summary = f"{self.name}_summary"
+        self.catalog = f"{self.name}_catalog"
+        self.rows = f"{self.name}_rows"
+        self.positions = f"{self.name}_positions"
+        self.cube = f"{self.name}_cube"
+        self.read_only = read_only
+        if read_only:
+            if clear:
+                raise ValueError(f"Cannot clear {self.name} when opened read only")
+            if not db_name.startswith("file:") and not os.path.isfile(db_name):
+                raise ValueError(f"There is no database {db_name}")
+            self.connection = sqlite3.connect(_read_only_uri(db_name), uri=True)
+        else:
+            # "file:" names are URIs, as used for shared in-memory databases
+            self.connection = sqlite3.connect(db_name, uri=db_name.startswith("file:"))
         self.connection.row_factory = sqlite3.Row
+        if read_only:
+            self.__check_layout(db_name)
+        else:
+            # see GENERATIONS
+            self.__ensure_generation_table()
+            self.__ensure_zones_table()
+            self.__ensure_cube_table()
+        self.generation = self.__get_generation()
+        self.zones = self.__get_zones()
         if clear:
             self.__clear_data_table()
-        self.__ensure_data_table()
+        self.identity = self.__get_identity()
+        # the encoding is chosen when the table is made, and kept after that
+        if self.__has_data_table():
+            compact = self.__has_table(self.name, "view")
+        self.compact = compact
+        # the table holding the rows, which is behind a view when compact
+        self.storage = self.rows if compact else self.name
+        # inserts into the view are upserted by its trigger instead
+        self.upsert = "" if compact else UPSERT
+        if not read_only:
+            self.__ensure_tables()
+        self.keyed = self.__has_table(f"{self.name}_key", "index")
 
     def __del__(self):
-        self.connection.close()
+        # there is no connection when opening failed
+        if hasattr(self, "connection"):
+            self.connection.close()
 
     def clear(self):
         self.__clear_data_table()
+        self.identity = self.__get_identity()
+        self.__ensure_tables()
+        self.keyed = True
+
+    def add_key(self) -> int:
+        """Remove duplicate rows and add the unique key rows are upserted on.
+
+        Tables written before the key existed can hold duplicates, and are
+        read as they are until this is run, by dbtool compact. Returns the
+        number of rows removed.
+        """
+        if self.keyed:
+            return 0
+        removed = self.remove_duplicates()
+        self.__create_key()
+        self.keyed = True
+        return removed
+
+    def flush(self):
+        # every write is committed as it is made
+        pass
+
+    def set_depth_zones(self, boundaries: Sequence[float]):
+        """Tag every row with its zone between the depth `boundaries`.
+
+        Depth ranges whose ends are all boundaries are then looked up by zone
+        on an index, instead of by scanning depths. The boundaries are kept
+        in the database, and rows are only tagged again when they change.
+        The buckets of the cube are ranges between the old boundaries, so it
+        is dropped when they change, until build_cube is run again. A read
+        only inlet keeps the zones it has, which select the same rows, only
+        without the index for ranges between other boundaries.
+        """
+        boundaries = sorted(set(float(boundary) for boundary in boundaries))
+        if boundaries == self.zones or self.read_only:
+            return
+        with self.connection:
+            self.connection.execute(
+                f"""delete from {ZONES} where name=:name""", {"name": self.name}
+            )
+            self.connection.executemany(
+                f"""insert into {ZONES} values (:name, :boundary)""",
+                ({"name": self.name, "boundary": boundary} for boundary in boundaries),
+            )
+            # the zone is not part of any result, so the generation stays
+            self.connection.execute(
+                f"""
+                update {self.storage}
+                set zone={_zone(self.__decoded("depth"), boundaries)}"""
+            )
+            self.connection.execute(f"""delete from {self.cube}""")
+            for table in (CUBES, CUBE_BUCKETS):
+                self.connection.execute(
+                    f"""delete from {table} where name=:name""", {"name": self.name}
+                )
+        self.zones = boundaries
+
+    def merge_from(self, db_name: str, base: Optional[str] = None):
+        """Copy this inlet's rows from another database file into this one.
+
+        Rows already here with the same key are replaced by the copied ones.
+        With `base`, only rows which are not in the database `base` exactly as
+        they are in `db_name` get copied, which makes a delta between the two.
+        """
+        self.__check_keyed()
+        with self.__attached(db_name, "other") as has_table:
+            if not has_table:
+                return
+            if base is None:
+                # the cube stays current when the other one can be added to it
+                fold = self.__can_fold_cube()
+                self.__insert_from_other("")
+                if fold:
+                    self.__fold_cube()
+                return
+            with self.__attached(base, "base") as base_has_table:
+                self.__insert_from_other(
+                    f"""
+                    and not exists (
+                        select 1 from base.{self.name} as b
+                        where {_same_key("b", "o")} and {_same_values("b", "o")}
+                    )"""
+                    if base_has_table
+                    else ""
+                )
+
+    def get_depth_collisions(self) -> List[Tuple[str, str, str, str]]:
+        """Rows that the compact encoding would merge into one, by their depths.
+
+        Depths are kept to 1/DEPTH_SCALE m there, so rows with the same kind,
+        source and time and depths closer than that have the same key. Gives
+        the kind, source, time and the depths of each such group of rows.
+        """
+        cursor = self.connection.execute(_depth_collisions(self.name))
+        return [tuple(row) for row in cursor]
+
+    def remove_duplicates(self) -> int:
+        """Delete all but the last inserted of any rows sharing a key.
+
+        Returns the number of rows deleted.
+        """
+        with self.connection:
+            cursor = self.connection.execute(
+                f"""
+                delete from {self.storage}
+                where rowid not in (
+                    select max(rowid) from {self.storage} group by {KEY_COLUMNS}
+                )"""
+            )
+            if cursor.rowcount > 0:
+                self.__bump_generation()
+                self.connection.execute(
+                    f"""
+                    update {self.catalog}
+                    set samples=(
+                        select sum(count) from {self.summary}
+                        where source={self.catalog}.source
+                    )"""
+                )
+        return cursor.rowcount
+
+    def has_data(self, kind: str) -> bool:
+        cursor = self.connection.execute(
+            f"""select exists(select 1 from {self.summary} where kind=:kind)""",
+            {"kind": kind},
+        )
+        return cursor.fetchone()[0] > 0
+
+    def get_sources(self, by_month: bool = False, before=None) -> Dict[int, Set[str]]:
+        """Sources with data of any kind, keyed by year (or by month).
+
+        Answered from the summary table, which holds one row per source per
+        kind per month, instead of scanning the observations. A source only
+        counts in the periods it has data in, not in every period between
+        its first and last samples as in the catalog.
+        """
+        period = "month" if by_month else "year"
+        clause, params = "", {}
+        if before is not None:
+            clause, params = "where year<:before", {"before": before.year}
+        cursor = self.connection.execute(
+            f"""select distinct {period} as period, source
+            from {self.summary}
+            {clause}
+            """,
+            params,
+        )
+        sources = {}
+        for row in cursor:
+            sources.setdefault(row["period"], set()).add(row["source"])
+        return sources
+
+    def get_catalog(self, before=None) -> List[CatalogEntry]:
+        """One entry per source, for sources starting before the year of `before`."""
+        clause, params = "", {}
+        if before is not None:
+            clause, params = "where start_time<:before", {"before": f"{before.year:04}"}
+        cursor = self.connection.execute(
+            f"""select * from {self.catalog}
+            {clause}
+            order by start_time
+            """,
+            params,
+        )
+        return [
+            CatalogEntry(
+                source=row["source"],
+                instrument=row["instrument"],
+                latitude=row["latitude"],
+                longitude=row["longitude"],
+                start_time=datetime.datetime.fromisoformat(row["start_time"]),
+                end_time=datetime.datetime.fromisoformat(row["end_time"]),
+                min_depth=row["min_depth"],
+                max_depth=row["max_depth"],
+                samples=row["samples"],
+            )
+            for row in cursor
+        ]
+
+    def get_source_counts(self, before=None) -> Dict[Tuple[int, int], int]:
+        """Number of distinct sources with data of any kind per (year, month)."""
+        clause, params = "", {}
+        if before is not None:
+            clause, params = "where year<:before", {"before": before.year}
+        cursor = self.connection.execute(
+            f"""select year, month, count(distinct source) as sources
+            from {self.summary}
+            {clause}
+            group by year, month
+            """,
+            params,
+        )
+        return {(row["year"], row["month"]): row["sources"] for row in cursor}
+
+    def get_columns(
+        self,
+        kind: str,
+        bucket: Tuple[float, float],
+        columns: Sequence[str] = DEFAULT_COLUMNS,
+        average: bool = False,
+        before=None,
+        exclude_qualities: Sequence[int] = (),
+        value_bounds: Optional[Tuple[float, float]] = None,
+    ) -> Dict[str, numpy.ndarray]:
+        """Read `kind` data inside `bucket` as one numpy array per column.
+
+        Rows are decoded straight from the cursor into typed arrays, so large
+        buckets never exist as a list of InletData objects. With `average`,
+        each row is the daily mean of one source, computed by SQLite.
+        `before` drops data from its year onward, and rows with a quality
+        flag in `exclude_qualities` are skipped before any averaging.
+        `value_bounds` keeps rows strictly between its two values.
+        """
+        clause, params = self.__filter_clause(
+            bucket, before, exclude_qualities, value_bounds
+        )
+        return self.__get_columns(kind, clause, params, columns, average)
+
+    def get_batch(
+        self,
+        kind: str,
+        bucket: Tuple[float, float],
+        before=None,
+        exclude_qualities: Sequence[int] = (),
+    ) -> InletDataBatch:
+        """Read `kind` data inside `bucket` as an InletDataBatch."""
+        return InletDataBatch.from_columns(
+            self.get_columns(
+                kind,
+                bucket,
+                columns=BATCH_FIELDS + ("source",),
+                before=before,
+                exclude_qualities=exclude_qualities,
+            )
+        )
+
+    def iter_data(
+        self, kind: str, bucket: Tuple[float, float], batch_size: int = BATCH_SIZE
+    ) -> Iterator[List[InletData]]:
+        """Like get_*_data, but yields the rows in lists of up to `batch_size`.
+
+        Rows are fetched from the cursor one batch at a time, so memory use
+        does not grow with the size of the inlet.
+        """
+        clause, params = self.__filter_clause(bucket)
+        cursor = self.connection.execute(
+            f"""select * from {self.name}
+            where kind=:kind{clause}
+            """,
+            {"kind": kind, **params},
+        )
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if len(rows) == 0:
+                break
+            yield [_row_to_data(row) for row in rows]
+
+    def iter_batches(
+        self,
+        kind: str,
+        bucket: Tuple[float, float],
+        batch_size: int = BATCH_SIZE,
+        before=None,
+        exclude_qualities: Sequence[int] = (),
+    ) -> Iterator[InletDataBatch]:
+        """Like get_batch, but yields InletDataBatches of up to `batch_size` rows."""
+        columns = BATCH_FIELDS + ("source",)
+        selected = ", ".join(TIME if column == "time" else column for column in columns)
+        clause, params = self.__filter_clause(bucket, before, exclude_qualities)
+        cursor = self.connection.cursor()
+        cursor.row_factory = None
+        cursor.execute(
+            f"""select {selected} from {self.name}
+            where kind=:kind{clause}
+            """,
+            {"kind": kind, **params},
+        )
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if len(rows) == 0:
+                break
+            yield InletDataBatch.from_columns(_read_columns(rows, columns))
+
+    def get_monthly_means(
+        self,
+        kind: str,
+        bucket: Tuple[float, float],
+        before=None,
+        exclude_qualities: Sequence[int] = (),
+        value_bounds: Optional[Tuple[float, float]] = None,
+    ) -> Dict[str, numpy.ndarray]:
+        """Monthly means of the daily per-source means of `kind` data.
+
+        This is the whole averaging method from METHOD.md in one query, so
+        only one row per month leaves the database. Filters are the same as
+        for get_columns, except that `value_bounds` applies to the monthly
+        means rather than to individual rows.
+        """
+        clause, params = self.__filter_clause(bucket, before, exclude_qualities)
+        having = ""
+        if value_bounds is not None:
+            having = "having avg(value)>:lower and avg(value)<:upper"
+            params["lower"], params["upper"] = value_bounds
+        cursor = self.connection.cursor()
+        cursor.row_factory = None
+        cursor.execute(
+            f"""select month, avg(value) from (
+                select substr(time, 1, 7) as month, avg(value) as value
+                from {self.name}
+                where kind=:kind{clause}
+                group by source, {DAY}
+            )
+            group by month
+            {having}
+            order by month
+            """,
+            {"kind": kind, **params},
+        )
+        rows = numpy.fromiter(
+            cursor, dtype=numpy.dtype([("time", "U7"), ("value", float)])
+        )
+        return {
+            "time": rows["time"].astype("datetime64[M]").astype("datetime64[D]"),
+            "value": numpy.ascontiguousarray(rows["value"]),
+        }
+
+    def build_cube(
+        self,
+        buckets: Dict[str, Tuple[float, float]],
+        exclude_qualities: Sequence[int] = (),
+    ):
+        """Store the count, mean and M2 of the means at each resolution.
+
+        For every kind and each named depth bucket in `buckets`, a "day"
+        cell holds the daily per-source means, and a month's cell holds those
+        of all its days, so its mean is as get_monthly_means gives it. A
+        "year" cell holds monthly means and a "decade" cell annual means,
+        keeping the averaging method of METHOD.md at each step. M2 is the sum
+        of squared differences from the mean, so the standard deviation of
+        every cell is there as well. The cube is only used while the table is
+        unchanged since it was built, or since rows were folded into it: the
+        data of sources new to a kind as add_*_data stores them, or the cube
+        of another database by merge_from. Nothing is done when the cube is
+        current for the same buckets.
+        """
+        definitions = {
+            bucket: _bucket_definition(bounds, exclude_qualities)
+            for bucket, bounds in buckets.items()
+        }
+        if self.__has_current_cube() and self.__cube_buckets() == definitions:
+            return
+        with self.connection:
+            self.connection.execute(f"""delete from {self.cube}""")
+            self.connection.execute(
+                f"""delete from {CUBE_BUCKETS} where name=:name""", {"name": self.name}
+            )
+            self.connection.executemany(
+                f"""
+                insert into {CUBE_BUCKETS}
+                values (:name, :bucket, :min_depth, :max_depth, :excluded)""",
+                (
+                    {
+                        "name": self.name,
+                        "bucket": bucket,
+                        "min_depth": min_depth,
+                        "max_depth": max_depth,
+                        "excluded": excluded,
+                    }
+                    for bucket, (min_depth, max_depth, excluded) in definitions.items()
+                ),
+            )
+            for kind in ("temperature", "salinity", "oxygen"):
+                for bucket, definition in definitions.items():
+                    query, params = self.__day_cells(kind, bucket, definition)
+                    self.connection.execute(f"""insert into {self.cube} {query}""", params)
+            self.__roll_up_cube()
+
+    def get_cube(
+        self,
+        kind: str,
+        bucket: str,
+        bounds: Tuple[float, float],
+        resolution: str,
+        before=None,
+        exclude_qualities: Sequence[int] = (),
+    ) -> Optional[Dict[str, numpy.ndarray]]:
+        """Cells of the cube for one kind and bucket, in time order.
+
+        "time" is the start of each period, with "count", "mean" and "m2" as
+        stored by build_cube. Periods from the year of `before` on are left
+        out, and a decade which that cuts short is averaged from its years.
+        None when there is no cube for the current data, or when `bucket` was
+        built with other depth `bounds` or `exclude_qualities`.
+        """
+        if resolution not in RESOLUTIONS:
+            raise ValueError(
+                f"Unknown resolution {resolution}, expected one of {RESOLUTIONS}"
+            )
+        if not self.__has_current_cube():
+            return None
+        definition = self.__cube_buckets().get(bucket)
+        if definition != _bucket_definition(bounds, exclude_qualities):
+            return None
+        params = {"kind": kind, "bucket": bucket, "resolution": resolution}
+        query = f"""select period, count, mean, m2
+            from {self.cube}
+            where kind=:kind and bucket=:bucket and resolution=:resolution"""
+        if before is not None:
+            params["before"] = f"{before.year:04}"
+            if resolution == "decade":
+                cells = _cells_of_means(
+                    self.cube,
+                    "decade",
+                    """kind=:kind and bucket=:bucket and resolution='year'
+                        and period<:before""",
+                )
+                query = f"""select period, count, mean, m2 from ({cells})"""
+            else:
+                query += " and period<:before"
+        cursor = self.connection.cursor()
+        cursor.row_factory = None
+        cursor.execute(f"{query} order by 1", params)
+        rows = numpy.fromiter(
+            cursor,
+            dtype=numpy.dtype(
+                [("time", "U10"), ("count", int), ("mean", float), ("m2", float)]
+            ),
+        )
+        return {
+            "time": rows["time"].astype("datetime64[D]"),
+            **{
+                column: numpy.ascontiguousarray(rows[column])
+                for column in ("count", "mean", "m2")
+            },
+        }
 
     def add_temperature_value(self, value: InletData):
         try:
@@ -91,11 +1031,10 @@ class InletDb:
     def get_temperature_data(
         self, bucket: Tuple[float, float], average: bool = False
     ) -> List[InletData]:
-        data = self.__get_data("temperature", bucket)
         if average:
-            return _averaged(data)
+            return self.__get_daily_averages("temperature", bucket)
         else:
-            return data
+            return self.__get_data("temperature", bucket)
 
     def add_salinity_value(self, value: InletData):
         try:
@@ -117,11 +1056,10 @@ class InletDb:
     def get_salinity_data(
         self, bucket: Tuple[float, float], average: bool = False
     ) -> List[InletData]:
-        data = self.__get_data("salinity", bucket)
         if average:
-            return _averaged(data)
+            return self.__get_daily_averages("salinity", bucket)
         else:
-            return data
+            return self.__get_data("salinity", bucket)
 
     def add_oxygen_value(self, value: InletData):
         try:
@@ -143,13 +1081,13 @@ class InletDb:
     def get_oxygen_data(
         self, bucket: Tuple[float, float], average: bool = False
     ) -> List[InletData]:
-        data = self.__get_data("oxygen", bucket)
         if average:
-            return _averaged(data)
+            return self.__get_daily_averages("oxygen", bucket)
         else:
-            return data
+            return self.__get_data("oxygen", bucket)
 
     def __add_value(self, value: InletData, kind: str):
+        self.__check_keyed()
         with self.connection:
             self.connection.execute(
                 f"""
@@ -164,13 +1102,20 @@ class InletDb:
                     :value,
                     :quality,
                     :computed,
-                    :assumed_density
-                )""",
+                    :assumed_density,
+                    {_zone(":depth", self.zones)}
+                )
+                {self.upsert}""",
                 {"kind": kind, **value.as_dict()},
             )
+            self.__bump_generation()
+            self.__add_to_catalog([value])
 
     def __add_data(self, data: List[InletData], kind: str):
+        self.__check_keyed()
+        sources = sorted(set(datum.source for datum in data))
         with self.connection:
+            fold = self.__can_fold_sources(kind, sources)
             self.connection.executemany(
                 f"""
                 insert into {self.name}
@@ -184,58 +1129,136 @@ class InletDb:
                     :value,
                     :quality,
                     :computed,
-                    :assumed_density
-                )""",
+                    :assumed_density,
+                    {_zone(":depth", self.zones)}
+                )
+                {self.upsert}""",
                 ({"kind": kind, **datum.as_dict()} for datum in data),
             )
+            self.__bump_generation()
+            self.__add_to_catalog(data)
+            if fold:
+                self.__fold_sources(kind, sources)
 
-    def __get_data(self, kind: str, bucket: Tuple[float, float]) -> List[InletData]:
+    def __filter_clause(
+        self,
+        bucket: Tuple[float, float],
+        before=None,
+        exclude_qualities: Sequence[int] = (),
+        value_bounds: Optional[Tuple[float, float]] = None,
+    ) -> Tuple[str, Dict]:
         min_depth, max_depth = bucket
-        if min_depth is None and max_depth is None:
-            cursor = self.connection.execute(
-                f"""select * from {self.name}
-                where kind=:kind
-                """,
-                {"kind": kind},
-            )
-        elif min_depth is None:
-            cursor = self.connection.execute(
-                f"""select * from {self.name}
-                where kind=:kind and depth<=:max
-                """,
-                {"kind": kind, "max": max_depth},
-            )
-        elif max_depth is None:
-            cursor = self.connection.execute(
-                f"""select * from {self.name}
-                where kind=:kind and depth>=:min
-                """,
-                {"kind": kind, "min": min_depth},
-            )
+        clauses, params = [], {}
+        zones = self.__bucket_zones(bucket)
+        if zones is not None:
+            if len(zones) < 2 * len(self.zones) + 1:
+                clauses.append(f"zone in ({', '.join(str(zone) for zone in zones)})")
         else:
-            cursor = self.connection.execute(
-                f"""select * from {self.name}
-                where kind=:kind and depth>=:min and depth<=:max
-                """,
-                {"kind": kind, "min": min_depth, "max": max_depth},
-            )
+            if min_depth is not None:
+                clauses.append("depth>=:min")
+                params["min"] = min_depth
+            if max_depth is not None:
+                clauses.append("depth<=:max")
+                params["max"] = max_depth
+        if before is not None:
+            # ISO times sort as text, so this keeps years before before.year
+            clauses.append("time<:before")
+            params["before"] = f"{before.year:04}-01-01"
+        if len(exclude_qualities) > 0:
+            names = [f":quality{i}" for i in range(len(exclude_qualities))]
+            clauses.append(f"quality not in ({', '.join(names)})")
+            params.update(zip((name[1:] for name in names), exclude_qualities))
+        if value_bounds is not None:
+            clauses.append("value>:lower and value<:upper")
+            params["lower"], params["upper"] = value_bounds
+        return "".join(f" and {clause}" for clause in clauses), params
+
+    def __bucket_zones(self, bucket: Tuple[float, float]) -> Optional[List[int]]:
+        # None unless both ends of the bucket are open or on a boundary
+        min_depth, max_depth = bucket
+        if any(
+            depth is not None and float(depth) not in self.zones for depth in bucket
+        ):
+            return None
+        first = 0 if min_depth is None else 2 * self.zones.index(min_depth) + 1
+        last = (
+            2 * len(self.zones)
+            if max_depth is None
+            else 2 * self.zones.index(max_depth) + 1
+        )
+        return list(range(first, last + 1))
+
+    def __get_data(self, kind: str, bucket: Tuple[float, float]) -> List[InletData]:
+        return [datum for data in self.iter_data(kind, bucket) for datum in data]
+
+    def __get_daily_averages(
+        self, kind: str, bucket: Tuple[float, float]
+    ) -> List[InletData]:
+        """Perform daily vertical averaging inside depth categories."""
+        clause, params = self.__filter_clause(bucket)
+        cursor = self.connection.execute(
+            f"""select source, {DAY} as date, avg(value) as value
+            from {self.name}
+            where kind=:kind{clause}
+            group by source, date
+            """,
+            {"kind": kind, **params},
+        )
         return [
             InletData(
-                source=row["source"],
-                latitude=row["latitude"],
-                longitude=row["longitude"],
-                time=datetime.datetime.fromisoformat(row["time"]),
-                depth=row["depth"],
-                value=row["value"],
-                quality=row["quality"],
-                computed=(row["computed"] > 0),
-                assumed_density=(row["assumed_density"] > 0),
+                datetime.date.fromisoformat(row["date"]),
+                0,
+                row["value"],
+                0,
+                0,
+                0,
+                row["source"],
             )
             for row in cursor
         ]
 
+    def __get_columns(
+        self,
+        kind: str,
+        clause: str,
+        params: Dict,
+        columns: Sequence[str],
+        average: bool = False,
+    ) -> Dict[str, numpy.ndarray]:
+        if average:
+            # daily means per source only keep their date, value and source,
+            # the same as the rows returned by get_*_data(average=True)
+            selected = ", ".join(
+                DAY
+                if column == "time"
+                else "avg(value)"
+                if column == "value"
+                else column
+                if column == "source"
+                else "0"
+                for column in columns
+            )
+            grouping = f"group by source, {DAY}"
+        else:
+            selected = ", ".join(
+                TIME if column == "time" else column for column in columns
+            )
+            grouping = ""
+        cursor = self.connection.cursor()
+        cursor.row_factory = None
+        cursor.execute(
+            f"""select {selected} from {self.name}
+            where kind=:kind{clause}
+            {grouping}
+            """,
+            {"kind": kind, **params},
+        )
+        return _read_columns(cursor.fetchall(), columns)
+
     def __ensure_data_table(self):
-        if not self.__has_data_table():
+        if self.compact:
+            self.__ensure_compact_table()
+        elif not self.__has_data_table():
             with self.connection:
                 self.connection.execute(
                     f"""
@@ -249,21 +1272,906 @@ class InletDb:
                         value real not null,
                         quality integer not null,
                         computed integer not null,
-                        assumed_density integer not null
+                        assumed_density integer not null,
+                        zone integer
+                    )"""
+                )
+        elif not self.__has_column("zone"):
+            # tables written before zones existed
+            with self.connection:
+                self.connection.execute(
+                    f"""alter table {self.name} add column zone integer"""
+                )
+                self.connection.execute(
+                    f"""update {self.name} set zone={_zone("depth", self.zones)}"""
+                )
+        with self.connection:
+            self.connection.execute(
+                f"""
+                create index if not exists {self.name}_zone
+                on {self.storage} (kind, zone)"""
+            )
+
+    def __ensure_compact_table(self):
+        """Make the tables of the compact encoding, behind a view of the usual columns.
+
+        Positions are only kept once per source, from its first row, and the
+        two flags are packed into one integer.
+        """
+        if self.__has_data_table():
+            return
+        with self.connection:
+            self.connection.execute(
+                f"""
+                create table {self.rows} (
+                    kind text not null,
+                    source text not null,
+                    time text not null,
+                    depth integer not null,
+                    value integer not null,
+                    quality integer not null,
+                    flags integer not null,
+                    zone integer
+                )"""
+            )
+            self.connection.execute(
+                f"""
+                create table {self.positions} (
+                    source text primary key,
+                    latitude real not null,
+                    longitude real not null
+                )"""
+            )
+            # a left join to a unique key is left out of queries which do not
+            # use the positions
+            self.connection.execute(
+                f"""
+                create view {self.name} as
+                select
+                    r.kind as kind,
+                    r.source as source,
+                    p.latitude as latitude,
+                    p.longitude as longitude,
+                    r.time as time,
+                    r.depth / {DEPTH_SCALE}.0 as depth,
+                    r.value / {VALUE_SCALE}.0 as value,
+                    r.quality as quality,
+                    r.flags & 1 as computed,
+                    (r.flags >> 1) & 1 as assumed_density,
+                    r.zone as zone
+                from {self.rows} as r
+                left join {self.positions} as p on p.source=r.source"""
+            )
+            self.connection.execute(
+                f"""
+                create trigger {self.name}_encode
+                instead of insert on {self.name}
+                begin
+                    insert into {self.positions}
+                    values (new.source, new.latitude, new.longitude)
+                    on conflict (source) do nothing;
+                    insert into {self.rows}
+                    values (
+                        new.kind,
+                        new.source,
+                        new.time,
+                        cast(round(new.depth * {DEPTH_SCALE}) as integer),
+                        cast(round(new.value * {VALUE_SCALE}) as integer),
+                        new.quality,
+                        (new.computed > 0) | ((new.assumed_density > 0) << 1),
+                        new.zone
+                    )
+                    on conflict ({KEY_COLUMNS}) do update set
+                        value=excluded.value,
+                        quality=excluded.quality,
+                        flags=excluded.flags;
+                end"""
+            )
+
+    def __ensure_summary_table(self):
+        # kept up to date by triggers, so every way of writing rows counts
+        if not self.__has_table(self.summary):
+            with self.connection:
+                self.connection.execute(
+                    f"""
+                    create table {self.summary} (
+                        kind text not null,
+                        year integer not null,
+                        month integer not null,
+                        source text not null,
+                        count integer not null,
+                        primary key (kind, year, month, source)
+                    ) without rowid"""
+                )
+                # fill in the summary for databases written before it existed
+                self.connection.execute(
+                    f"""
+                    insert into {self.summary}
+                    select kind, {YEAR}, {MONTH}, source, count(*)
+                    from {self.name}
+                    group by kind, {YEAR}, {MONTH}, source"""
+                )
+        with self.connection:
+            self.connection.execute(
+                f"""
+                create trigger if not exists {self.name}_summary_insert
+                after insert on {self.storage}
+                begin
+                    insert into {self.summary}
+                    values (
+                        new.kind,
+                        {_new(YEAR)},
+                        {_new(MONTH)},
+                        new.source,
+                        1
+                    )
+                    on conflict (kind, year, month, source)
+                    do update set count=count + 1;
+                end"""
+            )
+            self.connection.execute(
+                f"""
+                create trigger if not exists {self.name}_summary_delete
+                after delete on {self.storage}
+                begin
+                    update {self.summary}
+                    set count=count - 1
+                    where kind=old.kind
+                        and year={_old(YEAR)}
+                        and month={_old(MONTH)}
+                        and source=old.source;
+                    delete from {self.summary} where count<=0;
+                end"""
+            )
+
+    @contextmanager
+    def __attached(self, db_name: str, schema: str):
+        """Attach `db_name` as `schema`, giving whether it has this inlet's table."""
+        self.connection.execute(
+            f"attach database :path as {schema}", {"path": db_name}
+        )
+        try:
+            cursor = self.connection.execute(
+                f"""
+                select count(name)
+                from {schema}.sqlite_master
+                where type in ('table', 'view') and name=:name
+                """,
+                {"name": self.name},
+            )
+            yield cursor.fetchone()[0] > 0
+        finally:
+            self.connection.execute(f"detach database {schema}")
+
+    def __insert_from_other(self, condition: str):
+        # the other database may have no zones, or different ones
+        columns = ", ".join(f"o.{column}" for column in DATA_COLUMNS)
+        if self.compact:
+            cursor = self.connection.execute(
+                f"""{_depth_collisions(f"other.{self.name}", condition)} limit 1"""
+            )
+            row = cursor.fetchone()
+            if row is not None:
+                raise ValueError(
+                    f"{row['kind']} of {self.name} from {row['source']} at "
+                    f"{row['time']} has depths {row['depths']}, which would be "
+                    f"merged into one row when kept to 1/{DEPTH_SCALE} m"
+                )
+        with self.connection:
+            # rows written by the trigger of a compact table are not counted
+            # in the cursor's rowcount
+            changes = self.connection.total_changes
+            # "where true" keeps the upsert from being parsed as a join
+            self.connection.execute(
+                f"""
+                insert into {self.name}
+                select {columns}, {_zone("o.depth", self.zones)}
+                from other.{self.name} as o
+                where true {condition}
+                {self.upsert}"""
+            )
+            if self.connection.total_changes > changes:
+                self.__bump_generation()
+                self.__fill_catalog(f"other.{self.name}", condition)
+
+    def __ensure_tables(self):
+        # only a table made here gets the key, see add_key
+        created = not self.__has_data_table()
+        self.__ensure_data_table()
+        self.__ensure_summary_table()
+        self.__ensure_catalog_table()
+        if created:
+            self.__create_key()
+
+    def __create_key(self):
+        with self.connection:
+            self.connection.execute(
+                f"""
+                create unique index {self.name}_key
+                on {self.storage} ({KEY_COLUMNS})"""
+            )
+
+    def __check_keyed(self):
+        # rows are upserted on the key, so writes need it
+        if not self.keyed:
+            raise ValueError(
+                f"{self.name} was written before rows had a unique key and may "
+                "hold duplicates, so run dbtool compact on it before writing to it"
+            )
+
+    def __check_layout(self, db_name: str):
+        # a read only inlet cannot be brought up to date, see __init__
+        if not self.__has_data_table():
+            raise ValueError(f"There is no inlet {self.name} in {db_name}")
+        compact = self.__has_table(self.name, "view")
+        missing = [
+            table
+            for table in (
+                GENERATIONS,
+                IDENTITIES,
+                ZONES,
+                CUBES,
+                CUBE_BUCKETS,
+                self.summary,
+                self.catalog,
+                self.cube,
+            )
+            if not self.__has_table(table)
+        ]
+        if len(missing) == 0:
+            cursor = self.connection.execute(
+                f"""select 1 from {IDENTITIES} where name=:name""", {"name": self.name}
+            )
+            if cursor.fetchone() is None:
+                missing.append(f"the identity of {self.name}")
+            if not self.__has_column("m2", self.cube):
+                missing.append(f"the m2 column of {self.cube}")
+            if not self.__has_column("zone", self.rows if compact else self.name):
+                missing.append(f"the zone column of {self.name}")
+        if len(missing) > 0:
+            raise ValueError(
+                f"{self.name} in {db_name} was written by an older version, without "
+                f"{', '.join(missing)}; open it for writing once to add them"
+            )
+
+    def __ensure_generation_table(self):
+        with self.connection:
+            self.connection.execute(
+                f"""
+                create table if not exists {GENERATIONS} (
+                    name text primary key,
+                    generation integer not null
+                )"""
+            )
+            self.connection.execute(
+                f"""
+                create table if not exists {IDENTITIES} (
+                    name text primary key,
+                    identity text not null
+                )"""
+            )
+
+    def __ensure_cube_table(self):
+        if self.__has_table(self.cube) and not self.__has_column("m2", self.cube):
+            # cubes of sums are built again in the current layout
+            with self.connection:
+                self.connection.execute(f"""drop table {self.cube}""")
+                self.connection.execute(
+                    f"""delete from {CUBES} where name=:name""", {"name": self.name}
+                )
+        with self.connection:
+            self.connection.execute(
+                f"""
+                create table if not exists {CUBES} (
+                    name text primary key,
+                    generation integer not null
+                )"""
+            )
+            self.connection.execute(
+                f"""
+                create table if not exists {CUBE_BUCKETS} (
+                    name text not null,
+                    bucket text not null,
+                    min_depth real,
+                    max_depth real,
+                    exclude_qualities text not null,
+                    primary key (name, bucket)
+                )"""
+            )
+            self.connection.execute(
+                f"""
+                create table if not exists {self.cube} (
+                    kind text not null,
+                    bucket text not null,
+                    resolution text not null,
+                    period text not null,
+                    count integer not null,
+                    mean real not null,
+                    m2 real not null,
+                    primary key (kind, bucket, resolution, period)
+                ) without rowid"""
+            )
+
+    def __has_current_cube(self) -> bool:
+        cursor = self.connection.execute(
+            f"""select generation from {CUBES} where name=:name""", {"name": self.name}
+        )
+        row = cursor.fetchone()
+        return row is not None and row[0] == self.generation
+
+    def __cube_buckets(self, schema: str = "main") -> Dict[str, Tuple]:
+        # the definition of each bucket the cube was built for
+        cursor = self.connection.execute(
+            f"""
+            select bucket, min_depth, max_depth, exclude_qualities
+            from {schema}.{CUBE_BUCKETS}
+            where name=:name""",
+            {"name": self.name},
+        )
+        return {row[0]: tuple(row[1:]) for row in cursor}
+
+    def __day_cells(
+        self, kind: str, bucket: str, definition: Tuple, sources: Sequence[str] = ()
+    ) -> Tuple[str, Dict]:
+        """SQL for the day cells of one kind and bucket, with its parameters.
+
+        Only the rows of `sources` are included, when there are any.
+        """
+        min_depth, max_depth, excluded = definition
+        clause, params = self.__filter_clause(
+            (min_depth, max_depth),
+            exclude_qualities=[int(quality) for quality in excluded.split(",") if quality],
+        )
+        if len(sources) > 0:
+            names = [f":source{i}" for i in range(len(sources))]
+            clause += f" and source in ({', '.join(names)})"
+            params.update(zip((name[1:] for name in names), sources))
+        # differences are taken from each day's mean, rather than from sums of
+        # squares, which lose precision
+        query = f"""
+            select
+                :kind as kind,
+                :bucket as bucket,
+                'day' as resolution,
+                day as period,
+                count(value) as count,
+                avg(value) as mean,
+                sum((value - merged) * (value - merged)) as m2
+            from (
+                select day, value, avg(value) over (partition by day) as merged
+                from (
+                    select {DAY} as day, avg(value) as value
+                    from {self.name}
+                    where kind=:kind{clause}
+                    group by source, {DAY}
+                )
+            )
+            group by day"""
+        return query, {"kind": kind, "bucket": bucket, **params}
+
+    def __merge_day_cells(self, cells: str):
+        # add the day cells selected by `cells` to those of the cube, by
+        # Chan's formula, which is exact for disjoint sources
+        self.connection.execute(
+            f"""
+            insert into {self.cube}
+            select kind, bucket, resolution, period, count, mean, m2
+            from ({cells})
+            where true
+            on conflict (kind, bucket, resolution, period) do update set
+                count=count + excluded.count,
+                mean=mean
+                    + (excluded.mean - mean) * excluded.count
+                    / (count + excluded.count),
+                m2=m2 + excluded.m2
+                    + (excluded.mean - mean) * (excluded.mean - mean)
+                    * count * excluded.count / (count + excluded.count)"""
+        )
+
+    def __roll_up_cube(self, changed: Optional[str] = None):
+        """Build the cells of every resolution above days from the day cells.
+
+        With `changed`, SQL selecting the kind, bucket and period of the day
+        cells which changed, only the periods which contain them are built
+        again. The cube is then stamped as current.
+        """
+        for coarser, finer in (("month", "day"), ("year", "month"), ("decade", "year")):
+            condition = f"resolution='{finer}'"
+            if changed is None:
+                self.connection.execute(
+                    f"""delete from {self.cube} where resolution=:coarser""",
+                    {"coarser": coarser},
+                )
+            else:
+                period = PERIODS[coarser]
+                self.connection.execute(
+                    f"""
+                    delete from {self.cube}
+                    where resolution=:coarser and (kind, bucket, period) in (
+                        select kind, bucket, {period} from ({changed})
+                    )""",
+                    {"coarser": coarser},
+                )
+                condition += f"""
+                    and (kind, bucket, {period}) in (
+                        select kind, bucket, {period} from ({changed})
+                    )"""
+            cells = _merged_cells if coarser == "month" else _cells_of_means
+            self.connection.execute(
+                f"""insert into {self.cube} {cells(self.cube, coarser, condition)}"""
+            )
+        self.connection.execute(
+            f"""
+            insert into {CUBES} values (:name, :generation)
+            on conflict (name) do update set generation=excluded.generation""",
+            {"name": self.name, "generation": self.generation},
+        )
+
+    def __can_fold_sources(self, kind: str, sources: Sequence[str]) -> bool:
+        # rows of sources with no data of this kind yet add day cells of their
+        # own, so a current cube can take them without going back to the rest
+        if len(sources) == 0 or not self.__has_current_cube():
+            return False
+        if len(self.__cube_buckets()) == 0:
+            return False
+        names = [f":source{i}" for i in range(len(sources))]
+        cursor = self.connection.execute(
+            f"""
+            select 1 from {self.summary}
+            where kind=:kind and source in ({', '.join(names)})
+            limit 1""",
+            {"kind": kind, **{name[1:]: source for name, source in zip(names, sources)}},
+        )
+        return cursor.fetchone() is None
+
+    def __fold_sources(self, kind: str, sources: Sequence[str]):
+        # add the day cells of the rows just stored for `sources`, and build
+        # the periods above them again
+        new_cells = f"temp.{self.name}_new_cells"
+        self.connection.execute(
+            f"""
+            create temp table if not exists {self.name}_new_cells (
+                kind, bucket, resolution, period, count, mean, m2
+            )"""
+        )
+        self.connection.execute(f"""delete from {new_cells}""")
+        for bucket, definition in self.__cube_buckets().items():
+            query, params = self.__day_cells(kind, bucket, definition, sources)
+            self.connection.execute(f"""insert into {new_cells} {query}""", params)
+        self.__merge_day_cells(f"""select * from {new_cells}""")
+        self.__roll_up_cube(f"""select kind, bucket, period from {new_cells}""")
+
+    def __can_fold_cube(self) -> bool:
+        """Whether the cube of the attached "other" can be folded into this one.
+
+        The other cube has to be current, with the same depth zones and
+        bucket definitions as this one, which an inlet with no cube yet takes
+        from it. An inlet with no rows then takes the other cube as it is.
+        Otherwise this cube has to be current too, and the rows on each side
+        have to be from different sources, so that no per-source daily mean
+        is split between them.
+        """
+        cursor = self.connection.execute(
+            f"""
+            select count(name) from other.sqlite_master
+            where type='table'
+                and name in (:generations, :cubes, :buckets, :cube, :catalog)""",
+            {
+                "generations": GENERATIONS,
+                "cubes": CUBES,
+                "buckets": CUBE_BUCKETS,
+                "cube": self.cube,
+                "catalog": self.catalog,
+            },
+        )
+        if cursor.fetchone()[0] < 5:
+            return False
+        cursor = self.connection.execute(
+            f"""
+            select g.generation=c.generation
+            from other.{GENERATIONS} as g join other.{CUBES} as c using (name)
+            where name=:name""",
+            {"name": self.name},
+        )
+        row = cursor.fetchone()
+        if row is None or not row[0]:
+            return False
+        # values in the compact encoding are rounded, so cubes built from
+        # them differ slightly
+        cursor = self.connection.execute(
+            f"""select type from other.sqlite_master where name=:name""",
+            {"name": self.name},
+        )
+        if cursor.fetchone()[0] != ("view" if self.compact else "table"):
+            return False
+        cursor = self.connection.execute(
+            f"""
+            select boundary from other.{ZONES} where name=:name order by boundary""",
+            {"name": self.name},
+        )
+        if [row[0] for row in cursor] != self.zones:
+            return False
+        buckets = self.__cube_buckets("other")
+        if len(buckets) == 0 or self.__cube_buckets() not in ({}, buckets):
+            return False
+        cursor = self.connection.execute(f"""select 1 from {self.storage} limit 1""")
+        if cursor.fetchone() is None:
+            return True
+        if not self.__has_current_cube() or self.__cube_buckets() != buckets:
+            return False
+        cursor = self.connection.execute(
+            f"""
+            select 1 from other.{self.catalog} join {self.catalog} using (source)
+            limit 1"""
+        )
+        return cursor.fetchone() is None
+
+    def __fold_cube(self):
+        # merge the day cells of the attached "other" into these, and build
+        # the periods above them again
+        days = f"""select * from other.{self.cube} where resolution='day'"""
+        with self.connection:
+            self.connection.execute(
+                f"""
+                insert or replace into {CUBE_BUCKETS}
+                select * from other.{CUBE_BUCKETS} where name=:name""",
+                {"name": self.name},
+            )
+            self.__merge_day_cells(days)
+            self.__roll_up_cube(days)
+
+    def __ensure_zones_table(self):
+        with self.connection:
+            self.connection.execute(
+                f"""
+                create table if not exists {ZONES} (
+                    name text not null,
+                    boundary real not null,
+                    primary key (name, boundary)
+                )"""
+            )
+
+    def __get_zones(self) -> List[float]:
+        cursor = self.connection.execute(
+            f"""select boundary from {ZONES} where name=:name order by boundary""",
+            {"name": self.name},
+        )
+        return [row[0] for row in cursor]
+
+    def __get_generation(self) -> int:
+        cursor = self.connection.execute(
+            f"""select generation from {GENERATIONS} where name=:name""",
+            {"name": self.name},
+        )
+        row = cursor.fetchone()
+        return row[0] if row is not None else 0
+
+    def __get_identity(self) -> str:
+        # made the first time the inlet is opened, and after it is cleared
+        if not self.read_only:
+            with self.connection:
+                self.connection.execute(
+                    f"""
+                    insert into {IDENTITIES} values (:name, :identity)
+                    on conflict (name) do nothing""",
+                    {"name": self.name, "identity": uuid.uuid4().hex},
+                )
+        cursor = self.connection.execute(
+            f"""select identity from {IDENTITIES} where name=:name""",
+            {"name": self.name},
+        )
+        return cursor.fetchone()[0]
+
+    def __bump_generation(self):
+        # called inside the transaction of the write it counts
+        self.connection.execute(
+            f"""
+            insert into {GENERATIONS} values (:name, 1)
+            on conflict (name) do update set generation=generation + 1""",
+            {"name": self.name},
+        )
+        self.generation = self.__get_generation()
+
+    def __ensure_catalog_table(self):
+        # written once per source per batch, see __add_to_catalog, instead of
+        # by triggers on every row
+        if not self.__has_table(self.catalog):
+            with self.connection:
+                self.connection.execute(
+                    f"""
+                    create table {self.catalog} (
+                        source text primary key,
+                        instrument text not null,
+                        latitude real not null,
+                        longitude real not null,
+                        start_time text not null,
+                        end_time text not null,
+                        min_depth real not null,
+                        max_depth real not null,
+                        samples integer not null
                     )"""
                 )
+                self.connection.execute(
+                    f"""
+                    create index {self.catalog}_start
+                    on {self.catalog} (start_time)"""
+                )
+                self.__fill_catalog(self.name)
+        with self.connection:
+            # the triggers of databases written before
+            for trigger in ("insert", "delete"):
+                self.connection.execute(
+                    f"""drop trigger if exists {self.catalog}_{trigger}"""
+                )
+
+    def __fill_catalog(self, table: str, condition: str = ""):
+        # catalog entries for the sources of the rows `o` of `table`
+        self.connection.execute(
+            f"""
+            insert into {self.catalog}
+            select
+                o.source,
+                {_instrument("o.source")},
+                latitude,
+                longitude,
+                min({TIME}),
+                max({TIME}),
+                min(depth),
+                max(depth),
+                s.samples
+            from {table} as o
+            join (
+                select source, sum(count) as samples
+                from {self.summary}
+                group by source
+            ) as s on s.source=o.source
+            where true {condition}
+            group by o.source
+            {CATALOG_UPSERT}"""
+        )
+
+    def __add_to_catalog(self, data: List[InletData]):
+        # one catalog entry per source of the rows just written
+        entries = {}
+        for datum in data:
+            time = datum.time.isoformat(timespec="microseconds")[:26]
+            entry = entries.get(datum.source)
+            if entry is None:
+                entries[datum.source] = {
+                    "source": datum.source,
+                    "latitude": datum.latitude,
+                    "longitude": datum.longitude,
+                    "start_time": time,
+                    "end_time": time,
+                    "min_depth": datum.depth,
+                    "max_depth": datum.depth,
+                }
+                continue
+            entry["start_time"] = min(entry["start_time"], time)
+            entry["end_time"] = max(entry["end_time"], time)
+            entry["min_depth"] = min(entry["min_depth"], datum.depth)
+            entry["max_depth"] = max(entry["max_depth"], datum.depth)
+        self.connection.executemany(
+            f"""
+            insert into {self.catalog}
+            select
+                :source,
+                {_instrument(":source")},
+                :latitude,
+                :longitude,
+                :start_time,
+                :end_time,
+                :min_depth,
+                :max_depth,
+                sum(count)
+            from {self.summary}
+            where source=:source
+            {CATALOG_UPSERT}""",
+            entries.values(),
+        )
+
+    def __decoded(self, column: str) -> str:
+        # SQL for `column` of the storage table, which holds depths scaled
+        # when compact
+        if self.compact and column == "depth":
+            return f"depth / {DEPTH_SCALE}.0"
+        return column
 
     def __clear_data_table(self):
         if self.__has_data_table():
+            kind = "view" if self.__has_table(self.name, "view") else "table"
             with self.connection:
-                self.connection.execute(f"""drop table {self.name}""")
+                self.connection.execute(f"""drop {kind} {self.name}""")
+                self.__bump_generation()
+        with self.connection:
+            self.connection.execute(f"""delete from {self.cube}""")
+            self.connection.execute(
+                f"""delete from {IDENTITIES} where name=:name""", {"name": self.name}
+            )
+        for table in (self.summary, self.catalog, self.rows, self.positions):
+            if self.__has_table(table):
+                with self.connection:
+                    self.connection.execute(f"""drop table {table}""")
 
     def __has_data_table(self):
+        return self.__has_table(self.name) or self.__has_table(self.name, "view")
+
+    def __has_column(self, column: str, table: Optional[str] = None):
+        cursor = self.connection.execute(f"""pragma table_info({table or self.name})""")
+        return any(row["name"] == column for row in cursor)
+
+    def __has_table(self, name: str, kind: str = "table"):
         cursor = self.connection.execute(
             f"""
             select count(name)
             from sqlite_master
-            where type='table' and name='{self.name}'
+            where type='{kind}' and name='{name}'
             """
         )
         return cursor.fetchone()[0] > 0
+
+
+def vacuum(db_name: str = DB_NAME):
+    """Rebuild the database file, returning the space of deleted rows."""
+    connection = sqlite3.connect(db_name)
+    try:
+        connection.execute("vacuum")
+    finally:
+        connection.close()
+
+
+def open_db(
+    inlet_name: str,
+    clear: bool = False,
+    db_name: Optional[str] = None,
+    store="sqlite",
+    read_only: bool = False,
+):
+    """Open the storage for one inlet, using the backend named by `store`.
+
+    Every backend has the add/get interface of InletDb. `db_name` defaults to
+    the backend's usual location. Only the sqlite store opens `read_only`,
+    as described for InletDb.
+    """
+    if read_only and store != "sqlite":
+        raise ValueError(f"Only the sqlite store opens read only, not {store}")
+    if store == "parquet":
+        # pyarrow is only needed by the parquet backend
+        import inlet_parquet
+
+        return inlet_parquet.InletParquet(
+            inlet_name,
+            clear,
+            db_name if db_name is not None else inlet_parquet.PARQUET_ROOT,
+        )
+    elif store == "sqlite":
+        return InletDb(
+            inlet_name,
+            clear,
+            db_name if db_name is not None else DB_NAME,
+            read_only=read_only,
+        )
+    elif store == "shards":
+        return ShardSet(db_name if db_name is not None else SHARD_ROOT).open(
+            inlet_name, clear
+        )
+    else:
+        raise ValueError(f"Unknown store {store}, expected one of {STORES}")
+
+
+class ShardSet:
+    """One SQLite database file per inlet, all in one directory.
+
+    Each file only ever has one writer, so inlets can be ingested by separate
+    processes at once. Queries across inlets attach the files to a single
+    connection, and merge() gathers them into one ordinary database.
+    """
+
+    def __init__(self, root: str = SHARD_ROOT):
+        self.root = root
+
+    def path(self, inlet_name: str) -> str:
+        return os.path.join(self.root, f"{_table_name(inlet_name)}.db")
+
+    def open(self, inlet_name: str, clear: bool = False) -> InletDb:
+        os.makedirs(self.root, exist_ok=True)
+        return InletDb(inlet_name, clear, self.path(inlet_name))
+
+    def get_inlet_names(self) -> List[str]:
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(
+            file[: -len(".db")]
+            for file in os.listdir(self.root)
+            if file.endswith(".db")
+        )
+
+    def attached(self, inlet_names: Sequence[str]) -> sqlite3.Connection:
+        """In-memory connection with each shard attached under its table name.
+
+        At most MAX_ATTACHED shards can be attached to one connection.
+        """
+        connection = sqlite3.connect(":memory:")
+        connection.row_factory = sqlite3.Row
+        for name in inlet_names:
+            connection.execute(
+                f"attach database :path as {_table_name(name)}",
+                {"path": self.path(name)},
+            )
+        return connection
+
+    def get_source_counts(self, before=None) -> Dict[Tuple[int, int], int]:
+        """Number of distinct sources per (year, month), across every inlet."""
+        clause, params = "", {}
+        if before is not None:
+            clause, params = "where year<:before", {"before": before.year}
+        names = self.get_inlet_names()
+        months = set()
+        for start in range(0, len(names), MAX_ATTACHED):
+            group = names[start : start + MAX_ATTACHED]
+            connection = self.attached(group)
+            try:
+                queries = [
+                    f"select year, month, source from {name}.{name}_summary {clause}"
+                    for name in group
+                ]
+                cursor = connection.execute(" union ".join(queries), params)
+                months.update(tuple(row) for row in cursor)
+            finally:
+                connection.close()
+        counts = {}
+        for year, month, _ in months:
+            counts[(year, month)] = counts.get((year, month), 0) + 1
+        return counts
+
+    def merge(self, db_name: str = DB_NAME, inlet_names: Sequence[str] = ()):
+        """Copy every shard, or the named ones, into the database `db_name`."""
+        for name in self.get_inlet_names():
+            if len(inlet_names) > 0 and name not in inlet_names:
+                continue
+            InletDb(name, db_name=db_name).merge_from(self.path(name))
+
+
+class MemoryBuild:
+    """A copy of a database in memory, written back in one step.
+
+    InletDbs opened with `name` share the in-memory database, so ingestion
+    runs without touching the disk. write() copies it to a new file with
+    the SQLite backup API and renames that over `db_name`, so readers see
+    either the old database or the complete new one.
+    """
+
+    def __init__(self, db_name: str = DB_NAME):
+        self.db_name = db_name
+        self.name = f"file:inlet_build_{uuid.uuid4().hex}?mode=memory&cache=shared"
+        # the in-memory database lasts as long as a connection to it is open
+        self.connection = sqlite3.connect(self.name, uri=True)
+        if os.path.isfile(db_name):
+            # inlets which are not being rebuilt keep their data
+            existing = sqlite3.connect(db_name)
+            try:
+                existing.backup(self.connection)
+            finally:
+                existing.close()
+
+    def __del__(self):
+        self.connection.close()
+
+    def write(self):
+        directory = os.path.dirname(os.path.abspath(self.db_name))
+        handle, partial = tempfile.mkstemp(
+            prefix=f"{os.path.basename(self.db_name)}.",
+            suffix=".partial",
+            dir=directory,
+        )
+        os.close(handle)
+        try:
+            target = sqlite3.connect(partial)
+            try:
+                self.connection.backup(target)
+            finally:
+                target.close()
+            os.replace(partial, self.db_name)
+        except BaseException:
+            os.remove(partial)
+            raise
@@ -0,0 +1,536 @@
+import datetime
+from collections import Counter
+from inlet_data import (
+    BATCH_FIELDS,
+    BATCH_SIZE,
+    COLUMN_TYPES,
+    DEFAULT_COLUMNS,
+    InletData,
+    InletDataBatch,
+    _table_name,
+)
+import logging
+import numpy
+import os
+import shutil
+from typing import Dict, Iterator, List, Optional, Sequence, Set, Tuple
+import uuid
+
+try:
+    import pyarrow
+    import pyarrow.compute as compute
+    import pyarrow.dataset as dataset
+    import pyarrow.parquet as parquet
+except ImportError as e:
+    raise ImportError(
+        "The parquet store needs pyarrow; install it with `poetry install -E parquet`"
+    ) from e
+
+PARQUET_ROOT = "inlet_data.parquet"
+# rows held in memory before being written out, so that ingesting one small
+# file at a time does not leave thousands of tiny parquet files behind
+FLUSH_ROWS = 1_000_000
+SCHEMA = pyarrow.schema(
+    [
+        ("source", pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+        ("latitude", pyarrow.float64()),
+        ("longitude", pyarrow.float64()),
+        # wall clock time, with the UTC offset kept separately (in seconds) so
+        # that converting back to SQLite gives the same ISO text
+        ("time", pyarrow.timestamp("us")),
+        ("utc_offset", pyarrow.int32()),
+        ("depth", pyarrow.float64()),
+        ("value", pyarrow.float64()),
+        ("quality", pyarrow.int64()),
+        ("computed", pyarrow.bool_()),
+        ("assumed_density", pyarrow.bool_()),
+        ("kind", pyarrow.string()),
+        ("decade", pyarrow.int32()),
+    ]
+)
+PARTITIONING = dataset.partitioning(
+    pyarrow.schema([("kind", pyarrow.string()), ("decade", pyarrow.int32())]),
+    flavor="hive",
+)
+
+
+def get_inlet_names(root: str = PARQUET_ROOT) -> List[str]:
+    """Names of the inlets stored under `root`, as their table names."""
+    if not os.path.isdir(root):
+        return []
+    return sorted(
+        entry[len("inlet=") :]
+        for entry in os.listdir(root)
+        if entry.startswith("inlet=")
+    )
+
+
+def _to_table(data: List[InletData], kind: str) -> pyarrow.Table:
+    if isinstance(data, InletDataBatch):
+        return _batch_to_table(data, kind)
+    times = [datum.time for datum in data]
+    offsets = [time.utcoffset() for time in times]
+    return pyarrow.table(
+        {
+            "source": pyarrow.array(
+                [datum.source for datum in data], pyarrow.string()
+            ).dictionary_encode(),
+            "latitude": [datum.latitude for datum in data],
+            "longitude": [datum.longitude for datum in data],
+            "time": pyarrow.array(
+                [time.replace(tzinfo=None) for time in times], pyarrow.timestamp("us")
+            ),
+            "utc_offset": pyarrow.array(
+                [
+                    None if offset is None else int(offset.total_seconds())
+                    for offset in offsets
+                ],
+                pyarrow.int32(),
+            ),
+            "depth": [datum.depth for datum in data],
+            "value": [datum.value for datum in data],
+            "quality": [datum.quality for datum in data],
+            "computed": [bool(datum.computed) for datum in data],
+            "assumed_density": [bool(datum.assumed_density) for datum in data],
+            "kind": [kind] * len(data),
+            "decade": [time.year // 10 * 10 for time in times],
+        },
+        schema=SCHEMA,
+    )
+
+
+def _batch_to_table(batch: InletDataBatch, kind: str) -> pyarrow.Table:
+    # batches are already columns, and their times have no UTC offset
+    return pyarrow.table(
+        {
+            "source": pyarrow.DictionaryArray.from_arrays(
+                batch.source, pyarrow.array(batch.sources.tolist(), pyarrow.string())
+            ),
+            **{field: getattr(batch, field) for field in BATCH_FIELDS},
+            "utc_offset": pyarrow.nulls(len(batch), pyarrow.int32()),
+            "kind": pyarrow.repeat(pyarrow.scalar(kind), len(batch)),
+            "decade": (batch.time.astype("datetime64[Y]").astype(int) + 1970)
+            // 10
+            * 10,
+        },
+        schema=SCHEMA,
+    )
+
+
+def _to_time(time: datetime.datetime, offset: Optional[int]) -> datetime.datetime:
+    if offset is None:
+        return time
+    return time.replace(
+        tzinfo=datetime.timezone(datetime.timedelta(seconds=offset))
+    )
+
+
+def _row_to_data(row: Dict) -> InletData:
+    return InletData(
+        source=row["source"],
+        latitude=row["latitude"],
+        longitude=row["longitude"],
+        time=_to_time(row["time"], row["utc_offset"]),
+        depth=row["depth"],
+        value=row["value"],
+        quality=row["quality"],
+        computed=row["computed"],
+        assumed_density=row["assumed_density"],
+    )
+
+
+class InletParquet:
+    """Parquet storage for one inlet, with the same interface as InletDb.
+
+    Rows live under `<root>/inlet=<name>/kind=<kind>/decade=<decade>/`, so
+    queries only open the files for the kind and decades they need, and only
+    read the columns they select. Filters on depth, quality and value are
+    checked against the row group statistics before any data is read.
+
+    Two parts of InletDb are not supported. Rows are not tagged with depth
+    zones, because the boundaries are only recorded and depth filters do the
+    same job. There is no aggregate cube, so get_cube always gives None and
+    averaged queries read the dataset each time.
+    """
+
+    # build_cube warns once per process, not once per inlet
+    warned_cube = False
+
+    def __init__(
+        self, inlet_name: str, clear: bool = False, db_name: str = PARQUET_ROOT
+    ):
+        self.name = _table_name(inlet_name)
+        self.path = os.path.join(db_name, f"inlet={self.name}")
+        self.pending = []
+        self.pending_rows = 0
+        self.dataset = None
+        # the write generation, as in inlet_data.GENERATIONS
+        self.generation = 0
+        # the generation is not kept between runs, so files derived from the
+        # rows are only current within the run that wrote them
+        self.identity = uuid.uuid4().hex
+        self.zones = []
+        if clear:
+            self.clear()
+
+    def __del__(self):
+        self.flush()
+
+    def clear(self):
+        self.pending, self.pending_rows = [], 0
+        self.dataset = None
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        self.generation += 1
+        self.identity = uuid.uuid4().hex
+
+    def flush(self):
+        """Write out rows added since the last flush."""
+        if self.pending_rows == 0:
+            return
+        parquet.write_to_dataset(
+            pyarrow.concat_tables(self.pending).unify_dictionaries(),
+            root_path=self.path,
+            partition_cols=["kind", "decade"],
+            basename_template=f"{uuid.uuid4().hex}-{{i}}.parquet",
+        )
+        self.pending, self.pending_rows = [], 0
+        self.dataset = None
+
+    def set_depth_zones(self, boundaries: Sequence[float]):
+        # only recorded, as depth filters are pushed down to the row group
+        # statistics instead of looking rows up by zone
+        self.zones = sorted(set(float(boundary) for boundary in boundaries))
+
+    def build_cube(
+        self,
+        buckets: Dict[str, Tuple[float, float]],
+        exclude_qualities: Sequence[int] = (),
+    ):
+        if not InletParquet.warned_cube:
+            logging.warning(
+                "Parquet storage has no aggregate cube, so averaged queries "
+                "read the dataset every time"
+            )
+            InletParquet.warned_cube = True
+
+    def get_cube(
+        self,
+        kind: str,
+        bucket: str,
+        bounds: Tuple[float, float],
+        resolution: str,
+        before=None,
+        exclude_qualities: Sequence[int] = (),
+    ) -> Optional[Dict[str, numpy.ndarray]]:
+        # as for a cube which is out of date, see build_cube
+        return None
+
+    def has_data(self, kind: str) -> bool:
+        data = self.__dataset()
+        if data is None:
+            return False
+        return data.count_rows(filter=dataset.field("kind") == kind) > 0
+
+    def get_sources(self, by_month: bool = False, before=None) -> Dict[int, Set[str]]:
+        """Sources with data of any kind, keyed by year (or by month)."""
+        sources = {}
+        for year, month, source in self.__source_months(before):
+            sources.setdefault(month if by_month else year, set()).add(source)
+        return sources
+
+    def get_source_counts(self, before=None) -> Dict[Tuple[int, int], int]:
+        """Number of distinct sources with data of any kind per (year, month)."""
+        return dict(
+            Counter((year, month) for year, month, _ in self.__source_months(before))
+        )
+
+    def iter_data(
+        self, kind: str, bucket: Tuple[float, float], batch_size: int = BATCH_SIZE
+    ) -> Iterator[List[InletData]]:
+        """Like get_*_data, but yields the rows in lists of up to `batch_size`."""
+        for batch in self.__scan(
+            [name for name in SCHEMA.names if name not in ("kind", "decade")],
+            self.__filter(kind, bucket),
+            batch_size,
+        ):
+            yield [_row_to_data(row) for row in batch.to_pylist()]
+
+    def iter_batches(
+        self,
+        kind: str,
+        bucket: Tuple[float, float],
+        batch_size: int = BATCH_SIZE,
+        before=None,
+        exclude_qualities: Sequence[int] = (),
+    ) -> Iterator[InletDataBatch]:
+        """Like get_batch, but yields InletDataBatches of up to `batch_size` rows."""
+        columns = BATCH_FIELDS + ("source",)
+        for batch in self.__scan(
+            list(columns),
+            self.__filter(kind, bucket, before, exclude_qualities),
+            batch_size,
+        ):
+            yield InletDataBatch.from_columns(
+                {
+                    column: batch[column].to_numpy(zero_copy_only=False)
+                    for column in columns
+                }
+            )
+
+    def get_columns(
+        self,
+        kind: str,
+        bucket: Tuple[float, float],
+        columns: Sequence[str] = DEFAULT_COLUMNS,
+        average: bool = False,
+        before=None,
+        exclude_qualities: Sequence[int] = (),
+        value_bounds: Optional[Tuple[float, float]] = None,
+    ) -> Dict[str, numpy.ndarray]:
+        """Read `kind` data inside `bucket` as one numpy array per column.
+
+        Behaves like InletDb.get_columns.
+        """
+        expression = self.__filter(
+            kind, bucket, before, exclude_qualities, value_bounds
+        )
+        if average:
+            table = self.__daily_means(expression)
+            length = len(table)
+            return {
+                column: table["day"].to_numpy().astype(COLUMN_TYPES["time"])
+                if column == "time"
+                else table[column].to_numpy()
+                if column in ("value", "source")
+                else numpy.zeros(length, dtype=COLUMN_TYPES[column])
+                for column in columns
+            }
+        table = self.__read(list(columns), expression)
+        return {
+            column: table[column].to_numpy().astype(COLUMN_TYPES[column])
+            for column in columns
+        }
+
+    def get_batch(
+        self,
+        kind: str,
+        bucket: Tuple[float, float],
+        before=None,
+        exclude_qualities: Sequence[int] = (),
+    ) -> InletDataBatch:
+        """Read `kind` data inside `bucket` as an InletDataBatch."""
+        return InletDataBatch.from_columns(
+            self.get_columns(
+                kind,
+                bucket,
+                columns=BATCH_FIELDS + ("source",),
+                before=before,
+                exclude_qualities=exclude_qualities,
+            )
+        )
+
+    def get_monthly_means(
+        self,
+        kind: str,
+        bucket: Tuple[float, float],
+        before=None,
+        exclude_qualities: Sequence[int] = (),
+        value_bounds: Optional[Tuple[float, float]] = None,
+    ) -> Dict[str, numpy.ndarray]:
+        """Monthly means of the daily per-source means of `kind` data.
+
+        Behaves like InletDb.get_monthly_means.
+        """
+        daily = self.__daily_means(
+            self.__filter(kind, bucket, before, exclude_qualities)
+        )
+        monthly = (
+            pyarrow.table(
+                {
+                    "month": compute.floor_temporal(daily["day"], unit="month"),
+                    "value": daily["value"],
+                }
+            )
+            .group_by("month")
+            .aggregate([("value", "mean")])
+            .sort_by("month")
+        )
+        time = monthly["month"].to_numpy().astype("datetime64[D]")
+        value = monthly["value_mean"].to_numpy()
+        if value_bounds is not None:
+            inside = (value > value_bounds[0]) & (value < value_bounds[1])
+            time, value = time[inside], value[inside]
+        return {"time": time, "value": numpy.ascontiguousarray(value)}
+
+    def add_temperature_value(self, value: InletData):
+        self.__add_data([value], "temperature")
+
+    def add_temperature_data(self, data: List[InletData]):
+        self.__add_data(data, "temperature")
+
+    def get_temperature_data(
+        self, bucket: Tuple[float, float], average: bool = False
+    ) -> List[InletData]:
+        if average:
+            return self.__get_daily_averages("temperature", bucket)
+        else:
+            return self.__get_data("temperature", bucket)
+
+    def add_salinity_value(self, value: InletData):
+        self.__add_data([value], "salinity")
+
+    def add_salinity_data(self, data: List[InletData]):
+        self.__add_data(data, "salinity")
+
+    def get_salinity_data(
+        self, bucket: Tuple[float, float], average: bool = False
+    ) -> List[InletData]:
+        if average:
+            return self.__get_daily_averages("salinity", bucket)
+        else:
+            return self.__get_data("salinity", bucket)
+
+    def add_oxygen_value(self, value: InletData):
+        self.__add_data([value], "oxygen")
+
+    def add_oxygen_data(self, data: List[InletData]):
+        self.__add_data(data, "oxygen")
+
+    def get_oxygen_data(
+        self, bucket: Tuple[float, float], average: bool = False
+    ) -> List[InletData]:
+        if average:
+            return self.__get_daily_averages("oxygen", bucket)
+        else:
+            return self.__get_data("oxygen", bucket)
+
+    def __add_data(self, data: List[InletData], kind: str):
+        if len(data) == 0:
+            return
+        self.pending.append(_to_table(data, kind))
+        self.pending_rows += len(data)
+        self.generation += 1
+        if self.pending_rows >= FLUSH_ROWS:
+            self.flush()
+
+    def __dataset(self) -> Optional[dataset.Dataset]:
+        self.flush()
+        if self.dataset is None and os.path.isdir(self.path):
+            self.dataset = dataset.dataset(
+                self.path, schema=SCHEMA, format="parquet", partitioning=PARTITIONING
+            )
+        return self.dataset
+
+    def __read(self, columns: List[str], expression) -> pyarrow.Table:
+        data = self.__dataset()
+        if data is None:
+            return SCHEMA.empty_table().select(columns)
+        return data.to_table(columns=columns, filter=expression)
+
+    def __scan(
+        self, columns: List[str], expression, batch_size: int = BATCH_SIZE
+    ) -> Iterator[pyarrow.RecordBatch]:
+        # like __read, without holding more than one batch of rows at a time
+        data = self.__dataset()
+        if data is None:
+            return
+        for batch in data.to_batches(
+            columns=columns, filter=expression, batch_size=batch_size
+        ):
+            if batch.num_rows > 0:
+                yield batch
+
+    def __source_months(self, before=None) -> Set[Tuple[int, int, str]]:
+        """Distinct (year, month, source) of every row, read batch by batch."""
+        months = set()
+        for batch in self.__scan(["time", "source"], self.__filter(before=before)):
+            table = (
+                pyarrow.table(
+                    {
+                        "year": compute.year(batch["time"]),
+                        "month": compute.month(batch["time"]),
+                        "source": batch["source"],
+                    }
+                )
+                .group_by(["year", "month", "source"])
+                .aggregate([])
+            )
+            months.update(
+                zip(
+                    table["year"].to_pylist(),
+                    table["month"].to_pylist(),
+                    table["source"].to_pylist(),
+                )
+            )
+        return months
+
+    def __filter(
+        self,
+        kind: Optional[str] = None,
+        bucket: Tuple[float, float] = (None, None),
+        before=None,
+        exclude_qualities: Sequence[int] = (),
+        value_bounds: Optional[Tuple[float, float]] = None,
+    ):
+        min_depth, max_depth = bucket
+        clauses = []
+        if kind is not None:
+            clauses.append(dataset.field("kind") == kind)
+        if min_depth is not None:
+            clauses.append(dataset.field("depth") >= min_depth)
+        if max_depth is not None:
+            clauses.append(dataset.field("depth") <= max_depth)
+        if before is not None:
+            # the decade comparison lets whole partitions be skipped
+            clauses.append(dataset.field("decade") < before.year)
+            clauses.append(
+                dataset.field("time")
+                < pyarrow.scalar(
+                    datetime.datetime(before.year, 1, 1), pyarrow.timestamp("us")
+                )
+            )
+        if len(exclude_qualities) > 0:
+            clauses.append(~dataset.field("quality").isin(list(exclude_qualities)))
+        if value_bounds is not None:
+            clauses.append(dataset.field("value") > value_bounds[0])
+            clauses.append(dataset.field("value") < value_bounds[1])
+        expression = None
+        for clause in clauses:
+            expression = clause if expression is None else expression & clause
+        return expression
+
+    def __daily_means(self, expression) -> pyarrow.Table:
+        table = self.__read(["source", "time", "value"], expression)
+        means = (
+            pyarrow.table(
+                {
+                    "source": table["source"],
+                    "day": compute.cast(table["time"], pyarrow.date32()),
+                    "value": table["value"],
+                }
+            )
+            .group_by(["source", "day"])
+            .aggregate([("value", "mean")])
+        )
+        # the order of the aggregated columns depends on the pyarrow version
+        return pyarrow.table(
+            {
+                "source": means["source"],
+                "day": means["day"],
+                "value": means["value_mean"],
+            }
+        )
+
+    def __get_data(self, kind: str, bucket: Tuple[float, float]) -> List[InletData]:
+        return [datum for data in self.iter_data(kind, bucket) for datum in data]
+
+    def __get_daily_averages(
+        self, kind: str, bucket: Tuple[float, float]
+    ) -> List[InletData]:
+        """Perform daily vertical averaging inside depth categories."""
+        table = self.__daily_means(self.__filter(kind, bucket))
+        return [
+            InletData(row["day"], 0, row["value"], 0, 0, 0, row["source"])
+            for row in table.to_pylist()
+        ]
@@ -1,10 +1,10 @@
+from collections import OrderedDict
 import convert
 import csv
 import datetime
 import fnmatch
 import gsw
 import inlet_data
-import itertools
 import json
 import logging
 import math
@@ -12,6 +12,7 @@ import numpy
 import os
 import pandas
 import re
+import snapshot
 from shapely.geometry import Point, Polygon
 from typing import Dict, List
 import xarray
@@ -20,6 +21,9 @@ import erddap
 from enum import Enum
 
 EXCEPTIONALLY_BIG = 9.9e36
+# 2 is "inconsistent with climatology" in the vast majority of observed cases
+BAD_QUALITIES = [2, 3, 4]
+QUERY_CACHE_SIZE = 64
 
 
 class Category(Enum):
@@ -197,9 +201,7 @@ def has_quality(value_index, names):
 
 
 def is_acceptable_quality(quality_value):
-    # 2 is "inconsistent with climatology" in the vast majority of observed cases
-    bad_qualities = [2, 3, 4]
-    return quality_value not in bad_qualities
+    return quality_value not in BAD_QUALITIES
 
 
 def extract_data(source, index, replace):
@@ -230,24 +232,8 @@ def warn_wrong_units(expected, actual, filename):
     )
 
 
-def get_data(col, before=None, do_average=False):
-    data = [
-        [datum.time, datum.value]
-        for datum in col
-        if is_acceptable_quality(datum.quality)
-    ]
-    if before is not None:
-        data = [[t, d] for t, d in data if t.year < before.year]
-    if do_average:
-        data_dict = {}
-        for t, d in data:
-            date = datetime.date(t.year, t.month, 1)
-            if date not in data_dict:
-                data_dict[date] = {"total": 0, "count": 0}
-            data_dict[date]["total"] += d
-            data_dict[date]["count"] += 1
-        data = [[key, elem["total"] / elem["count"]] for key, elem in data_dict.items()]
-    return zip(*data) if len(data) > 0 else [[], []]
+def no_data():
+    return numpy.array([], dtype="datetime64[us]"), numpy.array([], dtype=float)
 
 
 def hakai_quality(quality):
@@ -256,6 +242,55 @@ def hakai_quality(quality):
     return 1
 
 
+class QueryCache(object):
+    """Bounded LRU cache of query results, tagged with the write generation.
+
+    An entry stored at an older generation than the one asked for is treated
+    as a miss and dropped, so any insert into the database invalidates it.
+    """
+
+    def __init__(self, maxsize: int = QUERY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, generation, compute):
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == generation:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        value = compute()
+        self.entries[key] = (generation, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        self.entries.clear()
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self.entries),
+            "hit_rate": self.hit_rate(),
+        }
+
+
+def read_only(*arrays):
+    for array in arrays:
+        array.setflags(write=False)
+    return arrays
+
+
 class Inlet(object):
     def __init__(
         self,
@@ -268,6 +303,9 @@ class Inlet(object):
         db_name=None,
         shallow: List[int] = [0, 30, 100],
         seasons: List[int] = [],
+        store: str = "sqlite",
+        snapshot_root=None,
+        read_only: bool = False,
     ):
         self.name = name
         self.area = area
@@ -285,16 +323,33 @@ class Inlet(object):
         self.polygon = polygon
         self.limits = limits
         self.used_files = set()
-        if db_name is not None:
-            self.data = inlet_data.InletDb(name, clear_old_data, db_name)
-        else:
-            self.data = inlet_data.InletDb(name, clear_old_data)
+        self.data = inlet_data.open_db(
+            name, clear_old_data, db_name, store, read_only=read_only
+        )
+        if snapshot_root is not None:
+            self.data = snapshot.SnapshotDb(self.data, snapshot_root)
         self.surface_bounds = (shallow[0], shallow[1])
         if len(shallow) > 2:
             self.shallow_bounds = (shallow[1], shallow[2])
         else:
             self.shallow_bounds = None
         self.seasons = seasons
+        self.cache = QueryCache()
+        # every bucket is a range between these, so it can be found by zone
+        self.data.set_depth_zones(
+            [
+                bound
+                for bounds in (
+                    self.surface_bounds,
+                    self.shallow_bounds or (),
+                    self.deep_bounds,
+                    self.deeper_bounds,
+                    self.deepest_bounds,
+                )
+                for bound in bounds
+                if bound is not None
+            ]
+        )
 
     def __bucket_to_bounds(self, bucket: Category):
         return (
@@ -324,77 +379,118 @@ class Inlet(object):
             else None
         )
 
-    def get_temperature_data(self, bucket: str, before=None, do_average=False):
+    def get_bounds(self, bucket: Category):
+        # (min depth, max depth) of a bucket, where None is no limit
+        return self.__bucket_to_bounds(bucket)
+
+    def __get_values(self, kind: str, bucket: Category, before, do_average, limits):
+        """(times, values) arrays for plotting, excluding bad quality data.
+
+        With `do_average`, the values are averaged by month and the times are
+        the first day of each month. `limits` is a [lower, upper] pair from
+        the "limits" property, keeping values strictly between the two; with
+        `do_average` it applies to the monthly means, as the charts do.
+        """
         if bucket == Category.SHALLOW and self.shallow_bounds is None:
-            return [[], []]
-        bounds = self.__bucket_to_bounds(bucket)
-        return get_data(
-            self.data.get_temperature_data(bounds, average=do_average),
-            before,
+            return no_data()
+        value_bounds = (
+            (limits[0], limits[1]) if limits is not None and len(limits) > 1 else None
+        )
+        # `before` only matters by year, so every END in a plotting run shares
+        # the same entry
+        key = (
+            self.name,
+            kind,
+            bucket,
+            before.year if before is not None else None,
             do_average,
+            value_bounds,
         )
-
-    def get_salinity_data(self, bucket: str, before=None, do_average=False):
-        if bucket == Category.SHALLOW and self.shallow_bounds is None:
-            return [[], []]
-        bounds = self.__bucket_to_bounds(bucket)
-        return get_data(
-            self.data.get_salinity_data(bounds, average=do_average), before, do_average
+        return self.cache.get(
+            key,
+            self.data.generation,
+            lambda: read_only(
+                *self.__query_values(kind, bucket, before, do_average, value_bounds)
+            ),
         )
 
-    def get_oxygen_data(self, bucket: str, before=None, do_average=False):
-        if bucket == Category.SHALLOW and self.shallow_bounds is None:
-            return [[], []]
+    def build_cube(self):
+        """Aggregate the good quality data of every bucket, for averaged queries."""
+        buckets = {
+            bucket.name: self.__bucket_to_bounds(bucket)
+            for bucket in Category
+            if self.shallow_bounds is not None
+            or bucket not in (Category.SHALLOW, Category.IGNORE)
+        }
+        self.data.build_cube(buckets, exclude_qualities=BAD_QUALITIES)
+
+    def __query_values(
+        self, kind: str, bucket: Category, before, do_average, value_bounds
+    ):
         bounds = self.__bucket_to_bounds(bucket)
-        return get_data(
-            self.data.get_oxygen_data(bounds, average=do_average), before, do_average
+        cube = (
+            self.data.get_cube(
+                kind,
+                bucket.name,
+                bounds,
+                "month",
+                before=before,
+                exclude_qualities=BAD_QUALITIES,
+            )
+            if do_average
+            else None
         )
+        if cube is not None:
+            # the months, without reading any rows
+            times, values = cube["time"], cube["mean"]
+            if value_bounds is not None:
+                inside = (values > value_bounds[0]) & (values < value_bounds[1])
+                times, values = times[inside], values[inside]
+            return times, values
+        if do_average:
+            data = self.data.get_monthly_means(
+                kind,
+                bounds,
+                before=before,
+                exclude_qualities=BAD_QUALITIES,
+                value_bounds=value_bounds,
+            )
+        else:
+            data = self.data.get_columns(
+                kind,
+                bounds,
+                columns=("time", "value"),
+                before=before,
+                exclude_qualities=BAD_QUALITIES,
+                value_bounds=value_bounds,
+            )
+        return data["time"], data["value"]
+
+    def get_temperature_data(
+        self, bucket: str, before=None, do_average=False, limits=None
+    ):
+        return self.__get_values("temperature", bucket, before, do_average, limits)
+
+    def get_salinity_data(self, bucket: str, before=None, do_average=False, limits=None):
+        return self.__get_values("salinity", bucket, before, do_average, limits)
+
+    def get_oxygen_data(self, bucket: str, before=None, do_average=False, limits=None):
+        return self.__get_values("oxygen", bucket, before, do_average, limits)
 
     def has_temperature_data(self):
-        bounds = self.__bucket_to_bounds(Category.ALL)
-        return len(self.data.get_temperature_data(bounds)) > 0
+        return self.data.has_data("temperature")
 
     def has_salinity_data(self):
-        bounds = self.__bucket_to_bounds(Category.ALL)
-        return len(self.data.get_salinity_data(bounds)) > 0
+        return self.data.has_data("salinity")
 
     def has_oxygen_data(self):
-        bounds = self.__bucket_to_bounds(Category.ALL)
-        return len(self.data.get_oxygen_data(bounds)) > 0
+        return self.data.has_data("oxygen")
 
     def has_data_from(self, file_name):
         return os.path.basename(file_name).lower() in self.used_files
 
     def get_station_data(self, before=None, by_month=False):
-        bounds = self.__bucket_to_bounds(Category.ALL)
-        data = self.data.get_temperature_data(bounds)
-        temperature_data = (
-            filter(lambda x: x.time.year < before.year, data)
-            if before is not None
-            else data
-        )
-        data = self.data.get_salinity_data(bounds)
-        salinity_data = (
-            filter(lambda x: x.time.year < before.year, data)
-            if before is not None
-            else data
-        )
-        data = self.data.get_oxygen_data(bounds)
-        oxygen_data = (
-            filter(lambda x: x.time.year < before.year, data)
-            if before is not None
-            else data
-        )
-        stations = {}
-        for datum in itertools.chain(temperature_data, salinity_data, oxygen_data):
-            if by_month:
-                time = datum.time.month
-            else:
-                time = datum.time.year
-            if time not in stations:
-                stations[time] = set()
-            stations[time].add(datum.source)
-        return stations
+        return self.data.get_sources(by_month=by_month, before=before)
 
     def contains(self, latitude=None, longitude=None):
         if longitude is None:
@@ -956,8 +1052,19 @@ def get_burke_inlet(osd_data_dir, hakai_data_dir,
     drop_names=[],
     keep_names=[],
     geojson_file="burke_inlet.geojson",  # "inlets.geojson",
+    store="sqlite",
 ) -> List[Inlet]:
     inlet_list = []
+    # saved SQLite data can be read from a snapshot, if one is up to date
+    snapshot_root = (
+        snapshot.SNAPSHOT_ROOT if from_saved and store == "sqlite" else None
+    )
+    # new SQLite data is read into memory, and replaces the database file
+    # only once it is complete
+    build = (
+        inlet_data.MemoryBuild() if not from_saved and store == "sqlite" else None
+    )
+    db_name = build.name if build is not None else None
     with open(geojson_file) as f:
         contents = json.load(f)["features"]
         for content in contents:
@@ -998,6 +1105,10 @@ def get_burke_inlet(osd_data_dir, hakai_data_dir,
                         clear_old_data=not from_saved,
                         shallow=content["properties"]["shallow boundaries"],
                         seasons=seasons,
+                        store=store,
+                        snapshot_root=snapshot_root,
+                        db_name=db_name,
+                        read_only=from_saved and store == "sqlite",
                     )
                 )
             else:
@@ -1010,6 +1121,10 @@ def get_burke_inlet(osd_data_dir, hakai_data_dir,
                         limits,
                         clear_old_data=not from_saved,
                         seasons=seasons,
+                        store=store,
+                        snapshot_root=snapshot_root,
+                        db_name=db_name,
+                        read_only=from_saved and store == "sqlite",
                     )
                 )
     if not from_saved:
@@ -1080,6 +1195,13 @@ def get_burke_inlet(osd_data_dir, hakai_data_dir,
                         continue
                     inlet.add_data_from_csv(inside_inlet, file)
 
+        for inlet in inlet_list:
+            # stores which buffer rows, like Parquet, write them out here
+            inlet.data.flush()
+            inlet.build_cube()
+        if build is not None:
+            build.write()
+
     return inlet_list
 
 
@@ -1093,8 +1215,19 @@ def get_inlets(
     drop_names=[],
     keep_names=[],
     geojson_file="inlets.geojson",
+    store="sqlite",
 ) -> List[Inlet]:
     inlet_list = []
+    # saved SQLite data can be read from a snapshot, if one is up to date
+    snapshot_root = (
+        snapshot.SNAPSHOT_ROOT if from_saved and store == "sqlite" else None
+    )
+    # new SQLite data is read into memory, and replaces the database file
+    # only once it is complete
+    build = (
+        inlet_data.MemoryBuild() if not from_saved and store == "sqlite" else None
+    )
+    db_name = build.name if build is not None else None
     with open(geojson_file) as f:
         contents = json.load(f)["features"]
         for content in contents:
@@ -1135,6 +1268,10 @@ def get_inlets(
                         clear_old_data=not from_saved,
                         shallow=content["properties"]["shallow boundaries"],
                         seasons=seasons,
+                        store=store,
+                        snapshot_root=snapshot_root,
+                        db_name=db_name,
+                        read_only=from_saved and store == "sqlite",
                     )
                 )
             else:
@@ -1147,6 +1284,10 @@ def get_inlets(
                         limits,
                         clear_old_data=not from_saved,
                         seasons=seasons,
+                        store=store,
+                        snapshot_root=snapshot_root,
+                        db_name=db_name,
+                        read_only=from_saved and store == "sqlite",
                     )
                 )
     if not from_saved:
@@ -1218,6 +1359,13 @@ def get_inlets(
                         continue
                     inlet.add_data_from_csv(inside_inlet, file)
 
+        for inlet in inlet_list:
+            # stores which buffer rows, like Parquet, write them out here
+            inlet.data.flush()
+            inlet.build_cube()
+        if build is not None:
+            build.write()
+
     return inlet_list
 
 
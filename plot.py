@@ -1,16 +1,15 @@
 import argparse
+import csv
 import datetime
 
 import numpy as np
 
+import inlet_data
 import inlets
-import itertools
 import matplotlib
 import matplotlib.pyplot as plt
 import numpy
-from numpy.polynomial import polynomial
 import os
-import scipy.optimize
 from typing import Dict, List
 import utils
 
@@ -36,6 +35,16 @@ def ensure_figure_path():
         pass
 
 
+def print_cache_stats(inlet_list: List[inlets.Inlet]):
+    for inlet in inlet_list:
+        stats = inlet.cache.stats()
+        print(
+            f"Query cache for {inlet.name}: {stats['hits']} hits, "
+            f"{stats['misses']} misses, {stats['size']} entries "
+            f"({stats['hit_rate']:.0%} hit rate)"
+        )
+
+
 def bins(min_val, max_val):
     # add 1 to cover matplotlib expecting e.g. [1,2),..,[11,12),[12,13],
     # and 1 for range not including the last value
@@ -50,27 +59,9 @@ def bins(min_val, max_val):
 def chart_deep_data(inlet: inlets.Inlet, limits: List[float], data_fn):
     # produce a matplotlib chart, which can be shown or saved at the upper level
     plt.clf()
-    shallow_time, shallow_data = data_fn(inlet, inlets.Category.DEEP)
-    middle_time, middle_data = data_fn(inlet, inlets.Category.DEEPER)
-    deep_time, deep_data = data_fn(inlet, inlets.Category.DEEPEST)
-    if len(limits) > 1:
-        shallow_time, shallow_data = zip(
-            *[
-                [t, d]
-                for t, d in zip(shallow_time, shallow_data)
-                if limits[0] < d < limits[1]
-            ]
-        )
-        middle_time, middle_data = zip(
-            *[
-                [t, d]
-                for t, d in zip(middle_time, middle_data)
-                if limits[0] < d < limits[1]
-            ]
-        )
-        deep_time, deep_data = zip(
-            *[[t, d] for t, d in zip(deep_time, deep_data) if limits[0] < d < limits[1]]
-        )
+    shallow_time, shallow_data = data_fn(inlet, inlets.Category.DEEP, limits)
+    middle_time, middle_data = data_fn(inlet, inlets.Category.DEEPER, limits)
+    deep_time, deep_data = data_fn(inlet, inlets.Category.DEEPEST, limits)
     plt.plot(
         shallow_time,
         shallow_data,
@@ -94,23 +85,8 @@ def chart_deep_data(inlet: inlets.Inlet, limits: List[float], data_fn):
 
 def chart_surface_data(inlet: inlets.Inlet, limits: List[float], data_fn):
     plt.clf()
-    surface_time, surface_data = data_fn(inlet, inlets.Category.SURFACE)
-    shallow_time, shallow_data = data_fn(inlet, inlets.Category.SHALLOW)
-    if len(limits) > 1:
-        surface_time, surface_data = zip(
-            *[
-                [t, d]
-                for t, d in zip(surface_time, surface_data)
-                if limits[0] < d < limits[1]
-            ]
-        )
-        shallow_time, shallow_data = zip(
-            *[
-                [t, d]
-                for t, d in zip(shallow_time, shallow_data)
-                if limits[0] < d < limits[1]
-            ]
-        )
+    surface_time, surface_data = data_fn(inlet, inlets.Category.SURFACE, limits)
+    shallow_time, shallow_data = data_fn(inlet, inlets.Category.SHALLOW, limits)
     plt.plot(
         surface_time,
         surface_data,
@@ -129,30 +105,15 @@ def chart_surface_data(inlet: inlets.Inlet, limits: List[float], data_fn):
 
 def chart_surface_and_deep(inlet: inlets.Inlet, limits: List[float], data_fn):
     # Copied from chart_surface_data() and chart_deep_data()
-    # data_fn(inlet, bucket): inlet.get_temperature_data(
-    #         bucket, before=END, do_average=use_averages
+    # data_fn(inlet, bucket, limits): inlet.get_temperature_data(
+    #         bucket, before=END, do_average=use_averages, limits=limits
     #     )
     plt.clf()
-    surface_time, surface_data = data_fn(inlet, inlets.Category.SURFACE)
+    surface_time, surface_data = data_fn(inlet, inlets.Category.SURFACE, limits)
     # USED_DEEP Category includes DEEP, DEEPER and DEEPEST, which is
     # what we want
-    deep_time, deep_data = data_fn(inlet, inlets.Category.USED_DEEP)
-
-    if len(limits) > 1:
-        surface_time, surface_data = zip(
-            *[
-                [t, d]
-                for t, d in zip(surface_time, surface_data)
-                if limits[0] < d < limits[1]
-            ]
-        )
-        deep_time, deep_data = zip(
-            *[
-                [t, d]
-                for t, d in zip(deep_time, deep_data)
-                if limits[0] < d < limits[1]
-            ]
-        )
+    deep_time, deep_data = data_fn(inlet, inlets.Category.USED_DEEP, limits)
+
     plt.plot(
         surface_time,
         surface_data,
@@ -171,8 +132,8 @@ def chart_surface_and_deep(inlet: inlets.Inlet, limits: List[float], data_fn):
     # TODO fix x_values so it has the same uneven spacing as deep_time
     # Convert deep_time to seconds since [1970]
     # x_values = np.linspace(0, 1, len(deep_time))
-    deep_time_arr = np.array([*deep_time])
-    x_values = (deep_time_arr - np.min(deep_time_arr)) / datetime.timedelta(days=1)
+    deep_time_arr = np.asarray(deep_time)
+    x_values = (deep_time_arr - np.min(deep_time_arr)) / np.timedelta64(1, "D")
     x_values_sorted = sorted(x_values)
     deep_data_sorted = [
         i for _, i in sorted(zip(x_values, deep_data))
@@ -190,8 +151,8 @@ def chart_temperatures(
 ):
     average = "-average" if use_averages else ""
     ylabel = "Temperature (C)"
-    data_fn = lambda inlet, bucket: inlet.get_temperature_data(
-        bucket, before=END, do_average=use_averages
+    data_fn = lambda inlet, bucket, limits: inlet.get_temperature_data(
+        bucket, before=END, do_average=use_averages, limits=limits
     )
 
     chart_deep_data(inlet, limits["deep"], data_fn)
@@ -214,8 +175,8 @@ def chart_temperatures_surface_deep(
 ):
     average = "-average" if use_averages else ""
     ylabel = "Temperature (C)"
-    data_fn = lambda inlet, bucket: inlet.get_temperature_data(
-        bucket, before=END, do_average=use_averages
+    data_fn = lambda inlet, bucket, limits: inlet.get_temperature_data(
+        bucket, before=END, do_average=use_averages, limits=limits
     )
     # TODO change limits?
     chart_surface_and_deep(inlet, limits["surface"], data_fn)
@@ -231,8 +192,8 @@ def chart_salinities(
 ):
     average = "-average" if use_averages else ""
     ylabel = "Salinity (PSU)"
-    data_fn = lambda inlet, bucket: inlet.get_salinity_data(
-        bucket, before=END, do_average=use_averages
+    data_fn = lambda inlet, bucket, limits: inlet.get_salinity_data(
+        bucket, before=END, do_average=use_averages, limits=limits
     )
 
     chart_deep_data(inlet, limits["deep"], data_fn)
@@ -255,8 +216,8 @@ def chart_oxygen_data(
 ):
     average = "-average" if use_averages else ""
     ylabel = "DO (ml/l)"
-    data_fn = lambda inlet, bucket: inlet.get_oxygen_data(
-        bucket, before=END, do_average=use_averages
+    data_fn = lambda inlet, bucket, limits: inlet.get_oxygen_data(
+        bucket, before=END, do_average=use_averages, limits=limits
     )
 
     chart_deep_data(inlet, limits["deep"], data_fn)
@@ -379,19 +340,66 @@ def do_chart_all(inlet_list, kind, bucket, chart_all_fn):
 ############################
 
 
+def stacked_parts(parts):
+    # the times and data of all of `parts`, with the index of each one's part
+    groups = numpy.concatenate(
+        [numpy.full(len(data), i) for i, (_, data) in enumerate(parts)]
+        + [numpy.empty(0, dtype=int)]
+    )
+    times = numpy.concatenate(
+        [numpy.asarray(times, dtype="datetime64[D]") for times, _ in parts]
+        + [numpy.empty(0, dtype="datetime64[D]")]
+    )
+    data = numpy.concatenate(
+        [numpy.asarray(data, dtype=float) for _, data in parts] + [numpy.empty(0)]
+    )
+    return groups, times, data
+
+
+def grouped_annual_arrays(parts, averaging_fn, baselines=None):
+    # averaging_fn over all of `parts` at once, with the index of each part
+    groups, times, data = stacked_parts(parts)
+    return averaging_fn(groups, utils.years(times), data, baselines)
+
+
+def grouped_annual_work(parts, averaging_fn, baselines=None):
+    """Annual values of several (times, data) pairs, averaged in one pass.
+
+    `baselines` is called by anomalies_averaging for the mean of each part's
+    data, so that it is only fetched for anomalies. Returns a (years, values)
+    pair of arrays for each of `parts`.
+    """
+    groups, years, values = grouped_annual_arrays(parts, averaging_fn, baselines)
+    # the results are sorted by group
+    splits = numpy.searchsorted(groups, numpy.arange(1, len(parts)))
+    return list(zip(numpy.split(years, splits), numpy.split(values, splits)))
+
+
+def unlimited_means(fetch_fns):
+    """The mean of the data given by each of `fetch_fns`, called without limits.
+
+    Anomalies are taken from these, so that they stay what they were when
+    the limits were applied after fetching: only the annual averages leave
+    out values outside the limits.
+    """
+    groups, _, data = stacked_parts([fetch_fn([]) for fetch_fn in fetch_fns])
+    (names,), means = utils.group_means([groups], data)
+    baselines = numpy.full(len(fetch_fns), numpy.nan)
+    baselines[names] = means
+    return baselines
+
+
 def do_annual_work(inlet_list, data_fn, averaging_fn, limit_fn):
     plt.clf()
-    for inlet, line_style in zip(inlet_list, INLET_LINES):
-        limits = limit_fn(inlet)
-        totals = {}
-        times, data = data_fn(inlet)
-        for time, datum in zip(times, data):
-            if len(limits) > 0 and not (limits[0] < datum < limits[1]):
-                continue
-            utils.update_totals(totals, time.year, datum)
-
-        averages = averaging_fn(totals, data)
-        years, values = zip(*sorted(averages.items(), key=lambda item: item[0]))
+    inlet_list = inlet_list[: len(INLET_LINES)]
+    averages = grouped_annual_work(
+        [data_fn(inlet, limit_fn(inlet)) for inlet in inlet_list],
+        averaging_fn,
+        lambda: unlimited_means(
+            [lambda limits, inlet=inlet: data_fn(inlet, limits) for inlet in inlet_list]
+        ),
+    )
+    for inlet, line_style, (years, values) in zip(inlet_list, INLET_LINES, averages):
         plt.plot(years, values, line_style, label=inlet.name)
 
     plt.legend()
@@ -415,15 +423,18 @@ def do_annual_work_parts(
         )
 
 
-def annual_averaging(totals, _data):
-    del _data
-    return {y: t / n for y, (t, n) in totals.items()}
+def annual_averaging(groups, years, data, _baselines=None):
+    # the mean of each group's data in each year, sorted by group and year
+    del _baselines
+    (groups, years), averages = utils.group_means([groups, years], data)
+    return groups, years, averages
 
 
-def anomalies_averaging(totals, data):
-    avg = sum(data) / len(data)
-    avgs = annual_averaging(totals, data)
-    return {y: a - avg for y, a in avgs.items()}
+def anomalies_averaging(groups, years, data, baselines):
+    # annual averages less the mean of all of the group's data, including
+    # values outside the limits
+    groups, years, avgs = annual_averaging(groups, years, data)
+    return groups, years, avgs - baselines()[groups]
 
 
 def chart_anomalies(
@@ -438,8 +449,8 @@ def chart_temperature_anomalies(inlet_list: List[inlets.Inlet], use_limits: bool
     print("Producing temperature anomaly plots")
     chart_anomalies(
         inlet_list,
-        lambda inlet: inlet.get_temperature_data(
-            inlets.Category.USED_DEEP, do_average=True, before=END
+        lambda inlet, limits: inlet.get_temperature_data(
+            inlets.Category.USED_DEEP, do_average=True, before=END, limits=limits
         ),
         "Temperature (C)",
         "Deep Water Temperature Anomalies",
@@ -449,8 +460,8 @@ def chart_temperature_anomalies(inlet_list: List[inlets.Inlet], use_limits: bool
     )
     chart_anomalies(
         inlet_list,
-        lambda inlet: inlet.get_temperature_data(
-            inlets.Category.USED_SURFACE, do_average=True, before=END
+        lambda inlet, limits: inlet.get_temperature_data(
+            inlets.Category.USED_SURFACE, do_average=True, before=END, limits=limits
         ),
         "Temperature (C)",
         "Surface Water Temperature Anomalies",
@@ -467,25 +478,28 @@ def do_annual_work_single(
     # category_dict (a dictionary)
     # averaging_fn: either annual_averaging() or anomalies_averaging()
     plt.clf()
-    for key, line_style in zip(
-            category_dict.keys(), INLET_LINES[:len(category_dict)]
-    ):
-        depth_limit, category = key, category_dict[key]
-        limits = limit_fn(inlet, depth_limit)
+    keys = list(category_dict.keys())[: len(INLET_LINES)]
+    parts = []
+    for key in keys:
+        limits = limit_fn(inlet, key)
         print('limits:', limits)
-        totals = {}
-        times, data = data_fn(inlet, category)
+        times, data = data_fn(inlet, category_dict[key], limits)
         print('times:', times)
         print('data:', data)
-
-        for time, datum in zip(times, data):
-            if len(limits) > 0 and not (limits[0] < datum < limits[1]):
-                continue
-            utils.update_totals(totals, time.year, datum)
-
-        averages = averaging_fn(totals, data)
-        print('averages:', averages)
-        years, values = zip(*sorted(averages.items(), key=lambda item: item[0]))
+        parts.append((times, data))
+
+    averages = grouped_annual_work(
+        parts,
+        averaging_fn,
+        lambda: unlimited_means(
+            [
+                lambda limits, key=key: data_fn(inlet, category_dict[key], limits)
+                for key in keys
+            ]
+        ),
+    )
+    for key, line_style, (years, values) in zip(keys, INLET_LINES, averages):
+        print('averages:', dict(zip(years.tolist(), values.tolist())))
 
         # Update label to depth bucket
         if key == 'surface':
@@ -512,8 +526,8 @@ def chart_temperature_anomalies_single(
     # Plot annual surface and deep anomalies on the same plot
     # for just a single inlet?
     print("Producing temperature anomaly plots for surface and deep")
-    data_fn_modified = lambda inlet, category: inlet.get_temperature_data(
-            category, do_average=True, before=END
+    data_fn_modified = lambda inlet, category, limits: inlet.get_temperature_data(
+            category, do_average=True, before=END, limits=limits
         )
     limit_fn_modified = lambda inlet, depth: inlet.limits["temperature"][
         depth] if use_limits and "temperature" in inlet.limits else []
@@ -549,8 +563,8 @@ def chart_salinity_anomalies(inlet_list: List[inlets.Inlet], use_limits: bool):
     print("Producing salinity anomaly plots")
     chart_anomalies(
         inlet_list,
-        lambda inlet: inlet.get_salinity_data(
-            inlets.Category.USED_DEEP, do_average=True, before=END
+        lambda inlet, limits: inlet.get_salinity_data(
+            inlets.Category.USED_DEEP, do_average=True, before=END, limits=limits
         ),
         "Salinity (PSU)",
         "Deep Water Salinity Anomalies",
@@ -560,8 +574,8 @@ def chart_salinity_anomalies(inlet_list: List[inlets.Inlet], use_limits: bool):
     )
     chart_anomalies(
         inlet_list,
-        lambda inlet: inlet.get_salinity_data(
-            inlets.Category.USED_SURFACE, do_average=True, before=END
+        lambda inlet, limits: inlet.get_salinity_data(
+            inlets.Category.USED_SURFACE, do_average=True, before=END, limits=limits
         ),
         "Salinity (PSU)",
         "Surface Water Salinity Anomalies",
@@ -575,8 +589,8 @@ def chart_oxygen_anomalies(inlet_list: List[inlets.Inlet], use_limits: bool):
     print("Producing oxygen anomaly plot")
     chart_anomalies(
         inlet_list,
-        lambda inlet: inlet.get_oxygen_data(
-            inlets.Category.USED_DEEP, do_average=True, before=END
+        lambda inlet, limits: inlet.get_oxygen_data(
+            inlets.Category.USED_DEEP, do_average=True, before=END, limits=limits
         ),
         "Oxygen (mL/L)",
         "Deep Water Dissolved Oxygen Anomalies",
@@ -586,8 +600,8 @@ def chart_oxygen_anomalies(inlet_list: List[inlets.Inlet], use_limits: bool):
     )
     chart_anomalies(
         inlet_list,
-        lambda inlet: inlet.get_oxygen_data(
-            inlets.Category.USED_SURFACE, do_average=True, before=END
+        lambda inlet, limits: inlet.get_oxygen_data(
+            inlets.Category.USED_SURFACE, do_average=True, before=END, limits=limits
         ),
         "Oxygen (mL/L)",
         "Surface Water Dissolved Oxygen Anomalies",
@@ -609,8 +623,8 @@ def chart_annual_temperature_averages(inlet_list: List[inlets.Inlet], use_limits
     print("Producing annual temperature plots")
     do_chart_annual_averages(
         inlet_list,
-        lambda inlet: inlet.get_temperature_data(
-            inlets.Category.USED_DEEP, do_average=True, before=END
+        lambda inlet, limits: inlet.get_temperature_data(
+            inlets.Category.USED_DEEP, do_average=True, before=END, limits=limits
         ),
         "Temperature (C)",
         "Deep Water Temperature Annual Averages",
@@ -620,8 +634,8 @@ def chart_annual_temperature_averages(inlet_list: List[inlets.Inlet], use_limits
     )
     do_chart_annual_averages(
         inlet_list,
-        lambda inlet: inlet.get_temperature_data(
-            inlets.Category.USED_SURFACE, do_average=True, before=END
+        lambda inlet, limits: inlet.get_temperature_data(
+            inlets.Category.USED_SURFACE, do_average=True, before=END, limits=limits
         ),
         "Temperature (C)",
         "Surface Water Temperature Annual Averages",
@@ -635,8 +649,8 @@ def chart_annual_temperature_averages_single(inlet_list: List[inlets.Inlet], use
     print("Producing annual temperature plots")
     y_label = "Temperature (C)"
 
-    data_fn_modified = lambda inlet, category: inlet.get_temperature_data(
-        category, do_average=True, before=END
+    data_fn_modified = lambda inlet, category, limits: inlet.get_temperature_data(
+        category, do_average=True, before=END, limits=limits
     )
     limit_fn_modified = lambda inlet, depth: inlet.limits["temperature"][
         depth] if use_limits and "temperature" in inlet.limits else []
@@ -657,8 +671,8 @@ def chart_annual_salinity_averages(inlet_list: List[inlets.Inlet], use_limits: b
     print("Producing annual salinity plots")
     do_chart_annual_averages(
         inlet_list,
-        lambda inlet: inlet.get_salinity_data(
-            inlets.Category.USED_DEEP, do_average=True, before=END
+        lambda inlet, limits: inlet.get_salinity_data(
+            inlets.Category.USED_DEEP, do_average=True, before=END, limits=limits
         ),
         "Salinity (PSU)",
         "Deep Water Salinity Annual Averages",
@@ -668,8 +682,8 @@ def chart_annual_salinity_averages(inlet_list: List[inlets.Inlet], use_limits: b
     )
     do_chart_annual_averages(
         inlet_list,
-        lambda inlet: inlet.get_salinity_data(
-            inlets.Category.USED_SURFACE, do_average=True, before=END
+        lambda inlet, limits: inlet.get_salinity_data(
+            inlets.Category.USED_SURFACE, do_average=True, before=END, limits=limits
         ),
         "Salinity (PSU)",
         "Surface Water Salinity Annual Averages",
@@ -683,8 +697,8 @@ def chart_annual_oxygen_averages(inlet_list: List[inlets.Inlet], use_limits: boo
     print("Producing annual oxygen plots")
     do_chart_annual_averages(
         inlet_list,
-        lambda inlet: inlet.get_oxygen_data(
-            inlets.Category.USED_DEEP, do_average=True, before=END
+        lambda inlet, limits: inlet.get_oxygen_data(
+            inlets.Category.USED_DEEP, do_average=True, before=END, limits=limits
         ),
         "Oxygen (mL/L)",
         "Deep Water Dissolved Oxygen Annual Averages",
@@ -694,8 +708,8 @@ def chart_annual_oxygen_averages(inlet_list: List[inlets.Inlet], use_limits: boo
     )
     do_chart_annual_averages(
         inlet_list,
-        lambda inlet: inlet.get_oxygen_data(
-            inlets.Category.USED_SURFACE, do_average=True, before=END
+        lambda inlet, limits: inlet.get_oxygen_data(
+            inlets.Category.USED_SURFACE, do_average=True, before=END, limits=limits
         ),
         "Oxygen (mL/L)",
         "Surface Water Dissolved Oxygen Annual Averages",
@@ -721,17 +735,15 @@ def apply_monthly_plot_formatting():
 def do_seasonal_averages_work(inlet, data_fn):
     plt.clf()
     times, data = data_fn(inlet)
-    plt.plot([time.month for time in times], data, "xg", label=f"Monthly Data")
+    plt.plot(utils.months(times), data, "xg", label=f"Monthly Data")
     apply_monthly_plot_formatting()
     plt.legend()
 
 
 def do_seasonal_frequency_work(inlet, data_fn):
     plt.clf()
-    data = []
     times, _ = data_fn(inlet)
-    for time in times:
-        data.append(time.month)
+    data = utils.months(times)
     plt.hist(
         data,
         bins=bins(1, 12),
@@ -744,64 +756,41 @@ def do_seasonal_frequency_work(inlet, data_fn):
 
 def do_seasonal_trend_comparison(inlet, data_fn, combine_years=False):
     plt.clf()
-    times, data = zip(*sorted(zip(*data_fn(inlet)), key=lambda x: x[0]))
+    times, data = data_fn(inlet)
+    order = numpy.argsort(times, kind="stable")
+    times, data = times[order], data[order]
     if combine_years:
-        times = [time.month for time in times]
+        times = utils.months(times)
     plt.plot(times, data, "xk", label=f"Monthly Data")
 
     if combine_years:
         indexed = times
-        even_spaced = even_times = list(range(1, 13))
+        even_spaced = even_times = numpy.arange(1, 13)
     else:
         indexed = utils.index_by_month(times)
-        even_spaced = []
-        even_times = []
-        years = [time.year for time in times]
-        for year in range(min(years), max(years) + 1):
-            even_spaced.extend(
-                [month + 1 + (12 * year - min(years)) for month in range(12)]
-            )
-            even_times.extend(
-                [datetime.date(year, month + 1, 1) for month in range(12)]
-            )
-
-    linear_fit = polynomial.Polynomial.fit(indexed, data, 1)
-    plt.plot(times, linear_fit(numpy.asarray(indexed)), label=f"Linear Fit")
-
-    mean = utils.mean(data)
-
-    def fit_sin(x, freq, amplitude, phase, offset):
-        return numpy.sin(x * freq + phase) * amplitude + offset
-
-    # period given in months
-    freq = lambda period: 1 / period
-    amp = (max(data) - min(data)) / 2
-
-    popt_sin12, _ = scipy.optimize.curve_fit(
-        fit_sin, indexed, data, p0=[freq(12), amp, 1, mean]
-    )
-    plt.plot(
-        even_times,
-        [fit_sin(x, *popt_sin12) for x in even_spaced],
-        label=f"12 Month Sine Fit",
-    )
-
-    popt_sin6, _ = scipy.optimize.curve_fit(
-        fit_sin, indexed, data, p0=[freq(6), amp, 1, mean]
-    )
-    plt.plot(
-        even_times,
-        [fit_sin(x, *popt_sin6) for x in even_spaced],
-        label=f"6 Month Sine Fit",
-    )
-
-    popt_sin3, _ = scipy.optimize.curve_fit(
-        fit_sin, indexed, data, p0=[freq(3), amp, 1, mean]
-    )
+        years = utils.years(times)
+        even_times = numpy.arange(
+            numpy.datetime64(f"{years.min():04}-01", "M"),
+            numpy.datetime64(f"{years.max() + 1:04}-01", "M"),
+        ).astype("datetime64[D]")
+        even_spaced = utils.index_by_month(even_times)
+
+    linear_fit = utils.fit_harmonics(indexed, data, periods=())
+    plt.plot(times, linear_fit(indexed), label=f"Linear Fit")
+
+    # the trend and every period are fitted together, then each period is
+    # drawn on top of the trend on its own
+    fit = utils.fit_harmonics(indexed, data, periods=(12, 6, 3))
+    for period in fit.periods:
+        plt.plot(
+            even_times,
+            fit(even_spaced, periods=(period,)),
+            label=f"{period} Month Harmonic",
+        )
     plt.plot(
         even_times,
-        [fit_sin(x, *popt_sin3) for x in even_spaced],
-        label=f"3 Month Sine Fit",
+        fit(even_spaced),
+        label=f"Harmonic Fit (residual SD {fit.residual_sd:.2f})",
     )
 
     if combine_years:
@@ -812,49 +801,37 @@ def do_seasonal_trend_comparison(inlet, data_fn, combine_years=False):
 
 def do_salinity_oxygen_compare(inlet, salinity_fn, oxygen_fn):
     plt.clf()
-    sal_times, sal_data = salinity_fn(inlet)
-    oxy_times, oxy_data = oxygen_fn(inlet)
+    times, salinity, oxygen = utils.join_by_time(salinity_fn(inlet), oxygen_fn(inlet))
+    months = utils.months(times)
 
     for m, style, name in zip(
         range(1, 13),
         ["xg", "xm", "xb", "xk", "xr", "xc", "+g", "+m", "+b", "+k", "+r", "+c"],
         ["JA", "FE", "MR", "AL", "MA", "JN", "JL", "AU", "SE", "OC", "NO", "DE"],
     ):
-        data = list(zip(
-            *[
-                [s, o]
-                for s_t, s in zip(sal_times, sal_data) for o_t, o in zip(oxy_times, oxy_data)
-                if s_t == o_t and s_t.month == m
-            ]
-        ))
-        if len(data) < 2:
+        inside = months == m
+        if not inside.any():
             continue
 
-        plt.plot(*data, style, label=name)
+        plt.plot(salinity[inside], oxygen[inside], style, label=name)
 
     plt.legend()
 
 
 def do_seasonal_salinity_oxygen_compare(inlet, salinity_fn, oxygen_fn):
     plt.clf()
-    sal_times, sal_data = salinity_fn(inlet)
-    oxy_times, oxy_data = oxygen_fn(inlet)
+    times, salinity, oxygen = utils.join_by_time(salinity_fn(inlet), oxygen_fn(inlet))
+    sal_months = utils.months(times)
 
     for (months, name), style in zip(
         inlet.get_seasons(),
         ["xg", "xm", "xb", "xk", "xr", "xc", "+g", "+m", "+b", "+k", "+r", "+c"],
     ):
-        data = list(zip(
-            *[
-                [s, o]
-                for s_t, s in zip(sal_times, sal_data) for o_t, o in zip(oxy_times, oxy_data)
-                if s_t == o_t and s_t.month in months
-            ]
-        ))
-        if len(data) < 2:
+        inside = numpy.isin(sal_months, months)
+        if not inside.any():
             continue
 
-        plt.plot(*data, style, label=name)
+        plt.plot(salinity[inside], oxygen[inside], style, label=name)
 
     plt.legend()
 
@@ -927,82 +904,83 @@ def chart_oxygen_seasonal_trends(inlet: inlets.Inlet):
 #############################
 
 
-def compute_decadal_average(times, data):
-    totals = {}
-    for time, datum in zip(times, data):
-        year = time.year
-        utils.update_totals(totals, year, datum)
-    new_data = annual_averaging(totals, [])
-
-    totals = {}
-    years = {}
-    for year, datum in new_data.items():
-        decade = year // 10
-        utils.update_totals(totals, decade, datum)
-        utils.update_totals(years, decade, year)
-    averages = annual_averaging(totals, [])
-    years = annual_averaging(years, [])
-
-    return zip(
-        *[
-            (utils.date_from_float(years[decade]), averages[decade])
-            for decade in averages.keys()
-        ]
-    )
-
-
-def do_decadal_anomaly_work(inlet, data_fn, use_seasons=False):
-    plt.clf()
-    times, data = data_fn(inlet)
-
-    # plot bare data along side decadal averages
-    if use_seasons:
-        means = {}
-        seasons = {}
-        for season, name in inlet.get_seasons():
-            seasons[name] = season
-            means[name] = utils.mean([datum for time, datum in zip(times, data) if time.month in season])
-        removed_trend = [
-            datum - means[name]
-            for time, datum in zip(times, data) for name in means.keys()
-            if time.month in seasons[name]
-        ]
-    else:
-        removed_trend = utils.remove_seasonal_trend(
-            times, data, utils.Trend.NONE, remove_sd=False
+def grouped_decadal_work(parts):
+    """Decadal averages of the annual averages of several (times, data) pairs.
+
+    Every pair is averaged in the same pass. Returns a (dates, averages) pair
+    of arrays for each of `parts`, dated at the mean of each decade's years.
+    """
+    groups, years, annual = grouped_annual_arrays(parts, annual_averaging)
+    keys = [groups, years // 10]
+    _, mean_years = utils.group_means(keys, years)
+    (groups, _), averages = utils.group_means(keys, annual)
+    # the results are sorted by group
+    splits = numpy.searchsorted(groups, numpy.arange(1, len(parts)))
+    return list(
+        zip(
+            numpy.split(utils.dates_from_floats(mean_years), splits),
+            numpy.split(averages, splits),
         )
-    plt.plot(times, removed_trend, "xg", label=f"Monthly Anomalies")
+    )
 
-    # plot trend of anomalies across decades
-    x, y = compute_decadal_average(times, removed_trend)
-    plt.plot(x, y, "^b", label=f"Decadal Anomalies")
 
-    plt.legend()
+def compute_decadal_average(times, data):
+    return grouped_decadal_work([(times, data)])[0]
 
 
-def do_decadal_averages_work(inlet, data_fn):
-    plt.clf()
-    times, data = data_fn(inlet)
+def monthly_anomalies(inlet, times, data, use_seasons=False):
+    """The anomalies of `data`, with the times they are at.
 
-    # plot bare data along side decadal averages
-    plt.plot(times, data, "xg", label=f"Monthly Averages")
+    With `use_seasons`, they are taken from the mean of each of the inlet's
+    seasons, leaving out months in none of them.
+    """
+    if use_seasons:
+        # the index of each month's season, or -1 for months in none of them
+        season_of = numpy.full(13, -1)
+        for index, (season, _) in enumerate(inlet.get_seasons()):
+            season_of[season] = index
+        seasons = season_of[utils.months(times)]
+        inside = seasons >= 0
+        times, seasons = numpy.asarray(times)[inside], seasons[inside]
+        data = numpy.asarray(data, dtype=float)[inside]
+        (names,), means = utils.group_means([seasons], data)
+        return times, data - means[numpy.searchsorted(names, seasons)]
+    return times, utils.remove_seasonal_trend(
+        times, data, utils.Trend.NONE, remove_sd=False
+    )
+
+
+def do_decadal_work(inlet, data_fn):
+    """The data of `data_fn` and its anomalies, each with its decadal averages.
+
+    The data is only fetched once, and both are averaged per decade in the
+    same pass. Returns ((times, values), (dates, averages)) for the data and
+    then for the anomalies.
+    """
+    times, data = data_fn(inlet)
+    parts = [(times, data), monthly_anomalies(inlet, times, data)]
+    return list(zip(parts, grouped_decadal_work(parts)))
 
-    # plot trend of anomalies across decades
-    x, y = compute_decadal_average(times, data)
-    plt.plot(x, y, "^b", label=f"Decadal Averages")
 
+def plot_decadal_work(work, label):
+    (times, values), (dates, averages) = work
+    plt.clf()
+    # plot bare data along side decadal averages
+    plt.plot(times, values, "xg", label=f"Monthly {label}")
+    plt.plot(dates, averages, "^b", label=f"Decadal {label}")
     plt.legend()
 
 
 def chart_temperature_decade(inlet: inlets.Inlet):
     print(f"Producing temperature decade trend plots for {inlet.name}")
     bounds = inlet.deep_bounds
-    do_decadal_averages_work(
+    averages, anomalies = do_decadal_work(
         inlet,
         lambda inlet: inlet.get_temperature_data(
             inlets.Category.DEEP, do_average=True, before=END
         ),
     )
+    plot_decadal_work(averages, "Averages")
     plt.ylabel("Temperature (C)")
     plt.title(
         f"{inlet.name} {utils.label_from_bounds(*bounds)} Temperature - Decade Averages"
@@ -1010,12 +988,7 @@ def chart_temperature_decade(inlet: inlets.Inlet):
     plt.savefig(
         figure_path(f"{utils.normalize(inlet.name)}-temperature-decade-averages.png")
     )
-    do_decadal_anomaly_work(
-        inlet,
-        lambda inlet: inlet.get_temperature_data(
-            inlets.Category.DEEP, do_average=True, before=END
-        ),
-    )
+    plot_decadal_work(anomalies, "Anomalies")
     plt.ylabel("Temperature (C)")
     plt.title(
         f"{inlet.name} {utils.label_from_bounds(*bounds)} Temperature - Decade Anomalies"
@@ -1028,12 +1001,13 @@ def chart_temperature_decade(inlet: inlets.Inlet):
 def chart_salinity_decade(inlet: inlets.Inlet):
     print(f"Producing salinity decade trend plot for {inlet.name}")
     bounds = inlet.deep_bounds
-    do_decadal_averages_work(
+    averages, anomalies = do_decadal_work(
         inlet,
         lambda inlet: inlet.get_salinity_data(
             inlets.Category.DEEP, do_average=True, before=END
         ),
     )
+    plot_decadal_work(averages, "Averages")
     plt.ylabel("Salinity (PSU)")
     plt.title(
         f"{inlet.name} {utils.label_from_bounds(*bounds)} Salinity - Decade Averages"
@@ -1041,12 +1015,7 @@ def chart_salinity_decade(inlet: inlets.Inlet):
     plt.savefig(
         figure_path(f"{utils.normalize(inlet.name)}-salinity-decade-averages.png")
     )
-    do_decadal_anomaly_work(
-        inlet,
-        lambda inlet: inlet.get_salinity_data(
-            inlets.Category.DEEP, do_average=True, before=END
-        ),
-    )
+    plot_decadal_work(anomalies, "Anomalies")
     plt.ylabel("Salinity (PSU)")
     plt.title(
         f"{inlet.name} {utils.label_from_bounds(*bounds)} Salinity - Decade Anomalies"
@@ -1059,12 +1028,13 @@ def chart_salinity_decade(inlet: inlets.Inlet):
 def chart_oxygen_decade(inlet: inlets.Inlet):
     print(f"Producing oxygen decade trend plot for {inlet.name}")
     bounds = inlet.deep_bounds
-    do_decadal_averages_work(
+    averages, anomalies = do_decadal_work(
         inlet,
         lambda inlet: inlet.get_oxygen_data(
             inlets.Category.DEEP, do_average=True, before=END
         ),
     )
+    plot_decadal_work(averages, "Averages")
     plt.ylabel("Dissolved Oxygen (mL/L)")
     plt.title(
         f"{inlet.name} {utils.label_from_bounds(*bounds)} Dissolved Oxygen - Decade Averages"
@@ -1072,12 +1042,7 @@ def chart_oxygen_decade(inlet: inlets.Inlet):
     plt.savefig(
         figure_path(f"{utils.normalize(inlet.name)}-oxygen-decade-averages.png")
     )
-    do_decadal_anomaly_work(
-        inlet,
-        lambda inlet: inlet.get_oxygen_data(
-            inlets.Category.DEEP, do_average=True, before=END
-        ),
-    )
+    plot_decadal_work(anomalies, "Anomalies")
     plt.ylabel("Dissolved Oxygen (mL/L)")
     plt.title(
         f"{inlet.name} {utils.label_from_bounds(*bounds)} Dissolved Oxygen - Decade Anomalies"
@@ -1090,12 +1055,12 @@ def chart_oxygen_decade(inlet: inlets.Inlet):
 def chart_oxygen_decade_seasonal(inlet: inlets.Inlet):
     print(f"Producing oxygen decade trend plot for {inlet.name} accounting for seasonality")
     bounds = inlet.deep_bounds
-    do_decadal_anomaly_work(
-        inlet,
-        lambda inlet:inlet.get_oxygen_data(
-            inlets.Category.DEEP, do_average=True, before=END
-        ),
-        use_seasons=True,
+    times, data = inlet.get_oxygen_data(
+        inlets.Category.DEEP, do_average=True, before=END
+    )
+    times, anomalies = monthly_anomalies(inlet, times, data, use_seasons=True)
+    plot_decadal_work(
+        ((times, anomalies), compute_decadal_average(times, anomalies)), "Anomalies"
     )
     plt.ylabel("Dissolved Oxygen (mL/L)")
     plt.title(
@@ -1127,46 +1092,19 @@ def chart_monthly_sample(inlet: inlets.Inlet):
         "November",
         "December",
     ]
-    files = {
-        "January": {},
-        "February": {},
-        "March": {},
-        "April": {},
-        "May": {},
-        "June": {},
-        "July": {},
-        "August": {},
-        "September": {},
-        "October": {},
-        "November": {},
-        "December": {},
-    }
     min_year = END.year
     max_year = 0
-    for datum in itertools.chain(
-        inlet.data.get_temperature_data((None, None)),
-        inlet.data.get_salinity_data((None, None)),
-        inlet.data.get_oxygen_data((None, None)),
-    ):
-        year = datum.time.year
-        # InletData object doesn't expose date filtering so we do it here
-        if year > END.year:
-            continue
+    # count sources up to and including the current year
+    counts = inlet.data.get_source_counts(before=datetime.date(END.year + 1, 1, 1))
+    for year, month in counts.keys():
         min_year = min(year, min_year)
         max_year = max(year, max_year)
-        month = months[datum.time.month]
-        if year not in files[month]:
-            files[month][year] = set()
-        files[month][year].add(datum.source)
     year_range = max_year - min_year + 1
     values = []
     for _ in range(year_range):
         values.append([0] * 12)
-    for month, d in files.items():
-        for year, filenames in d.items():
-            year_idx = year - min_year
-            month_idx = months.index(month) - 1
-            values[year_idx][month_idx] += len(filenames)
+    for (year, month), sources in counts.items():
+        values[year - min_year][month - 1] += sources
     biggest = 0
     for row in values:
         biggest = max(biggest, *row)
@@ -1208,6 +1146,113 @@ def chart_monthly_sample(inlet: inlets.Inlet):
     plt.axis("auto")
 
 
+#############
+# Trend table
+#############
+
+TREND_KINDS = ("temperature", "salinity", "oxygen")
+TREND_CATEGORIES = (
+    inlets.Category.SURFACE,
+    inlets.Category.SHALLOW,
+    inlets.Category.USED_SURFACE,
+    inlets.Category.DEEP,
+    inlets.Category.DEEPER,
+    inlets.Category.DEEPEST,
+    inlets.Category.USED_DEEP,
+)
+DEEP_CATEGORIES = (
+    inlets.Category.DEEP,
+    inlets.Category.DEEPER,
+    inlets.Category.DEEPEST,
+    inlets.Category.USED_DEEP,
+)
+
+
+def trend_table(
+    inlet_list: List[inlets.Inlet], use_limits: bool, confidence: float = 0.95
+) -> Dict[str, numpy.ndarray]:
+    """Linear trend of the monthly means of every inlet, kind and bucket.
+
+    Slopes are per year, and `lower` and `upper` bound them at `confidence`.
+    Every series is fitted at once, on a month axis shared by all of them.
+    Buckets without data are left out.
+    """
+    labels = []
+    months = []
+    values = []
+    for inlet in inlet_list:
+        for kind in TREND_KINDS:
+            for category in TREND_CATEGORIES:
+                water = "deep" if category in DEEP_CATEGORIES else "surface"
+                times, data = getattr(inlet, f"get_{kind}_data")(
+                    category,
+                    before=END,
+                    do_average=True,
+                    limits=inlet.limits[kind][water]
+                    if use_limits and kind in inlet.limits
+                    else None,
+                )
+                if len(times) == 0:
+                    continue
+                labels.append((inlet, kind, category))
+                months.append(numpy.asarray(times, dtype="datetime64[M]").astype(int))
+                values.append(data)
+    # one row per series, with NaN for months without data
+    rows = numpy.repeat(numpy.arange(len(labels)), [len(part) for part in months])
+    months = numpy.concatenate([numpy.zeros(0, dtype=int), *months])
+    # the axis runs from the first month with data to the last
+    first, last = (months.min(), months.max()) if len(months) > 0 else (0, 0)
+    series = numpy.full((len(labels), last - first + 1), numpy.nan)
+    series[rows, months - first] = numpy.concatenate([numpy.zeros(0), *values])
+    fit = utils.fit_harmonics(numpy.arange(series.shape[-1]), series, periods=())
+    lower, upper = fit.interval(confidence)
+    present = ~numpy.isnan(series)
+    starts = first + present.argmax(axis=-1)
+    ends = first + series.shape[-1] - 1 - present[:, ::-1].argmax(axis=-1)
+    bounds = numpy.array(
+        [inlet.get_bounds(category) for inlet, _, category in labels], dtype=float
+    ).reshape(-1, 2)
+    return {
+        "inlet": numpy.array([inlet.name for inlet, _, _ in labels], dtype=object),
+        "area": numpy.array([inlet.area for inlet, _, _ in labels], dtype=object),
+        "kind": numpy.array([kind for _, kind, _ in labels], dtype=object),
+        "category": numpy.array(
+            [category.name.lower() for _, _, category in labels], dtype=object
+        ),
+        "min_depth": bounds[:, 0],
+        "max_depth": bounds[:, 1],
+        "start": starts.astype("datetime64[M]").astype("datetime64[D]"),
+        "end": ends.astype("datetime64[M]").astype("datetime64[D]"),
+        "months": fit.samples,
+        # fitted per month
+        "slope": fit.slope * 12,
+        "stderr": fit.stderr[:, 1] * 12,
+        "lower": lower[:, 1] * 12,
+        "upper": upper[:, 1] * 12,
+    }
+
+
+def write_trend_table(inlet_list: List[inlets.Inlet], path: str, use_limits: bool):
+    """Write trend_table to `path`, as Parquet for a .parquet path or else CSV."""
+    print(f"Writing trends to {path}")
+    table = trend_table(inlet_list, use_limits)
+    if path.endswith(".parquet"):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as e:
+            raise ImportError(
+                "Writing trends to Parquet needs pyarrow; install it with `poetry install -E parquet`"
+            ) from e
+
+        pyarrow.parquet.write_table(pyarrow.table(table), path)
+        return
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(table.keys())
+        writer.writerows(zip(*(column.tolist() for column in table.values())))
+
+
 def main_all():
     parser = argparse.ArgumentParser()
     # inlet retrieval args
@@ -1216,6 +1261,7 @@ def main_all():
     parser.add_argument("-e", "--from-erddap", action="store_true")
     parser.add_argument("-c", "--from-csv", action="store_true")
     parser.add_argument("-d", "--data", type=str, nargs="?", default="data")
+    parser.add_argument("--store", choices=inlet_data.STORES, default="sqlite")
     # plot args
     parser.add_argument("-l", "--no-limits", action="store_true")
     parser.add_argument("-i", "--inlet-name", type=str, nargs="+", default=[])
@@ -1231,6 +1277,8 @@ def main_all():
         "-g", "--geojson", type=str, nargs="?", default="inlets.geojson"
     )
     parser.add_argument("--plot-all", action="store_true")
+    parser.add_argument("-T", "--trend-table", type=str, default=None)
+    parser.add_argument("-v", "--cache-stats", action="store_true")
     args = parser.parse_args()
     inlet_list = inlets.get_inlets(
         args.data,
@@ -1242,6 +1290,7 @@ def main_all():
         drop_names=args.remove_inlet_name,
         keep_names=args.limit_name,
         geojson_file=args.geojson,
+        store=args.store,
     )
     plt.figure(figsize=(8, 6))
     if args.plot_all:
@@ -1374,7 +1423,11 @@ def main_all():
             chart_oxygen_decade(inlet)
             chart_oxygen_seasonal_trends(inlet)
             chart_oxygen_decade_seasonal(inlet)
+    if args.trend_table is not None:
+        write_trend_table(inlet_list, args.trend_table, not args.no_limits)
     plt.close()
+    if args.cache_stats:
+        print_cache_stats(inlet_list)
 
 
 def main():
@@ -1385,6 +1438,7 @@ def main():
     parser.add_argument("-e", "--from-erddap", action="store_true")
     parser.add_argument("-c", "--from-csv", action="store_true")
     parser.add_argument("-d", "--data", type=str, nargs="?", default="data")
+    parser.add_argument("--store", choices=inlet_data.STORES, default="sqlite")
     # plot args
     parser.add_argument("-l", "--no-limits", action="store_true")
     parser.add_argument("-i", "--inlet-name", type=str, nargs="+", default=[])
@@ -1400,6 +1454,8 @@ def main():
         "-g", "--geojson", type=str, nargs="?", default="burke_inlet.geojson"
     )
     parser.add_argument("--plot-all", action="store_true")
+    parser.add_argument("-T", "--trend-table", type=str, default=None)
+    parser.add_argument("-v", "--cache-stats", action="store_true")
     args = parser.parse_args()
     osd_data_dir = '/usb/OSD_Data_Archive/'  # Access cruise and netCDF data
     hakai_data_dir = '/home/hourstonh/Documents/inlets/hakai_data/'
@@ -1413,6 +1469,7 @@ def main():
         drop_names=args.remove_inlet_name,
         keep_names=args.limit_name,
         geojson_file=args.geojson,
+        store=args.store,
     )
     # inlet_list = inlets.get_burke_inlet(
     #     osd_data_dir, hakai_data_dir,
@@ -1475,7 +1532,11 @@ def main():
                 chart_temperatures_surface_deep,
                 True,
             )
+    if args.trend_table is not None:
+        write_trend_table(inlet_list, args.trend_table, not args.no_limits)
     plt.close()
+    if args.cache_stats:
+        print_cache_stats(inlet_list)
 
 
 if __name__ == "__main__":
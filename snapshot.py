@@ -0,0 +1,196 @@
+from inlet_data import DEFAULT_COLUMNS, InletDb
+import json
+import numpy
+import os
+import shutil
+from typing import Dict, Optional, Sequence, Tuple
+import utils
+
+
+SNAPSHOT_ROOT = "inlet_data.snapshots"
+KINDS = ("temperature", "salinity", "oxygen")
+# sources are stored as indices into the list of sources kept in meta.json
+SNAPSHOT_COLUMNS = (
+    "time",
+    "depth",
+    "value",
+    "quality",
+    "computed",
+    "assumed_density",
+    "source",
+)
+
+
+def export_snapshot(db: InletDb, root: str = SNAPSHOT_ROOT):
+    """Write every column of one inlet as .npy files, one set per kind.
+
+    Rows are sorted by time. The snapshot is stamped with the identity and
+    generation of the inlet it was read from, and is only used while both
+    still match, so a cleared or rebuilt inlet which reaches the same
+    generation again does not take it.
+    """
+    path = os.path.join(root, db.name)
+    partial = f"{path}.partial"
+    if os.path.isdir(partial):
+        shutil.rmtree(partial)
+    os.makedirs(partial)
+    # read before the data, so a write during the export leaves it stale
+    meta = {"identity": db.identity, "generation": db.generation, "sources": {}}
+    for kind in KINDS:
+        columns = db.get_columns(kind, (None, None), columns=SNAPSHOT_COLUMNS)
+        order = numpy.argsort(columns["time"], kind="stable")
+        sources, codes = numpy.unique(columns["source"], return_inverse=True)
+        meta["sources"][kind] = sources.tolist()
+        columns["source"] = codes.astype(numpy.int32)
+        for column in SNAPSHOT_COLUMNS:
+            numpy.save(
+                os.path.join(partial, f"{kind}.{column}.npy"), columns[column][order]
+            )
+    with open(os.path.join(partial, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(partial, path)
+
+
+class SnapshotDb:
+    """InletDb that answers column queries from memory mapped snapshots.
+
+    The .npy files written by export_snapshot are opened with mmap, so only
+    the pages a query touches are read, and they are shared with any other
+    process reading the same snapshot. Once the database has been written
+    since the export, every query goes to the database instead. Anything
+    other than get_columns and get_monthly_means is passed through.
+    """
+
+    def __init__(self, db: InletDb, root: str = SNAPSHOT_ROOT):
+        self.db = db
+        self.path = os.path.join(root, db.name)
+        self.meta = None
+        self.columns = {}
+        meta_file = os.path.join(self.path, "meta.json")
+        if os.path.isfile(meta_file):
+            with open(meta_file) as f:
+                self.meta = json.load(f)
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+    def is_fresh(self) -> bool:
+        # snapshots written before identities were stamped have none
+        return (
+            self.meta is not None
+            and self.meta.get("identity") == self.db.identity
+            and self.meta["generation"] == self.db.generation
+        )
+
+    def get_columns(
+        self,
+        kind: str,
+        bucket: Tuple[float, float],
+        columns: Sequence[str] = DEFAULT_COLUMNS,
+        average: bool = False,
+        before=None,
+        exclude_qualities: Sequence[int] = (),
+        value_bounds: Optional[Tuple[float, float]] = None,
+    ) -> Dict[str, numpy.ndarray]:
+        """Same as InletDb.get_columns, read from the snapshot when it is fresh."""
+        if not self.is_fresh() or any(
+            column not in SNAPSHOT_COLUMNS for column in columns
+        ):
+            return self.db.get_columns(
+                kind,
+                bucket,
+                columns=columns,
+                average=average,
+                before=before,
+                exclude_qualities=exclude_qualities,
+                value_bounds=value_bounds,
+            )
+        data = self.__select(kind, bucket, before, exclude_qualities, value_bounds)
+        sources = numpy.array(self.meta["sources"][kind], dtype=object)
+        if average:
+            (codes, days), means = utils.group_means(
+                [data["source"], data["time"].astype("datetime64[D]")], data["value"]
+            )
+            return {
+                column: days.astype("datetime64[us]")
+                if column == "time"
+                else means
+                if column == "value"
+                else sources[codes]
+                if column == "source"
+                else numpy.zeros(len(means), dtype=data[column].dtype)
+                for column in columns
+            }
+        return {
+            column: sources[data[column]] if column == "source" else data[column]
+            for column in columns
+        }
+
+    def get_monthly_means(
+        self,
+        kind: str,
+        bucket: Tuple[float, float],
+        before=None,
+        exclude_qualities: Sequence[int] = (),
+        value_bounds: Optional[Tuple[float, float]] = None,
+    ) -> Dict[str, numpy.ndarray]:
+        """Same as InletDb.get_monthly_means, read from the snapshot when it is fresh."""
+        if not self.is_fresh():
+            return self.db.get_monthly_means(
+                kind,
+                bucket,
+                before=before,
+                exclude_qualities=exclude_qualities,
+                value_bounds=value_bounds,
+            )
+        data = self.__select(kind, bucket, before, exclude_qualities)
+        (_, days), daily = utils.group_means(
+            [data["source"], data["time"].astype("datetime64[D]")], data["value"]
+        )
+        (months,), monthly = utils.group_means([days.astype("datetime64[M]")], daily)
+        if value_bounds is not None:
+            inside = (monthly > value_bounds[0]) & (monthly < value_bounds[1])
+            months, monthly = months[inside], monthly[inside]
+        return {"time": months.astype("datetime64[D]"), "value": monthly}
+
+    def __load(self, kind: str) -> Dict[str, numpy.ndarray]:
+        if kind not in self.columns:
+            self.columns[kind] = {
+                column: numpy.load(
+                    os.path.join(self.path, f"{kind}.{column}.npy"), mmap_mode="r"
+                )
+                for column in SNAPSHOT_COLUMNS
+            }
+        return self.columns[kind]
+
+    def __select(
+        self,
+        kind: str,
+        bucket: Tuple[float, float],
+        before=None,
+        exclude_qualities: Sequence[int] = (),
+        value_bounds: Optional[Tuple[float, float]] = None,
+    ) -> Dict[str, numpy.ndarray]:
+        columns = self.__load(kind)
+        end = len(columns["time"])
+        if before is not None:
+            # rows are sorted by time, so years from before.year on are a suffix
+            end = numpy.searchsorted(
+                columns["time"], numpy.datetime64(f"{before.year:04}-01-01", "us")
+            )
+        columns = {column: values[:end] for column, values in columns.items()}
+        min_depth, max_depth = bucket
+        keep = numpy.ones(end, dtype=bool)
+        if min_depth is not None:
+            keep &= columns["depth"] >= min_depth
+        if max_depth is not None:
+            keep &= columns["depth"] <= max_depth
+        if len(exclude_qualities) > 0:
+            keep &= ~numpy.isin(columns["quality"], exclude_qualities)
+        if value_bounds is not None:
+            keep &= (columns["value"] > value_bounds[0]) & (
+                columns["value"] < value_bounds[1]
+            )
+        return {column: values[keep] for column, values in columns.items()}
@@ -0,0 +1,658 @@
+from .context import inlets
+from dataclasses import replace
+import datetime
+import numpy
+import os
+import pytest
+
+import dbtool
+import inlet_data
+
+
+DB_NAME = ":memory:"
+
+
+def make_datum(time, depth, value, source="a.ctd", quality=1):
+    return inlet_data.InletData(
+        time=time,
+        depth=depth,
+        value=value,
+        quality=quality,
+        longitude=-124.5,
+        latitude=48.5,
+        source=source,
+    )
+
+
+SAMPLE_DATA = [
+    make_datum(datetime.datetime(1990, 1, 5, 3), 10, 1.0),
+    make_datum(datetime.datetime(1990, 1, 5, 9), 20, 3.0),
+    make_datum(datetime.datetime(1990, 1, 6, 12), 200, 5.0, quality=3),
+    make_datum(
+        datetime.datetime(1990, 2, 1, 23, tzinfo=datetime.timezone.utc),
+        300,
+        7.0,
+        source="b.bot",
+    ),
+]
+
+
+@pytest.mark.parametrize(
+    "bucket,expected",
+    [
+        ((None, None), [1.0, 3.0, 5.0, 7.0]),
+        ((None, 20), [1.0, 3.0]),
+        ((200, None), [5.0, 7.0]),
+        ((20, 200), [3.0, 5.0]),
+    ],
+)
+def test_get_columns_bucket(bucket, expected):
+    db = inlet_data.InletDb("Test Inlet", db_name=DB_NAME)
+    db.add_temperature_data(SAMPLE_DATA)
+    columns = db.get_columns("temperature", bucket)
+    assert sorted(columns["value"].tolist()) == expected
+
+
+def test_get_columns_matches_rows():
+    db = inlet_data.InletDb("Test Inlet", db_name=DB_NAME)
+    db.add_salinity_data(SAMPLE_DATA)
+    columns = db.get_columns(
+        "salinity", (None, None), columns=list(inlet_data.COLUMN_TYPES.keys())
+    )
+    rows = db.get_salinity_data((None, None))
+    assert len(rows) == len(columns["time"])
+    assert columns["time"].dtype == numpy.dtype("datetime64[us]")
+    for row, time, depth, quality in zip(
+        rows, columns["time"], columns["depth"], columns["quality"]
+    ):
+        assert time == numpy.datetime64(row.time.replace(tzinfo=None))
+        assert depth == row.depth
+        assert quality == row.quality
+
+
+def test_get_columns_average():
+    db = inlet_data.InletDb("Test Inlet", db_name=DB_NAME)
+    db.add_oxygen_data(SAMPLE_DATA)
+    columns = db.get_columns("oxygen", (None, None), average=True)
+    averages = {
+        str(time.astype("datetime64[D]")): value
+        for time, value in zip(columns["time"], columns["value"])
+    }
+    assert averages == {"1990-01-05": 2.0, "1990-01-06": 5.0, "1990-02-01": 7.0}
+
+
+def test_get_data_average():
+    db = inlet_data.InletDb("Test Inlet", db_name=DB_NAME)
+    db.add_temperature_data(SAMPLE_DATA)
+    averages = {
+        (datum.source, datum.time): datum.value
+        for datum in db.get_temperature_data((None, None), average=True)
+    }
+    assert averages == {
+        ("a.ctd", datetime.date(1990, 1, 5)): 2.0,
+        ("a.ctd", datetime.date(1990, 1, 6)): 5.0,
+        ("b.bot", datetime.date(1990, 2, 1)): 7.0,
+    }
+
+
+@pytest.mark.parametrize(
+    "before,exclude_qualities,expected",
+    [
+        (None, (), {"1990-01-01": 3.5, "1990-02-01": 7.0}),
+        (None, (3,), {"1990-01-01": 2.0, "1990-02-01": 7.0}),
+        (datetime.datetime(1990, 6, 1), (), {}),
+        (datetime.datetime(1991, 6, 1), (3,), {"1990-01-01": 2.0, "1990-02-01": 7.0}),
+    ],
+)
+def test_get_monthly_means(before, exclude_qualities, expected):
+    db = inlet_data.InletDb("Test Inlet", db_name=DB_NAME)
+    db.add_temperature_data(SAMPLE_DATA)
+    means = db.get_monthly_means(
+        "temperature", (None, None), before=before, exclude_qualities=exclude_qualities
+    )
+    assert {str(t): v for t, v in zip(means["time"], means["value"])} == expected
+
+
+@pytest.mark.parametrize(
+    "value_bounds,expected_rows,expected_months",
+    [
+        (None, [1.0, 3.0, 5.0, 7.0], [3.5, 7.0]),
+        ((0, 6), [1.0, 3.0, 5.0], [3.5]),
+        ((2, 8), [3.0, 5.0, 7.0], [3.5, 7.0]),
+        ((4, 7), [5.0], []),
+    ],
+)
+def test_value_bounds(value_bounds, expected_rows, expected_months):
+    db = inlet_data.InletDb("Test Inlet", db_name=DB_NAME)
+    db.add_temperature_data(SAMPLE_DATA)
+    rows = db.get_columns("temperature", (None, None), value_bounds=value_bounds)
+    assert sorted(rows["value"].tolist()) == expected_rows
+    # bounds on monthly means apply after averaging, like the charts did
+    months = db.get_monthly_means(
+        "temperature", (None, None), value_bounds=value_bounds
+    )
+    assert months["value"].tolist() == expected_months
+
+
+def test_summary_tracks_inserts():
+    db = inlet_data.InletDb("Test Inlet", db_name=DB_NAME)
+    assert not db.has_data("oxygen")
+    db.add_oxygen_data(SAMPLE_DATA)
+    db.add_temperature_data(SAMPLE_DATA[:1])
+    assert db.has_data("oxygen")
+    assert not db.has_data("salinity")
+    assert db.get_source_counts() == {(1990, 1): 1, (1990, 2): 1}
+    assert db.get_sources() == {1990: {"a.ctd", "b.bot"}}
+    assert db.get_sources(by_month=True) == {1: {"a.ctd"}, 2: {"b.bot"}}
+    assert db.get_sources(before=datetime.datetime(1990, 1, 1)) == {}
+
+
+def test_summary_filled_for_existing_table(tmp_path):
+    db_name = str(tmp_path / "inlet_data.db")
+    db = inlet_data.InletDb("Test Inlet", db_name=db_name)
+    db.add_salinity_data(SAMPLE_DATA)
+    with db.connection:
+        db.connection.execute(f"drop table {db.summary}")
+    del db
+    db = inlet_data.InletDb("Test Inlet", db_name=db_name)
+    assert db.get_source_counts() == {(1990, 1): 1, (1990, 2): 1}
+
+
+def test_catalog(tmp_path):
+    db_name = str(tmp_path / "inlet_data.db")
+    db = inlet_data.InletDb("Test Inlet", db_name=db_name)
+    db.add_temperature_data(SAMPLE_DATA)
+    db.add_salinity_data(
+        [make_datum(datetime.datetime(1991, 3, 1), 5, 30.0, source="c.CTD.nc")]
+    )
+    expected = [
+        inlet_data.CatalogEntry(
+            source="a.ctd",
+            instrument="ctd",
+            latitude=48.5,
+            longitude=-124.5,
+            start_time=datetime.datetime(1990, 1, 5, 3),
+            end_time=datetime.datetime(1990, 1, 6, 12),
+            min_depth=10,
+            max_depth=200,
+            samples=3,
+        ),
+        inlet_data.CatalogEntry(
+            source="b.bot",
+            instrument="bot",
+            latitude=48.5,
+            longitude=-124.5,
+            start_time=datetime.datetime(1990, 2, 1, 23),
+            end_time=datetime.datetime(1990, 2, 1, 23),
+            min_depth=300,
+            max_depth=300,
+            samples=1,
+        ),
+    ]
+    assert db.get_catalog(before=datetime.datetime(1991, 1, 1)) == expected
+    assert db.get_catalog()[-1].instrument == "ctd"
+    assert db.get_sources() == {1990: {"a.ctd", "b.bot"}, 1991: {"c.CTD.nc"}}
+    # filled in for a table written before there was a catalog
+    with db.connection:
+        db.connection.execute(f"drop table {db.catalog}")
+    del db
+    db = inlet_data.InletDb("Test Inlet", db_name=db_name)
+    assert db.get_catalog(before=datetime.datetime(1991, 1, 1)) == expected
+
+
+def test_catalog_counts_rows_written_again(tmp_path):
+    db_name = str(tmp_path / "inlet_data.db")
+    db = inlet_data.InletDb("Test Inlet", db_name=db_name)
+    db.add_temperature_data(SAMPLE_DATA)
+    db.add_temperature_data(SAMPLE_DATA[:2])
+    db.add_temperature_value(SAMPLE_DATA[0])
+    db.add_salinity_data(SAMPLE_DATA[:1])
+    assert [entry.samples for entry in db.get_catalog()] == [4, 1]
+    copy_name = str(tmp_path / "copy.db")
+    copy = inlet_data.InletDb("Test Inlet", db_name=copy_name)
+    copy.add_temperature_data(SAMPLE_DATA[:1])
+    copy.merge_from(db_name)
+    assert copy.get_catalog() == db.get_catalog()
+    # no trigger writes to the catalog on every row
+    cursor = db.connection.execute(
+        "select name from sqlite_master where type='trigger' and tbl_name=:name",
+        {"name": db.storage},
+    )
+    assert sorted(row[0] for row in cursor) == [
+        f"{db.name}_summary_delete",
+        f"{db.name}_summary_insert",
+    ]
+
+
+@pytest.mark.parametrize(
+    "bucket",
+    [(None, None), (None, 20), (20, None), (10, 200), (20, 200), (200, 300), (5, 20)],
+)
+def test_depth_zones_match_ranges(tmp_path, bucket):
+    db_name = str(tmp_path / "inlet_data.db")
+    expected = sorted(
+        datum.value
+        for datum in SAMPLE_DATA
+        if (bucket[0] is None or datum.depth >= bucket[0])
+        and (bucket[1] is None or datum.depth <= bucket[1])
+    )
+    db = inlet_data.InletDb("Test Inlet", db_name=db_name)
+    # rows written both before and after the zones are set get tagged
+    db.add_temperature_data(SAMPLE_DATA[:2])
+    db.set_depth_zones([200, 20, 10])
+    db.add_temperature_data(SAMPLE_DATA[2:])
+    assert sorted(db.get_columns("temperature", bucket)["value"].tolist()) == expected
+    # the boundaries are kept, and changing them tags the rows again
+    db = inlet_data.InletDb("Test Inlet", db_name=db_name)
+    assert db.zones == [10, 20, 200]
+    db.set_depth_zones([5, 20])
+    assert sorted(db.get_columns("temperature", bucket)["value"].tolist()) == expected
+
+
+def test_sources_only_in_periods_with_data():
+    db = inlet_data.InletDb("Test Inlet", db_name=DB_NAME)
+    db.add_oxygen_data(
+        [
+            make_datum(datetime.datetime(1990, 1, 3), 10, 6.0, source="m.cur"),
+            make_datum(datetime.datetime(1995, 12, 30), 10, 5.0, source="m.cur"),
+        ]
+    )
+    assert db.get_sources() == {1990: {"m.cur"}, 1995: {"m.cur"}}
+    assert db.get_sources(by_month=True) == {1: {"m.cur"}, 12: {"m.cur"}}
+    assert db.get_sources(before=datetime.datetime(1993, 1, 1)) == {1990: {"m.cur"}}
+    assert db.get_source_counts() == {(1990, 1): 1, (1995, 12): 1}
+
+
+def test_depth_zones_use_index():
+    db = inlet_data.InletDb("Test Inlet", db_name=DB_NAME)
+    db.set_depth_zones([0, 30, 100])
+    plan = db.connection.execute(
+        f"""explain query plan
+        select value from {db.name} where kind='salinity' and zone in (1, 2, 3)"""
+    )
+    assert any(f"{db.name}_zone" in row["detail"] for row in plan)
+
+
+CUBE_BUCKETS = {"all": (None, None), "deep": (200, None)}
+
+
+def cube_of(db, bucket, resolution, before=None):
+    return db.get_cube(
+        "temperature",
+        bucket,
+        CUBE_BUCKETS[bucket],
+        resolution,
+        before=before,
+        exclude_qualities=(3,),
+    )
+
+
+def test_cube():
+    db = inlet_data.InletDb("Test Inlet", db_name=DB_NAME)
+    db.add_temperature_data(
+        SAMPLE_DATA
+        + [
+            make_datum(datetime.datetime(1990, 1, 5, 6), 10, 5.0, source="c.ctd"),
+            make_datum(datetime.datetime(1995, 7, 1), 10, 9.0),
+        ]
+    )
+    assert cube_of(db, "all", "month") is None
+    db.build_cube(CUBE_BUCKETS, exclude_qualities=(3,))
+    months = cube_of(db, "all", "month")
+    expected = db.get_monthly_means("temperature", (None, None), exclude_qualities=(3,))
+    numpy.testing.assert_array_equal(months["time"], expected["time"])
+    numpy.testing.assert_allclose(months["mean"], expected["value"])
+    # 1990-01-05 has a mean of 2.0 from "a.ctd" and 5.0 from "c.ctd"
+    days = cube_of(db, "all", "day")
+    assert days["count"].tolist() == [2, 1, 1]
+    assert days["mean"].tolist() == [3.5, 7.0, 9.0]
+    assert days["m2"].tolist() == [4.5, 0.0, 0.0]
+    assert months["m2"].tolist() == [4.5, 0.0, 0.0]
+    years = cube_of(db, "all", "year")
+    assert years["time"].tolist() == [
+        datetime.date(1990, 1, 1),
+        datetime.date(1995, 1, 1),
+    ]
+    assert years["mean"].tolist() == [5.25, 9.0]
+    assert years["m2"].tolist() == [6.125, 0.0]
+    decades = cube_of(db, "all", "decade")
+    assert decades["count"].tolist() == [2]
+    before = cube_of(db, "all", "decade", datetime.datetime(1992, 1, 1))
+    assert before["mean"].tolist() == [5.25]
+    assert cube_of(db, "deep", "month")["mean"].tolist() == [7.0]
+    # a bucket asked for with other bounds or qualities is not in the cube
+    assert db.get_cube("temperature", "deep", (100, None), "month") is None
+    assert db.get_cube("temperature", "deep", (200, None), "month") is None
+    db.add_temperature_value(make_datum(datetime.datetime(1991, 1, 1), 10, 1.0))
+    assert cube_of(db, "all", "month") is None
+
+
+@pytest.mark.parametrize("overlap", [False, True])
+def test_cube_folded_by_merge(tmp_path, overlap):
+    names = [str(tmp_path / f"{part}.db") for part in ("old", "new", "whole")]
+    new_data = [
+        make_datum(datetime.datetime(1990, 1, 5, 6), 10, 5.0, source="c.ctd"),
+        make_datum(datetime.datetime(1990, 3, 1), 250, 4.0, source="c.ctd"),
+        make_datum(datetime.datetime(2001, 7, 1), 10, 9.0, source="d.ctd"),
+    ]
+    if overlap:
+        new_data.append(replace(SAMPLE_DATA[0], time=datetime.datetime(1990, 1, 7)))
+    dbs = [inlet_data.InletDb("Test Inlet", db_name=name) for name in names]
+    for db, data in zip(dbs, (SAMPLE_DATA, new_data, SAMPLE_DATA + new_data)):
+        db.set_depth_zones([200])
+        db.add_temperature_data(data)
+        db.build_cube(CUBE_BUCKETS, exclude_qualities=(3,))
+    old, _, whole = dbs
+    old.merge_from(names[1])
+    cube = cube_of(old, "all", "month")
+    if overlap:
+        # "a.ctd" has rows on both sides
+        assert cube is None
+        return
+    for bucket in CUBE_BUCKETS:
+        for resolution in inlet_data.RESOLUTIONS:
+            folded, built = (
+                cube_of(db, bucket, resolution) for db in (old, whole)
+            )
+            numpy.testing.assert_array_equal(folded["time"], built["time"])
+            numpy.testing.assert_array_equal(folded["count"], built["count"])
+            numpy.testing.assert_allclose(folded["mean"], built["mean"])
+            numpy.testing.assert_allclose(folded["m2"], built["m2"], atol=1e-12)
+    # an inlet with no rows takes the cube as it is, when its depth zones are
+    # the same
+    for name, boundaries in (("empty", [200]), ("other-zones", [150])):
+        empty = inlet_data.InletDb("Test Inlet", db_name=str(tmp_path / f"{name}.db"))
+        empty.set_depth_zones(boundaries)
+        empty.merge_from(names[2])
+        cube = cube_of(empty, "deep", "year")
+        if boundaries == [200]:
+            assert cube["mean"].tolist() == [5.5]
+        else:
+            assert cube is None
+
+
+def test_cube_folded_on_insert():
+    new_data = [
+        make_datum(datetime.datetime(1990, 1, 5, 6), 10, 5.0, source="c.ctd"),
+        make_datum(datetime.datetime(1990, 3, 1), 250, 4.0, source="c.ctd"),
+        make_datum(datetime.datetime(2001, 7, 1), 10, 9.0, source="d.ctd"),
+    ]
+    dbs = [inlet_data.InletDb("Test Inlet", db_name=DB_NAME) for _ in range(2)]
+    folded, built = dbs
+    folded.add_temperature_data(SAMPLE_DATA)
+    folded.build_cube(CUBE_BUCKETS, exclude_qualities=(3,))
+    folded.add_temperature_data(new_data)
+    built.add_temperature_data(SAMPLE_DATA + new_data)
+    built.build_cube(CUBE_BUCKETS, exclude_qualities=(3,))
+    for bucket in CUBE_BUCKETS:
+        for resolution in inlet_data.RESOLUTIONS:
+            cubes = [cube_of(db, bucket, resolution) for db in dbs]
+            numpy.testing.assert_array_equal(cubes[0]["time"], cubes[1]["time"])
+            numpy.testing.assert_array_equal(cubes[0]["count"], cubes[1]["count"])
+            numpy.testing.assert_allclose(cubes[0]["mean"], cubes[1]["mean"])
+            numpy.testing.assert_allclose(cubes[0]["m2"], cubes[1]["m2"], atol=1e-12)
+    # "a.ctd" already has temperature rows, so its daily means would change
+    folded.add_temperature_data([replace(SAMPLE_DATA[0], value=2.0)])
+    assert cube_of(folded, "all", "month") is None
+
+
+def test_batch_round_trip():
+    # batches keep wall clock times only
+    data = [
+        make_datum(
+            datum.time.replace(tzinfo=None),
+            datum.depth,
+            datum.value,
+            source=datum.source,
+            quality=datum.quality,
+        )
+        for datum in SAMPLE_DATA
+    ]
+    batch = inlet_data.InletDataBatch.from_data(data)
+    assert len(batch) == len(data)
+    assert list(batch) == data
+    assert batch.sources.tolist() == ["a.ctd", "b.bot"]
+    # a few tens of bytes per row
+    assert batch.nbytes / len(batch) < 64
+
+
+@pytest.mark.parametrize(
+    "bucket,exclude_qualities,expected",
+    [
+        ((None, None), (), [1.0, 3.0, 5.0, 7.0]),
+        ((20, 200), (), [3.0, 5.0]),
+        ((200, None), (3,), [7.0]),
+    ],
+)
+def test_batch_filters(bucket, exclude_qualities, expected):
+    batch = inlet_data.InletDataBatch.from_data(SAMPLE_DATA)
+    selected = batch.in_bucket(bucket).excluding_qualities(exclude_qualities)
+    assert selected.value.tolist() == expected
+    db = inlet_data.InletDb("Test Inlet", db_name=DB_NAME)
+    db.add_temperature_data(batch)
+    from_db = db.get_batch("temperature", bucket, exclude_qualities=exclude_qualities)
+    assert sorted(from_db.value.tolist()) == expected
+    assert sorted(from_db.get_sources().tolist()) == sorted(
+        selected.get_sources().tolist()
+    )
+    assert len(batch.before(datetime.datetime(1990, 1, 1))) == 0
+
+
+@pytest.mark.parametrize("batch_size,expected_sizes", [(1, [1, 1, 1, 1]), (3, [3, 1])])
+def test_iter_data(batch_size, expected_sizes):
+    db = inlet_data.InletDb("Test Inlet", db_name=DB_NAME)
+    db.add_oxygen_data(SAMPLE_DATA)
+    chunks = list(db.iter_data("oxygen", (None, None), batch_size=batch_size))
+    assert [len(chunk) for chunk in chunks] == expected_sizes
+    assert [datum for chunk in chunks for datum in chunk] == SAMPLE_DATA
+    batches = list(
+        db.iter_batches(
+            "oxygen", (None, None), batch_size=batch_size, exclude_qualities=(3,)
+        )
+    )
+    assert [value for batch in batches for value in batch.value] == [1.0, 3.0, 7.0]
+
+
+def test_reinsert_replaces_rows():
+    db = inlet_data.InletDb("Test Inlet", db_name=DB_NAME)
+    db.add_temperature_data(SAMPLE_DATA)
+    db.add_temperature_data(SAMPLE_DATA)
+    db.add_temperature_value(replace(SAMPLE_DATA[0], value=2.0))
+    rows = db.get_columns("temperature", (None, None))
+    assert sorted(rows["value"].tolist()) == [2.0, 3.0, 5.0, 7.0]
+    assert db.get_source_counts() == {(1990, 1): 1, (1990, 2): 1}
+
+
+def test_compact_encoding(tmp_path):
+    db_name = str(tmp_path / "inlet_data.db")
+    data = SAMPLE_DATA + [
+        replace(
+            SAMPLE_DATA[0],
+            depth=12.345,
+            value=31.23456,
+            computed=True,
+            assumed_density=True,
+        )
+    ]
+    db = inlet_data.InletDb("Test Inlet", db_name=db_name, compact=True)
+    db.set_depth_zones([10, 20])
+    db.add_salinity_data(data)
+    db.add_salinity_value(replace(SAMPLE_DATA[1], value=4.0))
+    expected = data[:1] + [replace(SAMPLE_DATA[1], value=4.0)] + data[2:]
+    del db
+    # the encoding is kept when the table is opened again
+    db = inlet_data.InletDb("Test Inlet", db_name=db_name)
+    assert db.compact
+    assert sorted(db.get_salinity_data((None, None)), key=str) == sorted(
+        expected, key=str
+    )
+    values = db.get_columns("salinity", (10, 20))["value"]
+    assert sorted(values.tolist()) == [1.0, 4.0, 31.23456]
+    assert db.get_source_counts() == {(1990, 1): 1, (1990, 2): 1}
+    assert db.get_catalog()[0].max_depth == 200
+    assert inlet_data.get_inlet_names(db_name) == ["test_inlet"]
+    copy_name = str(tmp_path / "copy.db")
+    copy = inlet_data.InletDb("Test Inlet", db_name=copy_name)
+    copy.merge_from(db_name)
+    assert sorted(copy.get_salinity_data((None, None)), key=str) == sorted(
+        expected, key=str
+    )
+    compact = inlet_data.InletDb("Test Inlet", db_name=db_name, clear=True)
+    assert not compact.compact
+    assert not compact.has_data("salinity")
+
+
+def test_compact_rejects_close_depths(tmp_path, capsys):
+    db_name = str(tmp_path / "inlet_data.db")
+    db = inlet_data.InletDb("Test Inlet", db_name=db_name)
+    db.add_salinity_data(SAMPLE_DATA + [replace(SAMPLE_DATA[0], depth=10.0004)])
+    assert db.get_depth_collisions() == [
+        ("salinity", "a.ctd", "1990-01-05T03:00:00.000000", "10.0, 10.0004")
+    ]
+    target = str(tmp_path / "compact.db")
+    compact = inlet_data.InletDb("Test Inlet", db_name=target, compact=True)
+    with pytest.raises(ValueError, match="10.0, 10.0004"):
+        compact.merge_from(db_name)
+    assert not compact.has_data("salinity")
+    del compact
+    other_target = str(tmp_path / "other.db")
+    dbtool.encode(db_name, other_target)
+    assert "Not copying test_inlet: 1 groups" in capsys.readouterr().out
+    assert inlet_data.get_inlet_names(other_target) == []
+    with db.connection:
+        db.connection.execute(f"delete from {db.name} where depth=10.0004")
+    assert db.get_depth_collisions() == []
+    dbtool.encode(db_name, other_target)
+    assert inlet_data.get_inlet_names(other_target) == ["test_inlet"]
+
+
+def test_duplicates_kept_until_compact(tmp_path):
+    db_name = str(tmp_path / "inlet_data.db")
+    db = inlet_data.InletDb("Test Inlet", db_name=db_name)
+    db.add_salinity_data(SAMPLE_DATA)
+    # as written before rows had a key
+    with db.connection:
+        db.connection.execute(f"drop index {db.name}_key")
+        db.connection.execute(f"insert into {db.name} select * from {db.name}")
+    del db
+    with open(db_name, "rb") as f:
+        contents = f.read()
+    reader = inlet_data.InletDb("Test Inlet", db_name=db_name, read_only=True)
+    assert len(reader.get_salinity_data((None, None))) == 2 * len(SAMPLE_DATA)
+    reader.set_depth_zones([100])
+    del reader
+    with open(db_name, "rb") as f:
+        assert f.read() == contents
+    db = inlet_data.InletDb("Test Inlet", db_name=db_name)
+    assert len(db.get_salinity_data((None, None))) == 2 * len(SAMPLE_DATA)
+    with pytest.raises(ValueError, match="dbtool compact"):
+        db.add_salinity_data(SAMPLE_DATA)
+    del db
+    dbtool.compact(db_name)
+    db = inlet_data.InletDb("Test Inlet", db_name=db_name)
+    assert len(db.get_salinity_data((None, None))) == len(SAMPLE_DATA)
+    db.add_salinity_data(SAMPLE_DATA)
+    assert db.add_key() == 0
+
+
+def test_read_only_needs_current_layout(tmp_path):
+    db_name = str(tmp_path / "inlet_data.db")
+    with pytest.raises(ValueError, match="no database"):
+        inlet_data.InletDb("Test Inlet", db_name=db_name, read_only=True)
+    assert not os.path.exists(db_name)
+    inlet_data.InletDb("Other Inlet", db_name=db_name)
+    with pytest.raises(ValueError, match="no inlet"):
+        inlet_data.InletDb("Test Inlet", db_name=db_name, read_only=True)
+    db = inlet_data.InletDb("Test Inlet", db_name=db_name)
+    with db.connection:
+        db.connection.execute(f"drop table {db.summary}")
+    del db
+    with pytest.raises(ValueError, match="test_inlet_summary"):
+        inlet_data.InletDb("Test Inlet", db_name=db_name, read_only=True)
+
+
+def test_shards_merge(tmp_path):
+    shards = inlet_data.ShardSet(str(tmp_path / "shards"))
+    shards.open("Test Inlet").add_temperature_data(SAMPLE_DATA[:2])
+    shards.open("Other Inlet").add_temperature_data(
+        [replace(datum, source="c.ctd") for datum in SAMPLE_DATA]
+    )
+    assert shards.get_inlet_names() == ["other_inlet", "test_inlet"]
+    assert shards.get_source_counts() == {(1990, 1): 2, (1990, 2): 1}
+    db_name = str(tmp_path / "inlet_data.db")
+    shards.merge(db_name)
+    # merging again changes nothing
+    shards.merge(db_name)
+    assert inlet_data.get_inlet_names(db_name) == ["other_inlet", "test_inlet"]
+    merged = inlet_data.InletDb("Other Inlet", db_name=db_name)
+    assert sorted(merged.get_temperature_data((None, None)), key=str) == sorted(
+        shards.open("Other Inlet").get_temperature_data((None, None)), key=str
+    )
+    assert merged.get_source_counts() == {(1990, 1): 1, (1990, 2): 1}
+
+
+def test_memory_build(tmp_path):
+    db_name = str(tmp_path / "inlet_data.db")
+    inlet_data.InletDb("Test Inlet", db_name=db_name).add_oxygen_data(SAMPLE_DATA)
+    build = inlet_data.MemoryBuild(db_name)
+    inlet_data.InletDb("Other Inlet", db_name=build.name).add_oxygen_data(
+        SAMPLE_DATA[:1]
+    )
+    assert inlet_data.get_inlet_names(db_name) == ["test_inlet"]
+    build.write()
+    assert inlet_data.get_inlet_names(db_name) == ["other_inlet", "test_inlet"]
+    kept = inlet_data.InletDb("Test Inlet", db_name=db_name)
+    assert len(kept.get_oxygen_data((None, None))) == len(SAMPLE_DATA)
+    assert os.listdir(tmp_path) == ["inlet_data.db"]
+
+
+def test_diff_and_delta(tmp_path):
+    old_name, new_name = str(tmp_path / "old.db"), str(tmp_path / "new.db")
+    old = inlet_data.InletDb("Test Inlet", db_name=old_name)
+    old.add_temperature_data(SAMPLE_DATA[:3])
+    new = inlet_data.InletDb("Test Inlet", db_name=new_name)
+    new.add_temperature_data(
+        [SAMPLE_DATA[0], replace(SAMPLE_DATA[1], quality=4), SAMPLE_DATA[3]]
+    )
+    assert inlet_data.diff(old_name, new_name, "Test Inlet") == {
+        "a.ctd": {"added": 0, "removed": 1, "changed": 1},
+        "b.bot": {"added": 1, "removed": 0, "changed": 0},
+    }
+    delta_name = str(tmp_path / "delta.db")
+    delta = inlet_data.InletDb("Test Inlet", db_name=delta_name)
+    delta.merge_from(new_name, base=old_name)
+    assert len(delta.get_temperature_data((None, None))) == 2
+    old.merge_from(delta_name)
+    assert inlet_data.diff(old_name, new_name, "Test Inlet") == {
+        "a.ctd": {"added": 0, "removed": 1, "changed": 0}
+    }
+
+
+def test_diff_leaves_files_unchanged(tmp_path, capsys):
+    old_name, new_name = str(tmp_path / "old.db"), str(tmp_path / "new.db")
+    old = inlet_data.InletDb("Test Inlet", db_name=old_name)
+    old.add_temperature_data(SAMPLE_DATA[:3])
+    # a duplicate row, as in tables written before rows had a key
+    with old.connection:
+        old.connection.execute(f"drop index {old.name}_key")
+        old.connection.execute(
+            f"insert into {old.name} select * from {old.name} limit 1"
+        )
+    del old
+    new = inlet_data.InletDb("Other Inlet", db_name=new_name)
+    new.add_temperature_data(SAMPLE_DATA[3:])
+    del new
+    contents = {}
+    for name in (old_name, new_name):
+        with open(name, "rb") as f:
+            contents[name] = f.read()
+    dbtool.diff(old_name, new_name)
+    assert capsys.readouterr().out.splitlines() == [
+        "other_inlet:",
+        "  b.bot: 1 added, 0 removed, 0 changed",
+        "test_inlet:",
+        "  a.ctd: 0 added, 4 removed, 0 changed",
+    ]
+    for name in (old_name, new_name):
+        with open(name, "rb") as f:
+            assert f.read() == contents[name]
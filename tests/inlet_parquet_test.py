@@ -0,0 +1,159 @@
+from .context import inlets
+import datetime
+import numpy
+import pytest
+
+import dbtool
+import inlet_data
+
+pytest.importorskip("pyarrow")
+import inlet_parquet
+
+from .inlet_data_test import SAMPLE_DATA, make_datum
+
+
+@pytest.fixture
+def stores(tmp_path):
+    sqlite = inlet_data.InletDb("Test Inlet", db_name=":memory:")
+    parquet = inlet_parquet.InletParquet(
+        "Test Inlet", db_name=str(tmp_path / "inlet_data.parquet")
+    )
+    for db in (sqlite, parquet):
+        db.add_temperature_data(SAMPLE_DATA)
+        db.add_oxygen_data(SAMPLE_DATA[:2])
+    return sqlite, parquet
+
+
+@pytest.mark.parametrize(
+    "bucket,average,before,exclude_qualities,value_bounds",
+    [
+        ((None, None), False, None, (), None),
+        ((20, 200), False, None, (), None),
+        ((None, None), True, None, (), None),
+        ((None, None), False, datetime.datetime(1991, 1, 1), (3,), (2, 8)),
+        ((None, None), True, datetime.datetime(1990, 1, 1), (), None),
+    ],
+)
+def test_get_columns_matches_sqlite(
+    stores, bucket, average, before, exclude_qualities, value_bounds
+):
+    columns = list(inlet_data.COLUMN_TYPES.keys())
+    sqlite, parquet = (
+        db.get_columns(
+            "temperature",
+            bucket,
+            columns=columns,
+            average=average,
+            before=before,
+            exclude_qualities=exclude_qualities,
+            value_bounds=value_bounds,
+        )
+        for db in stores
+    )
+    order = [numpy.argsort(result["time"], kind="stable") for result in (sqlite, parquet)]
+    for column in columns:
+        assert parquet[column].dtype == sqlite[column].dtype
+        numpy.testing.assert_array_equal(
+            parquet[column][order[1]], sqlite[column][order[0]]
+        )
+
+
+@pytest.mark.parametrize(
+    "exclude_qualities,value_bounds", [((), None), ((3,), None), ((), (0, 6))]
+)
+def test_get_monthly_means_matches_sqlite(stores, exclude_qualities, value_bounds):
+    sqlite, parquet = (
+        db.get_monthly_means(
+            "temperature",
+            (None, None),
+            exclude_qualities=exclude_qualities,
+            value_bounds=value_bounds,
+        )
+        for db in stores
+    )
+    numpy.testing.assert_array_equal(parquet["time"], sqlite["time"])
+    numpy.testing.assert_allclose(parquet["value"], sqlite["value"])
+
+
+def test_summaries_match_sqlite(stores):
+    sqlite, parquet = stores
+    for kind in ("temperature", "salinity", "oxygen"):
+        assert parquet.has_data(kind) == sqlite.has_data(kind)
+    assert parquet.get_source_counts() == sqlite.get_source_counts()
+    assert parquet.get_sources(by_month=True) == sqlite.get_sources(by_month=True)
+    before = datetime.datetime(1990, 1, 1)
+    assert parquet.get_sources(before=before) == sqlite.get_sources(before=before)
+
+
+def test_sources_spanning_years_match_sqlite(stores):
+    sqlite, parquet = stores
+    for db in stores:
+        db.add_salinity_data(
+            [
+                make_datum(datetime.datetime(1990, 1, 3), 10, 30.0, source="m.cur"),
+                make_datum(datetime.datetime(1995, 12, 30), 10, 31.0, source="m.cur"),
+            ]
+        )
+    for by_month in (False, True):
+        assert parquet.get_sources(by_month=by_month) == sqlite.get_sources(
+            by_month=by_month
+        )
+    assert sqlite.get_sources()[1995] == {"m.cur"}
+    assert 1993 not in sqlite.get_sources()
+
+
+def test_no_cube_is_reported(stores, caplog, monkeypatch):
+    _, parquet = stores
+    parquet.set_depth_zones([100, 10, 10])
+    assert parquet.zones == [10.0, 100.0]
+    monkeypatch.setattr(inlet_parquet.InletParquet, "warned_cube", False)
+    parquet.build_cube({"all": (None, None)})
+    parquet.build_cube({"all": (None, None)})
+    assert len(caplog.records) == 1
+    assert "no aggregate cube" in caplog.records[0].getMessage()
+    assert parquet.get_cube("temperature", "all", (None, None), "month") is None
+
+
+def test_convert_round_trip(tmp_path):
+    sqlite_name = str(tmp_path / "inlet_data.db")
+    parquet_name = str(tmp_path / "inlet_data.parquet")
+    db = inlet_data.InletDb("Test Inlet", db_name=sqlite_name)
+    db.add_salinity_data(SAMPLE_DATA)
+    dbtool.convert("sqlite", sqlite_name, "parquet", parquet_name)
+    assert inlet_parquet.get_inlet_names(parquet_name) == ["test_inlet"]
+    copy_name = str(tmp_path / "copy.db")
+    dbtool.convert("parquet", parquet_name, "sqlite", copy_name)
+    copy = inlet_data.InletDb("Test Inlet", db_name=copy_name)
+    assert sorted(copy.get_salinity_data((None, None)), key=str) == sorted(
+        SAMPLE_DATA, key=str
+    )
+
+
+def test_add_batch(tmp_path):
+    parquet = inlet_parquet.InletParquet(
+        "Test Inlet", db_name=str(tmp_path / "inlet_data.parquet")
+    )
+    batch = inlet_data.InletDataBatch.from_data(SAMPLE_DATA)
+    parquet.add_salinity_data(batch)
+    from_parquet = parquet.get_batch("salinity", (None, None))
+    order = numpy.argsort(from_parquet.time)
+    assert list(from_parquet[order]) == list(batch)
+
+
+@pytest.mark.parametrize("batch_size", [1, 3])
+def test_iter_data(stores, batch_size):
+    sqlite, parquet = stores
+    rows = [
+        datum
+        for data in parquet.iter_data("temperature", (None, None), batch_size)
+        for datum in data
+    ]
+    assert sorted(rows, key=str) == sorted(SAMPLE_DATA, key=str)
+    values = [
+        value
+        for batch in parquet.iter_batches(
+            "temperature", (20, None), batch_size=batch_size
+        )
+        for value in batch.value
+    ]
+    assert sorted(values) == [3.0, 5.0, 7.0]
@@ -1,4 +1,5 @@
 from .context import inlets
+import datetime
 import numpy
 import pytest
 import os
@@ -270,3 +271,155 @@ def test_inlet_add_oxygen(source):
 )
 def test_reinsert_nan(data, placeholder):
     assert any(numpy.isnan(inlets.reinsert_nan(data, placeholder)))
+
+
+def deep_cube(inlet):
+    return inlet.data.get_cube(
+        "temperature",
+        "DEEP",
+        inlet.get_bounds(inlets.Category.DEEP),
+        "month",
+        exclude_qualities=inlets.BAD_QUALITIES,
+    )
+
+
+@pytest.mark.parametrize("use_cube", [False, True])
+def test_inlet_get_data_monthly_average(use_cube):
+    inlet = inlets.Inlet(
+        "Test Inlet",
+        "Test Area",
+        Polygon([[0, 0], [0, 1], [1, 1], [1, 0]]),
+        [150, 250, 300],
+        {},
+        db_name=DB_NAME,
+    )
+    inlet.data.add_temperature_data(
+        [
+            inlets.inlet_data.InletData(
+                datetime.datetime(year, month, day), depth, value, 0, 0.5, 0.5, source
+            )
+            for year, month, day, depth, value, source in [
+                (1990, 1, 1, 200, 1.0, "a"),
+                (1990, 1, 1, 210, 3.0, "a"),
+                (1990, 1, 20, 200, 8.0, "b"),
+                (1990, 3, 2, 200, 4.0, "a"),
+                (1990, 3, 2, 10, 100.0, "a"),
+                (2001, 1, 1, 200, 9.0, "a"),
+            ]
+        ]
+    )
+    if use_cube:
+        inlet.build_cube()
+        assert deep_cube(inlet) is not None
+    times, values = inlet.get_temperature_data(
+        inlets.Category.DEEP, before=datetime.datetime(2001, 6, 1), do_average=True
+    )
+    assert times.tolist() == [datetime.date(1990, 1, 1), datetime.date(1990, 3, 1)]
+    assert values.tolist() == [5.0, 4.0]
+
+
+def test_inlet_cube_dropped_with_new_boundaries(tmp_path):
+    db_name = str(tmp_path / "inlet_data.db")
+
+    def make_inlet(boundaries):
+        return inlets.Inlet(
+            "Test Inlet",
+            "Test Area",
+            Polygon([[0, 0], [0, 1], [1, 1], [1, 0]]),
+            boundaries,
+            {},
+            db_name=db_name,
+        )
+
+    inlet = make_inlet([150, 250, 300])
+    inlet.data.add_temperature_data(
+        [
+            inlets.inlet_data.InletData(
+                datetime.datetime(1990, 1, 1), depth, value, 0, 0.5, 0.5, "a"
+            )
+            for depth, value in [(160, 1.0), (200, 9.0)]
+        ]
+    )
+    inlet.build_cube()
+    del inlet
+    # as with plot -r, which reads the cube without building it again
+    inlet = make_inlet([180, 250, 300])
+    assert deep_cube(inlet) is None
+    _, values = inlet.get_temperature_data(inlets.Category.DEEP, do_average=True)
+    assert values.tolist() == [9.0]
+    # the same boundaries keep the cube
+    inlet.build_cube()
+    del inlet
+    inlet = make_inlet([180, 250, 300])
+    assert deep_cube(inlet) is not None
+
+
+def test_inlet_cube_not_used_for_moved_buckets(tmp_path):
+    db_name = str(tmp_path / "inlet_data.db")
+
+    def make_inlet(boundaries, shallow):
+        return inlets.Inlet(
+            "Test Inlet",
+            "Test Area",
+            Polygon([[0, 0], [0, 1], [1, 1], [1, 0]]),
+            boundaries,
+            {},
+            db_name=db_name,
+            shallow=shallow,
+        )
+
+    inlet = make_inlet([150, 250, 300], [0, 30, 100])
+    inlet.data.add_temperature_data(
+        [
+            inlets.inlet_data.InletData(
+                datetime.datetime(1990, month, 1), depth, value, 0, 0.5, 0.5, "a"
+            )
+            for month, depth, value in [(1, 200, 9.0), (2, 120, 1.0)]
+        ]
+    )
+    inlet.build_cube()
+    del inlet
+    # the same depth zones, with DEEP from 100m instead of 150m
+    inlet = make_inlet([100, 250, 300], [0, 30, 150])
+    assert inlet.data.zones == [0, 30, 100, 150, 250, 300]
+    assert deep_cube(inlet) is None
+    _, values = inlet.get_temperature_data(inlets.Category.DEEP, do_average=True)
+    assert values.tolist() == [9.0, 1.0]
+
+
+def test_query_cache_eviction():
+    cache = inlets.QueryCache(maxsize=2)
+    for key in ["a", "b", "a", "c", "b"]:
+        cache.get(key, 0, lambda: key)
+    # "b" was evicted by "c" since "a" had been used more recently
+    assert cache.stats() == {"hits": 1, "misses": 4, "size": 2, "hit_rate": 0.2}
+    assert list(cache.entries.keys()) == ["c", "b"]
+
+
+def test_inlet_cache_invalidated_by_insert():
+    inlet = inlets.Inlet(
+        "Test Inlet",
+        "Test Area",
+        Polygon([[0, 0], [0, 1], [1, 1], [1, 0]]),
+        [150, 250, 300],
+        {},
+        db_name=DB_NAME,
+    )
+
+    def add(value, depth):
+        inlet.data.add_salinity_data(
+            [
+                inlets.inlet_data.InletData(
+                    datetime.datetime(1990, 1, 1), depth, value, 0, 0.5, 0.5, "a"
+                )
+            ]
+        )
+
+    add(30.0, 200)
+    first = inlet.get_salinity_data(inlets.Category.DEEP, do_average=True)
+    again = inlet.get_salinity_data(inlets.Category.DEEP, do_average=True)
+    assert again is first
+    add(32.0, 210)
+    _, values = inlet.get_salinity_data(inlets.Category.DEEP, do_average=True)
+    assert values.tolist() == [31.0]
+    assert inlet.cache.hits == 1 and inlet.cache.misses == 2
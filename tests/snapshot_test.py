@@ -0,0 +1,106 @@
+from .context import inlets
+import datetime
+import numpy
+import os
+import pytest
+
+import inlet_data
+import snapshot
+
+from .inlet_data_test import SAMPLE_DATA, make_datum
+
+
+@pytest.fixture
+def snapshot_db(tmp_path):
+    db = inlet_data.InletDb("Test Inlet", db_name=str(tmp_path / "inlet_data.db"))
+    db.add_temperature_data(SAMPLE_DATA)
+    db.add_salinity_data(SAMPLE_DATA[:2])
+    root = str(tmp_path / "snapshots")
+    snapshot.export_snapshot(db, root)
+    return snapshot.SnapshotDb(db, root)
+
+
+@pytest.mark.parametrize(
+    "bucket,average,before,exclude_qualities,value_bounds",
+    [
+        ((None, None), False, None, (), None),
+        ((20, 200), False, None, (), None),
+        ((None, None), True, None, (), None),
+        ((None, None), False, datetime.datetime(1991, 1, 1), (3,), (2, 8)),
+        ((None, None), True, datetime.datetime(1990, 1, 1), (), None),
+    ],
+)
+def test_get_columns_matches_db(
+    snapshot_db, bucket, average, before, exclude_qualities, value_bounds
+):
+    assert snapshot_db.is_fresh()
+    expected, actual = (
+        db.get_columns(
+            "temperature",
+            bucket,
+            columns=snapshot.SNAPSHOT_COLUMNS,
+            average=average,
+            before=before,
+            exclude_qualities=exclude_qualities,
+            value_bounds=value_bounds,
+        )
+        for db in (snapshot_db.db, snapshot_db)
+    )
+    order = numpy.argsort(expected["time"], kind="stable")
+    for column in snapshot.SNAPSHOT_COLUMNS:
+        assert actual[column].dtype == expected[column].dtype
+        numpy.testing.assert_array_equal(actual[column], expected[column][order])
+
+
+@pytest.mark.parametrize(
+    "exclude_qualities,value_bounds", [((), None), ((3,), None), ((), (0, 6))]
+)
+def test_get_monthly_means_matches_db(snapshot_db, exclude_qualities, value_bounds):
+    expected, actual = (
+        db.get_monthly_means(
+            "temperature",
+            (None, None),
+            exclude_qualities=exclude_qualities,
+            value_bounds=value_bounds,
+        )
+        for db in (snapshot_db.db, snapshot_db)
+    )
+    numpy.testing.assert_array_equal(actual["time"], expected["time"])
+    numpy.testing.assert_allclose(actual["value"], expected["value"])
+
+
+def test_stale_snapshot_falls_back(snapshot_db):
+    snapshot_db.add_temperature_value(
+        make_datum(datetime.datetime(1990, 3, 1), 10, 9.0)
+    )
+    assert not snapshot_db.is_fresh()
+    means = snapshot_db.get_monthly_means("temperature", (None, None))
+    assert means["value"].tolist() == [3.5, 7.0, 9.0]
+
+
+def test_rebuilt_db_is_stale(snapshot_db, tmp_path):
+    # the same writes to a new file reach the same generation
+    generation = snapshot_db.generation
+    snapshot_db.db.connection.close()
+    os.remove(tmp_path / "inlet_data.db")
+    db = inlet_data.InletDb("Test Inlet", db_name=str(tmp_path / "inlet_data.db"))
+    db.add_temperature_data(SAMPLE_DATA[:1])
+    db.add_salinity_data(SAMPLE_DATA[:1])
+    assert db.generation == generation
+    snapshot_db.db = db
+    assert not snapshot_db.is_fresh()
+    means = snapshot_db.get_monthly_means("temperature", (None, None))
+    assert means["value"].tolist() == [1.0]
+
+
+def test_generation_is_kept(tmp_path):
+    db_name = str(tmp_path / "inlet_data.db")
+    db = inlet_data.InletDb("Test Inlet", db_name=db_name)
+    db.add_oxygen_data(SAMPLE_DATA)
+    generation, identity = db.generation, db.identity
+    del db
+    db = inlet_data.InletDb("Test Inlet", db_name=db_name)
+    assert (db.generation, db.identity) == (generation, identity)
+    db.clear()
+    assert db.identity != identity
+    assert inlet_data.get_inlet_names(db_name) == ["test_inlet"]
@@ -3,6 +3,8 @@
 from .context import inlets
 import pytest
 import datetime
+import numpy
+import scipy.stats
 
 import utils
 
@@ -30,36 +32,74 @@ def test_label_from_bounds(lower, upper, expected):
 
 
 @pytest.mark.parametrize(
-    "totals,key,datum,expected",
+    "keys,values,expected_keys,expected",
     [
-        ({}, 1, 2, (2, 1)),
-        ({2: "other"}, 1, 2, (2, 1)),
-        ({1: (3, 1)}, 1, 2, (5, 2)),
+        ([[2, 1, 2, 1]], [1.0, 2.0, 3.0, 6.0], [[1, 2]], [4.0, 2.0]),
+        (
+            [[0, 0, 1, 0], [1990, 1991, 1990, 1990]],
+            [1.0, 2.0, 3.0, 5.0],
+            [[0, 0, 1], [1990, 1991, 1990]],
+            [3.0, 2.0, 3.0],
+        ),
+        ([[]], [], [[]], []),
     ],
 )
-def test_update_totals(totals, key, datum, expected):
-    utils.update_totals(totals, key, datum)
-    assert totals[key] == expected
+def test_group_means(keys, values, expected_keys, expected):
+    keys = [numpy.array(key, dtype=int) for key in keys]
+    result_keys, means = utils.group_means(keys, values)
+    assert [key.tolist() for key in result_keys] == expected_keys
+    assert means.tolist() == expected
+
+
+def test_join_by_time():
+    day = numpy.datetime64("1990-01-01")
+    salinity = ([day + 2, day, day + 1, day + 2], [1.0, 2.0, 3.0, 4.0])
+    oxygen = ([day + 2, day + 3, day + 2, day], [5.0, 6.0, 7.0, 8.0])
+    times, sal, oxy = utils.join_by_time(salinity, oxygen)
+    assert times.tolist() == [
+        datetime.datetime(1990, 1, 3),
+        datetime.datetime(1990, 1, 3),
+        datetime.datetime(1990, 1, 1),
+        datetime.datetime(1990, 1, 3),
+        datetime.datetime(1990, 1, 3),
+    ]
+    assert sal.tolist() == [1.0, 1.0, 2.0, 4.0, 4.0]
+    assert oxy.tolist() == [5.0, 7.0, 8.0, 5.0, 7.0]
 
 
 @pytest.mark.parametrize(
     "data,expected",
     [
         ([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 5.5),
+        ([1, numpy.nan, 3], 2.0),
+        (
+            [[1, 2, 3], [4, numpy.nan, numpy.nan], [numpy.nan] * 3],
+            [2.0, 4.0, numpy.nan],
+        ),
     ],
 )
 def test_mean(data, expected):
-    assert utils.mean(data) == expected
+    numpy.testing.assert_array_equal(utils.mean(data), expected)
+
+
+def test_moments():
+    count, mean, m2 = utils.moments(
+        [[1, 2, numpy.nan], [3, 3, 3], [numpy.nan, numpy.nan, numpy.nan]]
+    )
+    assert count.tolist() == [2, 3, 0]
+    numpy.testing.assert_array_equal(mean, [1.5, 3.0, numpy.nan])
+    assert m2.tolist() == [0.5, 0.0, 0.0]
 
 
 @pytest.mark.parametrize(
     "data,expected",
     [
         ([1, 2, 1, 2, 1, 2, 1, 2, 1, 2], 0.5),
+        ([[1, 2, numpy.nan], [3, 3, 3]], [0.5, 0.0]),
     ],
 )
 def test_sd(data, expected):
-    assert utils.sd(data) == expected
+    numpy.testing.assert_array_equal(utils.sd(data), expected)
 
 
 @pytest.mark.parametrize(
@@ -73,10 +113,54 @@ def test_sd(data, expected):
             ],
             [1, 2, 13],
         ),
+        (
+            numpy.array(
+                [["1950-01-01", "1950-03-01"], ["1952-12-01", "1951-06-01"]],
+                dtype="datetime64[D]",
+            ),
+            [[1, 3], [24, 6]],
+        ),
     ],
 )
 def test_index_by_month(dates, expected):
-    assert utils.index_by_month(dates) == expected
+    assert utils.index_by_month(dates).tolist() == expected
+
+
+@pytest.mark.parametrize(
+    "trend,remove_sd",
+    [
+        (utils.Trend.NONE, False),
+        (utils.Trend.NONE, True),
+        (utils.Trend.DIFF, True),
+        (utils.Trend.LINEAR, False),
+        (utils.Trend.LINEAR, True),
+    ],
+)
+def test_remove_seasonal_trend(trend, remove_sd):
+    times = numpy.arange("1950-01", "1952-01", dtype="datetime64[M]")
+    rows = numpy.random.default_rng(0).normal(size=(3, len(times)))
+    rows[1, [0, 5, 6]] = numpy.nan
+    removed = utils.remove_seasonal_trend(times, rows, trend, remove_sd)
+    # each row of the stack is the same as the row on its own
+    for row, expected in zip(rows, removed):
+        numpy.testing.assert_allclose(
+            utils.remove_seasonal_trend(times, row, trend, remove_sd), expected
+        )
+    # and missing values stay missing without changing the rest
+    if trend != utils.Trend.DIFF:
+        inside = ~numpy.isnan(rows[1])
+        assert numpy.isnan(removed[1]).tolist() == (~inside).tolist()
+        numpy.testing.assert_allclose(
+            utils.remove_seasonal_trend(
+                times[inside], rows[1][inside], trend, remove_sd
+            ),
+            removed[1][inside],
+        )
+    if trend == utils.Trend.LINEAR:
+        domain = utils.index_by_month(times)
+        residuals = rows[0] - numpy.polyval(numpy.polyfit(domain, rows[0], 1), domain)
+        expected = residuals / residuals.std() if remove_sd else residuals
+        numpy.testing.assert_allclose(removed[0], expected)
 
 
 @pytest.mark.parametrize(
@@ -84,7 +168,62 @@ def test_index_by_month(dates, expected):
     [
         (1965.0, datetime.date(1965, 1, 1)),
         (1965.5, datetime.date(1965, 7, 2)),
+        (1965 + 30.5 / 365, datetime.date(1965, 1, 31)),
+        (1965.9999, datetime.date(1965, 12, 31)),
     ],
 )
 def test_year_from_float(num, expected):
     assert utils.date_from_float(num) == expected
+
+
+def test_dates_from_floats():
+    dates = utils.dates_from_floats([1965.0, 1965.5, 2000 + 59.5 / 365])
+    assert dates.tolist() == [
+        datetime.date(1965, 1, 1),
+        datetime.date(1965, 7, 2),
+        datetime.date(2000, 3, 1),
+    ]
+
+
+@pytest.mark.parametrize("periods", [(), (12,), (12, 6, 3)])
+def test_fit_harmonics(periods):
+    months = numpy.arange(1, 121)
+    coefficients = numpy.array([[4.0, 0.01, 2.0, -1.0, 0.5, 0.0, 0.0, 0.25]])
+    coefficients = numpy.concatenate([coefficients, -coefficients])
+    coefficients = coefficients[:, : 2 + 2 * len(periods)]
+    rows = coefficients @ utils.harmonic_terms(months, periods).T
+    rows[1, ::5] = numpy.nan
+    fit = utils.fit_harmonics(months, rows, periods)
+    numpy.testing.assert_allclose(fit.coefficients, coefficients, atol=1e-9)
+    numpy.testing.assert_allclose(fit(months)[0], rows[0])
+    assert fit.samples.tolist() == [120, 96]
+    numpy.testing.assert_allclose(fit.residual_sd, 0, atol=1e-9)
+    numpy.testing.assert_allclose(fit.r_squared, 1)
+    if len(periods) > 0:
+        numpy.testing.assert_allclose(fit.amplitudes[0, 0], numpy.hypot(2, 1))
+        numpy.testing.assert_allclose(
+            fit(months, periods=())[0], 4 + 0.01 * months, atol=1e-9
+        )
+
+
+def test_fit_harmonics_interval():
+    months = numpy.arange(1, 61, dtype=float)
+    rows = numpy.stack([0.1 * months + numpy.sin(months), months, months])
+    rows[1, 1:] = numpy.nan
+    rows[2, ::2] = numpy.nan
+    fit = utils.fit_harmonics(months, rows, periods=())
+    lower, upper = fit.interval(0.9)
+    expected = scipy.stats.linregress(months, rows[0])
+    numpy.testing.assert_allclose(fit.slope[0], expected.slope)
+    numpy.testing.assert_allclose(
+        fit.stderr[0], [expected.intercept_stderr, expected.stderr]
+    )
+    margin = scipy.stats.t.ppf(0.95, 58) * expected.stderr
+    numpy.testing.assert_allclose(
+        [lower[0, 1], upper[0, 1]], [expected.slope - margin, expected.slope + margin]
+    )
+    # one sample is too few for any spread
+    assert numpy.isnan(fit.stderr[1]).all() and numpy.isnan(lower[1]).all()
+    # a perfect fit has no spread at all
+    numpy.testing.assert_allclose(fit.stderr[2], 0, atol=1e-12)
+    numpy.testing.assert_allclose([lower[2, 1], upper[2, 1]], 1)
@@ -1,7 +1,9 @@
+from dataclasses import dataclass
 import datetime
 from enum import Enum
-import math
-from numpy.polynomial.polynomial import Polynomial
+import numpy
+import scipy.stats
+from typing import Optional, Sequence, Tuple
 
 
 def normalize(string: str):
@@ -15,55 +17,131 @@ def label_from_bounds(lower, upper):
         return f"{lower}m-{upper}m"
 
 
-def update_totals(totals, key, datum):
-    if key not in totals:
-        totals[key] = (0, 0)
-    total, num = totals[key]
-    totals[key] = (total + datum, num + 1)
+def group_means(keys, values):
+    """Mean of `values` for each distinct combination of `keys`, in key order.
+
+    Returns the distinct keys, one array per key, and their means. Each group
+    is added up in the order its values are given, so the means are the same
+    as from running totals.
+    """
+    order = numpy.lexsort(keys[::-1])
+    keys = [numpy.asarray(key)[order] for key in keys]
+    values = numpy.asarray(values, dtype=float)[order]
+    if len(values) == 0:
+        return keys, values
+    changed = numpy.zeros(len(values), dtype=bool)
+    changed[0] = True
+    for key in keys:
+        changed[1:] |= key[1:] != key[:-1]
+    groups = numpy.cumsum(changed) - 1
+    means = numpy.bincount(groups, weights=values) / numpy.bincount(groups)
+    return [key[changed] for key in keys], means
+
+
+def match_times(left_times, right_times):
+    """Indices of every pair of equal times in two series.
+
+    The pairs are ordered by their index in `left_times`, then by their index
+    in `right_times`, as nested loops over the two would find them.
+    """
+    left_times = numpy.asarray(left_times, dtype="datetime64[us]")
+    right_times = numpy.asarray(right_times, dtype="datetime64[us]")
+    order = numpy.argsort(right_times, kind="stable")
+    sorted_times = right_times[order]
+    starts = numpy.searchsorted(sorted_times, left_times, side="left")
+    counts = numpy.searchsorted(sorted_times, left_times, side="right") - starts
+    left = numpy.repeat(numpy.arange(len(left_times)), counts)
+    # the position of each pair among those of its left time
+    firsts = numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    offsets = numpy.arange(len(left)) - firsts
+    return left, order[numpy.repeat(starts, counts) + offsets]
+
+
+def join_by_time(*series):
+    """Values of several (times, data) series at the times they all have.
+
+    Returns the matched times, followed by an array of values for each series.
+    """
+    times, data = series[0]
+    times = numpy.asarray(times, dtype="datetime64[us]")
+    values = [numpy.asarray(data, dtype=float)]
+    for other_times, other_data in series[1:]:
+        left, right = match_times(times, other_times)
+        times = times[left]
+        values = [value[left] for value in values]
+        values.append(numpy.asarray(other_data, dtype=float)[right])
+    return (times, *values)
 
 
 def mean(data):
-    return sum(data) / len(data)
+    """Mean along the last axis, leaving out NaN values.
+
+    `data` can be a stack of series, giving one mean for each. A series with
+    only NaN values has a NaN mean.
+    """
+    data = numpy.asarray(data, dtype=float)
+    counts = numpy.count_nonzero(~numpy.isnan(data), axis=-1)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        return numpy.nansum(data, axis=-1) / counts
+
+
+def moments(data):
+    """Count, mean and M2 along the last axis, leaving out NaN values.
+
+    M2 is the sum of squared differences from the mean, as in the cells of
+    the cube in inlet_data, so the variance is M2 / count. A series with only
+    NaN values has a count and M2 of 0, and a NaN mean.
+    """
+    data = numpy.asarray(data, dtype=float)
+    count = numpy.count_nonzero(~numpy.isnan(data), axis=-1)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        mean = numpy.nansum(data, axis=-1) / count
+    m2 = numpy.nansum((data - mean[..., numpy.newaxis]) ** 2, axis=-1)
+    return count, mean, m2
 
 
 def sd(data):
-    u = mean(data)
-    return math.sqrt(sum((x - u) ** 2 for x in data) / len(data))
+    # population standard deviation along the last axis, leaving out NaN values
+    count, _, m2 = moments(data)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        return numpy.sqrt(m2 / count)
+
+
+def years(times):
+    # accepts dates, datetimes or datetime64 values
+    return numpy.asarray(times, dtype="datetime64[Y]").astype(int) + 1970
+
+
+def months(times):
+    # 1-12, like datetime.date.month
+    return numpy.asarray(times, dtype="datetime64[M]").astype(int) % 12 + 1
 
 
 def index_by_month(dates):
-    dates = list(dates)
-    start_year = min(date.year for date in dates)
-    return [date.month + (12 * (date.year - start_year)) for date in dates]
+    # 1 for January of the first year, counting up by month, along the last axis
+    year = years(dates)
+    return months(dates) + 12 * (year - year.min(axis=-1, keepdims=True))
 
 
-def date_from_float(num):
-    # ignoring leap years for simplicity
-    year = math.trunc(num)
+# days in the year before the end of each month, ignoring leap years
+MONTH_ENDS = numpy.cumsum([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+
+def dates_from_floats(nums):
+    # fractional years to datetime64[D], ignoring leap years for simplicity
+    nums = numpy.asarray(nums, dtype=float)
+    years = numpy.trunc(nums).astype(int)
     # want 1-365 instead of 0-364
-    day = math.trunc((num - year) * 365) + 1
-    months = [
-        0,  # padding
-        31,  # January
-        28,  # February
-        31,  # March
-        30,  # April
-        31,  # May
-        30,  # June
-        31,  # July
-        31,  # August
-        30,  # September
-        31,  # October
-        30,  # November
-        31,  # December
-    ]
-    for m, d in enumerate(months):
-        if day < d:
-            month = m
-            break
-        else:
-            day -= d
-    return datetime.date(year, month, day)
+    days = numpy.trunc((nums - years) * 365).astype(int) + 1
+    months = numpy.searchsorted(MONTH_ENDS, days)
+    days -= numpy.concatenate([[0], MONTH_ENDS])[months]
+    return (
+        (years - 1970).astype("datetime64[Y]").astype("datetime64[M]") + months
+    ).astype("datetime64[D]") + (days - 1)
+
+
+def date_from_float(num):
+    return dates_from_floats([num])[0].astype(datetime.date)
 
 
 class Trend(Enum):
@@ -73,20 +151,123 @@ class Trend(Enum):
 
 
 def remove_seasonal_trend(x, y, trend=Trend.NONE, remove_sd=True):
-    to_process = list(y)
+    """Differences of `y` from its mean, after removing `trend`.
+
+    With `remove_sd` they are in standard deviations. `y` can be a stack of
+    series along its last axis, with times `x` for all of them or one row of
+    times each. NaN values are left out of the fit and the mean, and stay NaN.
+    """
+    y = numpy.asarray(y, dtype=float)
     if trend == Trend.DIFF:
-        to_process = [a - b for a, b in zip(to_process[1:], to_process)]
+        y = numpy.diff(y, axis=-1)
     elif trend == Trend.LINEAR:
-        domain = index_by_month(x)
-        fit = Polynomial.fit(domain, to_process, 1)
-        coeficients = fit.convert().coef
-        to_process = [
-            a - (coeficients[0] + coeficients[1] * b)
-            for a, b in zip(to_process, domain)
-        ]
-    avg = mean(to_process)
-    out = [x - avg for x in to_process]
+        # least squares line through each series against its month index
+        domain = numpy.broadcast_to(index_by_month(x), y.shape).astype(float)
+        domain = numpy.where(numpy.isnan(y), numpy.nan, domain)
+        offsets = domain - mean(domain)[..., numpy.newaxis]
+        slope = numpy.nansum(offsets * y, axis=-1) / numpy.nansum(offsets**2, axis=-1)
+        y = y - slope[..., numpy.newaxis] * offsets
+    out = y - mean(y)[..., numpy.newaxis]
     if remove_sd:
-        std_dev = sd(to_process)
-        out = [x / std_dev for x in out]
+        out = out / sd(y)[..., numpy.newaxis]
     return out
+
+
+def harmonic_terms(x, periods: Sequence[float]):
+    # offset, slope, then a cosine and a sine for each period, at month indices x
+    x = numpy.asarray(x, dtype=float)
+    terms = [numpy.ones_like(x), x]
+    for period in periods:
+        angle = 2 * numpy.pi * x / period
+        terms.extend([numpy.cos(angle), numpy.sin(angle)])
+    return numpy.stack(terms, axis=-1)
+
+
+@dataclass(frozen=True, eq=False)
+class HarmonicFit:
+    """Linear trend plus a sinusoid per period, fitted to a stack of series.
+
+    `coefficients` has the offset and slope, then the cosine and sine terms
+    of each period in months, along its last axis, and `stderr` has their
+    standard errors. The other axes, and those of the statistics, are the
+    axes of the stack apart from time.
+    """
+
+    periods: Tuple[float, ...]
+    coefficients: numpy.ndarray
+    stderr: numpy.ndarray
+    samples: numpy.ndarray
+    residual_sd: numpy.ndarray
+    r_squared: numpy.ndarray
+
+    @property
+    def offset(self) -> numpy.ndarray:
+        return self.coefficients[..., 0]
+
+    @property
+    def slope(self) -> numpy.ndarray:
+        # change per month
+        return self.coefficients[..., 1]
+
+    @property
+    def amplitudes(self) -> numpy.ndarray:
+        # one per period, along the last axis
+        return numpy.hypot(self.coefficients[..., 2::2], self.coefficients[..., 3::2])
+
+    @property
+    def phases(self) -> numpy.ndarray:
+        # in radians, so that each sinusoid is amplitude * cos(angle - phase)
+        return numpy.arctan2(self.coefficients[..., 3::2], self.coefficients[..., 2::2])
+
+    def interval(self, confidence: float = 0.95):
+        # bounds of each coefficient at `confidence`, from Student's t
+        freedom = self.samples - self.coefficients.shape[-1]
+        scale = scipy.stats.t.ppf((1 + confidence) / 2, freedom)
+        margin = numpy.asarray(scale)[..., numpy.newaxis] * self.stderr
+        return self.coefficients - margin, self.coefficients + margin
+
+    def __call__(self, x, periods: Optional[Sequence[float]] = None) -> numpy.ndarray:
+        """The fitted curves at month indices `x`, with only `periods` if given."""
+        coefficients = self.coefficients
+        if periods is not None:
+            keep = numpy.repeat(numpy.isin(self.periods, periods), 2)
+            coefficients = coefficients * numpy.concatenate([[True, True], keep])
+        terms = harmonic_terms(x, self.periods)
+        return (terms @ coefficients[..., numpy.newaxis])[..., 0]
+
+
+def fit_harmonics(x, y, periods: Sequence[float] = (12, 6, 3)) -> HarmonicFit:
+    """Fit a linear trend and sinusoids of `periods` months in one least squares solve.
+
+    `x` are month indices, as from index_by_month, or month numbers for a
+    single seasonal cycle. `y` can be a stack of series along its last axis,
+    with `x` shared by all of them or one row each, and every series is
+    fitted at once. NaN values are left out of each fit.
+    """
+    y = numpy.asarray(y, dtype=float)
+    valid = ~numpy.isnan(y)
+    terms = harmonic_terms(numpy.broadcast_to(x, y.shape), periods)
+    terms = numpy.where(valid[..., numpy.newaxis], terms, 0.0)
+    values = numpy.where(valid, y, 0.0)
+    # rows of zeros for missing values change nothing in the solution
+    solution = numpy.linalg.pinv(terms)
+    coefficients = (solution @ values[..., numpy.newaxis])[..., 0]
+    residuals = values - (terms @ coefficients[..., numpy.newaxis])[..., 0]
+    deviations = numpy.where(valid, y - mean(y)[..., numpy.newaxis], 0.0)
+    samples = valid.sum(axis=-1)
+    squares = (residuals**2).sum(axis=-1)
+    spread = (deviations**2).sum(axis=-1)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        residual_sd = numpy.sqrt(squares / (samples - terms.shape[-1]))
+        r_squared = 1 - squares / spread
+    residual_sd = numpy.where(samples > terms.shape[-1], residual_sd, numpy.nan)
+    # the diagonal of the covariance of the coefficients, as pinv(X) pinv(X)^T
+    variances = (solution**2).sum(axis=-1) * (residual_sd**2)[..., numpy.newaxis]
+    return HarmonicFit(
+        periods=tuple(periods),
+        coefficients=coefficients,
+        stderr=numpy.sqrt(variances),
+        samples=samples,
+        residual_sd=residual_sd,
+        r_squared=r_squared,
+    )